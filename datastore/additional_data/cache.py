@@ -0,0 +1,55 @@
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """A cache that holds up to max_size items, discarding the least recently
+    used item when it is full. Keeps counts of hits, misses and evictions so
+    that the size can be tuned."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        try:
+            value = self._items[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self._items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+
+        if len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            "size": len(self._items),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def __str__(self):
+        return (
+            "%(size)s/%(max_size)s items, %(hits)s hits, %(misses)s misses, %(evictions)s evictions"
+            % (self.stats())
+        )
@@ -1,3 +1,6 @@
+from django.conf import settings
+
+from additional_data import location_refs
 from additional_data.sources.find_that_charity import FindThatCharitySource
 from additional_data.sources.geo_lookup import GeoLookupSource
 from additional_data.sources.nspl import NSPLSource
@@ -12,31 +15,80 @@ from additional_data.sources.tsg_recipient_types import TSGRecipientTypesSource
 class AdditionalDataGenerator(object):
     """Adds additional data to grant data"""
 
-    def __init__(self):
-        self.find_that_charity_source = FindThatCharitySource()
-        self.nspl_source = NSPLSource()
-        self.geo_lookup = GeoLookupSource()
+    def __init__(self, snapshot=None):
+        """snapshot: Optional LookupSnapshot for the sources to look things up in
+        instead of the database"""
+        self.find_that_charity_source = FindThatCharitySource(snapshot=snapshot)
+        self.nspl_source = NSPLSource(snapshot=snapshot)
+        self.geo_lookup = GeoLookupSource(snapshot=snapshot)
         self.tsg_org_types = TSGOrgTypesSource()
         self.additional_data_recipient_location = AdditionalDataRecipientLocation()
         self.code_lists = CodeListSource()
         self.tsg_recipient_type = TSGRecipientTypesSource()
         # Initialise Other Sources here
 
+        # This ordering is important for any data dependencies
+        # Add other additional_data updaters here
+        self.sources = [
+            self.find_that_charity_source,
+            self.nspl_source,
+            self.geo_lookup,
+            self.tsg_org_types,
+            self.additional_data_recipient_location,
+            self.code_lists,
+            self.tsg_recipient_type,
+        ]
+
     def create(self, grant):
         """Takes a grant's data and returns a dict of additional data"""
 
         additional_data = {}
 
-        # This ordering is important for any data dependencies
-        # Add other additional_data updaters here
-        self.find_that_charity_source.update_additional_data(grant, additional_data)
-        self.nspl_source.update_additional_data(grant, additional_data)
-        self.geo_lookup.update_additional_data(grant, additional_data)
-        self.tsg_org_types.update_additional_data(grant, additional_data)
-        self.additional_data_recipient_location.update_additional_data(
-            grant, additional_data
-        )
-        self.code_lists.update_additional_data(grant, additional_data)
-        self.tsg_recipient_type.update_additional_data(grant, additional_data)
+        for source in self.sources:
+            source.update_additional_data(grant, additional_data)
 
         return additional_data
+
+    def create_many(self, grants):
+        """Takes a list of grants' data and returns a list of dicts of additional data
+
+        Each source processes the whole list in turn so that sources can look
+        up what they need for all of the grants at once.
+        """
+
+        additional_data_list = [{} for grant in grants]
+
+        for source in self.sources:
+            if hasattr(source, "update_additional_data_batch"):
+                source.update_additional_data_batch(grants, additional_data_list)
+            else:
+                for grant, additional_data in zip(grants, additional_data_list):
+                    source.update_additional_data(grant, additional_data)
+
+        return additional_data_list
+
+    def lookup_keys(self, grant, additional_data):
+        """Returns the sorted keys of the reference data the sources looked up to
+        create the grant's additional data, e.g. "postcode:EX364AJ"
+
+        These are stored on the grant so that the grants affected by a change to
+        the reference data can be found, see the lookup_key_changes command.
+        """
+        keys = set()
+
+        for source in self.sources:
+            if hasattr(source, "lookup_keys"):
+                keys.update(source.lookup_keys(grant, additional_data))
+
+        return sorted(keys)
+
+    def normalise(self, grant, additional_data):
+        """Returns the grant's additional data to store
+
+        With ADDITIONAL_DATA_LOCATION_REFS the area and postcode data is replaced
+        by references to it, see location_refs. Use after lookup_keys().
+        """
+        if additional_data is None or not settings.ADDITIONAL_DATA_LOCATION_REFS:
+            return additional_data
+
+        return location_refs.normalise(grant, additional_data, self.nspl_source)
@@ -0,0 +1,130 @@
+from additional_data.models import GeoLookup
+from additional_data.sources.nspl import NSPLSource
+
+# Keys of the references that replace the GeoLookup area data in locationLookup
+# and the NSPL data in recipientOrganizationLocation
+AREA_REF = "areaRef"
+POSTCODE_REF = "postcodeRef"
+
+
+def normalise(grant, additional_data, nspl_source):
+    """Replaces the areas in the additional data's locationLookup and its
+    recipientOrganizationLocation with references to them, in place
+
+    The rest of the additional data, including the fields derived from the
+    areas e.g. recipientRegionName, is kept as it is.
+    """
+    if "locationLookup" in additional_data:
+        additional_data["locationLookup"] = [
+            {
+                AREA_REF: area["areacode"],
+                "source": area["source"],
+                "sourceCode": area["sourceCode"],
+            }
+            if "areacode" in area
+            else area
+            for area in additional_data["locationLookup"]
+        ]
+
+    if "recipientOrganizationLocation" in additional_data:
+        # The same postcode NSPLSource.update_additional_data() found
+        for recipient_org in grant.get("recipientOrganization", []):
+            postcode = recipient_org.get("postalCode")
+            if postcode and nspl_source.get_location_data_by_postcode(postcode):
+                additional_data["recipientOrganizationLocation"] = {
+                    POSTCODE_REF: nspl_source.format_postcode(postcode)
+                }
+                break
+
+    return additional_data
+
+
+class LocationResolver(object):
+    """Puts the area and postcode data back in place of the references in
+    additional data normalised by normalise()
+
+    The areas and postcodes looked up are kept in memory, so use one resolver
+    for all the grants being output.
+
+    Example usage:
+
+    resolver = LocationResolver()
+    resolver.resolve_many([grant.additional_data for grant in grants])
+    """
+
+    def __init__(self):
+        # GeoLookup data by areacode
+        self.areas = {}
+        self.nspl_source = NSPLSource()
+
+    def prefetch(self, additional_data_list):
+        """Looks up all of the referenced areas and postcodes not already
+        looked up, a query for each"""
+        areacodes = set()
+        postcodes = set()
+
+        for additional_data in additional_data_list:
+            if not additional_data:
+                continue
+
+            for area in additional_data.get("locationLookup", []):
+                if AREA_REF in area and area[AREA_REF] not in self.areas:
+                    areacodes.add(area[AREA_REF])
+
+            location = additional_data.get("recipientOrganizationLocation", {})
+            if POSTCODE_REF in location:
+                postcodes.add(location[POSTCODE_REF])
+
+        if areacodes:
+            for areacode in areacodes:
+                self.areas[areacode] = None
+
+            for areacode, data in GeoLookup.objects.filter(
+                areacode__in=areacodes
+            ).values_list("areacode", "data"):
+                self.areas[areacode] = data
+
+        if postcodes:
+            self.nspl_source.prefetch_postcodes(postcodes)
+
+    def resolve_area(self, ref):
+        # Copied as the area data is shared by every grant in the area
+        area = dict(self.areas[ref[AREA_REF]] or {"areacode": ref[AREA_REF]})
+        area["source"] = ref["source"]
+        area["sourceCode"] = ref["sourceCode"]
+        return area
+
+    def resolve(self, additional_data):
+        """Replaces the references in the additional data, in place"""
+        if not additional_data:
+            return additional_data
+
+        # Nothing is looked up if it was all prefetched already
+        self.prefetch([additional_data])
+
+        if "locationLookup" in additional_data:
+            additional_data["locationLookup"] = [
+                self.resolve_area(area) if AREA_REF in area else area
+                for area in additional_data["locationLookup"]
+            ]
+
+        location = additional_data.get("recipientOrganizationLocation", {})
+        if POSTCODE_REF in location:
+            location_data = self.nspl_source.get_named_location_data(
+                location[POSTCODE_REF]
+            )
+            if location_data:
+                additional_data["recipientOrganizationLocation"] = location_data
+            else:
+                del additional_data["recipientOrganizationLocation"]
+
+        return additional_data
+
+    def resolve_many(self, additional_data_list):
+        """Replaces the references in each of the additional data, in place"""
+        self.prefetch(additional_data_list)
+
+        for additional_data in additional_data_list:
+            self.resolve(additional_data)
+
+        return additional_data_list
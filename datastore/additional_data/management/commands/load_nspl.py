@@ -1,4 +1,5 @@
-from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
 
 from additional_data.sources.nspl import NSPLSource
 
@@ -11,7 +12,24 @@ class Command(BaseCommand):
             "--url",
             help="Override the URL to NSPL data.",
         )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=10000,
+            help="The number of postcodes to load at a time.",
+        )
+        parser.add_argument(
+            "--index-only",
+            action="store_true",
+            help="Only rebuild the NSPL index (NSPL_INDEX_FILE) from the existing NSPL data.",
+        )
 
     def handle(self, *args, **options):
         source = NSPLSource()
-        source.import_nspl(options.get("url"))
+
+        if options["index_only"]:
+            if not settings.NSPL_INDEX_FILE:
+                raise CommandError("NSPL_INDEX_FILE is not set")
+            source.build_nspl_index(settings.NSPL_INDEX_FILE)
+        else:
+            source.import_nspl(options.get("url"), options["batch_size"])
@@ -1,8 +1,9 @@
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction
 
 from additional_data.models import OrgInfoCache
 from additional_data.sources.find_that_charity import FindThatCharitySource
+from db.shadow_table import ShadowTable
 
 
 class Command(BaseCommand):
@@ -26,11 +27,23 @@ class Command(BaseCommand):
             % OrgInfoCache.ORG_TYPE,
         )
 
+        parser.add_argument(
+            "--shadow",
+            action="store_true",
+            help="Load into the org data shadow table, see shadow_org_data",
+        )
+
     def handle(self, *args, **options):
+        table = None
+        if options["shadow"]:
+            shadow = ShadowTable(OrgInfoCache)
+            if not shadow.exists():
+                raise CommandError("No shadow table, use shadow_org_data --create")
+            table = shadow.table
 
         with transaction.atomic():
             added = FindThatCharitySource().import_from_path(
-                options["path"], org_type=options.get("org_type")
+                options["path"], org_type=options.get("org_type"), table=table
             )
 
             print("Added %s" % added)
@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from additional_data.models import LookupKeyHash
+
+
+class Command(BaseCommand):
+    help = (
+        "Finds the lookup keys of the reference data changed by reloading it, so "
+        "that only the affected grants' additional data needs rewriting"
+    )
+    """ Usage:
+          ./manage.py lookup_key_changes --start
+          (reload the NSPL, GeoCodeName, GeoLookup, org or codelist data)
+          ./manage.py lookup_key_changes --finish changed_keys.txt
+          ./manage.py rewrite_additional_data latest --lookup-keys-file changed_keys.txt
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--start",
+            action="store_true",
+            help="Record the current reference data before reloading it",
+        )
+
+        parser.add_argument(
+            "--finish",
+            action="store",
+            dest="keys_file",
+            help="Write the keys changed since --start to this file, one per line",
+        )
+
+    def handle(self, *args, **options):
+        if options["start"]:
+            print("Recorded %s lookup keys" % LookupKeyHash.record(), file=self.stdout)
+
+        elif options["keys_file"]:
+            if not LookupKeyHash.objects.exists():
+                raise CommandError("Nothing recorded, use --start before reloading")
+
+            changed = 0
+            with open(options["keys_file"], "w") as keys_file:
+                for key in LookupKeyHash.changed_keys():
+                    keys_file.write("%s\n" % key)
+                    changed = changed + 1
+
+            LookupKeyHash.objects.all().delete()
+
+            print("%s lookup keys changed" % changed, file=self.stdout)
+
+        else:
+            raise CommandError("Use --start or --finish")
@@ -1,7 +1,59 @@
-from django.core.management.base import BaseCommand
+import collections
+import json
+import os
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Q
 
 from additional_data.generator import AdditionalDataGenerator
-from db.models import Grant, Latest
+from additional_data.snapshot import LookupSnapshot
+from db.copy_loader import CopyLoader
+from db.management import parallel
+from db.management.commands.load_datagetter_data import batched
+from db.models import Grant, GrantBlob, Latest, SourceFile
+
+# Temporary table the new additional data of a batch of grants is copied into
+# before updating the grants from it. Emptied at the end of each transaction.
+STAGING_TABLE = "rewrite_additional_data_staging"
+
+# The generator of each worker process, kept between batches so that the
+# additional data sources' caches are reused
+_worker_generators = {}
+
+
+def additional_data_rows(generator, grants):
+    """Returns the (pk, getter_run_id, additional data, lookup keys) of each of
+    the (pk, getter_run_id, data) grants"""
+    rows = []
+
+    for (pk, getter_run_id, data), additional_data in zip(
+        grants, generator.create_many([data for pk, getter_run_id, data in grants])
+    ):
+        lookup_keys = generator.lookup_keys(data, additional_data)
+        rows.append(
+            (
+                pk,
+                getter_run_id,
+                generator.normalise(data, additional_data),
+                lookup_keys,
+            )
+        )
+
+    return rows
+
+
+def generate_additional_data(snapshot_dir, grants):
+    """Process pool worker for additional_data_rows() using the LookupSnapshot
+    in snapshot_dir"""
+    generator = _worker_generators.get(snapshot_dir)
+    if not generator:
+        generator = AdditionalDataGenerator(snapshot=LookupSnapshot(snapshot_dir))
+        _worker_generators[snapshot_dir] = generator
+
+    return additional_data_rows(generator, grants)
 
 
 class Command(BaseCommand):
@@ -17,17 +69,200 @@ class Command(BaseCommand):
             help="The datagetter run id or latest",
         )
 
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            action="store",
+            dest="batch_size",
+            help="The number of grants to read, process and update at a time",
+            default=5000,
+        )
+
+        parser.add_argument(
+            "--parallel",
+            type=int,
+            action="store",
+            dest="parallel",
+            help="Generate the additional data using this number of worker processes",
+            default=0,
+        )
+
+        parser.add_argument(
+            "--lookup-keys-file",
+            action="store",
+            dest="lookup_keys_file",
+            help=(
+                "Only rewrite the grants that looked up any of the keys in this file,"
+                " as written by lookup_key_changes --finish"
+            ),
+        )
+
+        parser.add_argument(
+            "--checkpoint",
+            action="store",
+            dest="checkpoint",
+            help=(
+                "File to record the progress in after each batch. If it exists the"
+                " rewrite resumes from where it was recorded. Removed once finished"
+            ),
+        )
+
+    def read_checkpoint(self):
+        """Returns the pk of the last grant rewritten before, or 0"""
+        if not self.options["checkpoint"] or not os.path.exists(
+            self.options["checkpoint"]
+        ):
+            return 0
+
+        with open(self.options["checkpoint"]) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+
+        if checkpoint["getter_run"] != self.options["getter_run"]:
+            raise CommandError(
+                "Checkpoint %s is for %s not %s"
+                % (
+                    self.options["checkpoint"],
+                    checkpoint["getter_run"],
+                    self.options["getter_run"],
+                )
+            )
+
+        print(
+            "Resuming after grant %s from %s"
+            % (checkpoint["last_pk"], self.options["checkpoint"]),
+            file=self.stdout,
+        )
+        return checkpoint["last_pk"]
+
+    def write_checkpoint(self, last_pk):
+        if not self.options["checkpoint"]:
+            return
+
+        tmp_path = "%s.tmp" % self.options["checkpoint"]
+        with open(tmp_path, "w") as checkpoint_file:
+            json.dump(
+                {"getter_run": self.options["getter_run"], "last_pk": last_pk},
+                checkpoint_file,
+            )
+        os.replace(tmp_path, self.options["checkpoint"])
+
+    def update_grants(self, rows):
+        """Sets the additional data of the grants from the (pk, getter_run_id,
+        additional data, lookup keys) rows"""
+        loader = CopyLoader(
+            Grant,
+            ["id", "getter_run", "additional_data", "additional_data_keys"],
+            table=STAGING_TABLE,
+        )
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            for row in rows:
+                loader.add(row)
+            loader.flush()
+
+            # Matching the getter_run too limits the update to its partition
+            cursor.execute(
+                "UPDATE db_grant SET additional_data = staging.additional_data, "
+                "additional_data_keys = staging.additional_data_keys "
+                "FROM {staging} AS staging "
+                "WHERE db_grant.id = staging.id "
+                "AND db_grant.getter_run_id = staging.getter_run_id".format(
+                    staging=STAGING_TABLE
+                )
+            )
+
+    def generate_batches(self, batches):
+        """Yields the additional data rows of each batch of grants in order"""
+        if not self.options["parallel"]:
+            generator = AdditionalDataGenerator()
+            for grants in batches:
+                yield additional_data_rows(generator, grants)
+            return
+
+        with tempfile.TemporaryDirectory() as snapshot_dir:
+            print(
+                "Lookup snapshot: %s" % LookupSnapshot.build(snapshot_dir),
+                file=self.stdout,
+            )
+
+            with parallel.Pool(self.options["parallel"]) as pool:
+                # Only read a few batches ahead of the workers, to keep the
+                # memory use down, and collect them in order so that the
+                # checkpoint covers every grant up to it
+                pending = collections.deque()
+                for grants in batches:
+                    pending.append(
+                        pool.apply_async(
+                            generate_additional_data, (snapshot_dir, grants)
+                        )
+                    )
+                    if len(pending) > self.options["parallel"] * 2:
+                        yield pending.popleft().get()
+
+                while pending:
+                    yield pending.popleft().get()
+
     def handle(self, *args, **options):
+        self.options = options
 
         if "latest" in options["getter_run"]:
-            grants = Latest.objects.get(series=Latest.CURRENT).grant_set.all()
+            grants = Latest.grants()
         else:
+            GrantBlob.hydrate(
+                SourceFile.objects.filter(getter_run=options["getter_run"])
+            )
             grants = Grant.objects.filter(getter_run=options["getter_run"])
 
-        generator = AdditionalDataGenerator()
+        if options["lookup_keys_file"]:
+            with open(options["lookup_keys_file"]) as keys_file:
+                lookup_keys = [line.rstrip("\n") for line in keys_file if line.strip()]
+            # Grants without lookup keys, e.g. loaded before they were added,
+            # may have looked up any of them. Rewriting them adds their keys.
+            without_keys = grants.filter(additional_data_keys__isnull=True).count()
+            if without_keys:
+                print(
+                    "Including %s grants without lookup keys" % without_keys,
+                    file=self.stdout,
+                )
+            # Uses the GIN index of the lookup keys and the partial index of
+            # the grants without them
+            grants = grants.filter(
+                Q(additional_data_keys__overlap=lookup_keys)
+                | Q(additional_data_keys__isnull=True)
+            )
+
+        grants = grants.filter(pk__gt=self.read_checkpoint()).order_by("pk")
+        total = grants.count()
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "CREATE TEMPORARY TABLE IF NOT EXISTS {staging} "
+                "(id integer, getter_run_id integer, additional_data jsonb,"
+                " additional_data_keys text[]) "
+                "ON COMMIT DELETE ROWS".format(staging=STAGING_TABLE)
+            )
+
+        # A server side cursor so only a batch of grants is in memory at a time
+        batches = batched(
+            grants.values_list("pk", "getter_run_id", "data").iterator(
+                chunk_size=options["batch_size"]
+            ),
+            options["batch_size"],
+        )
+
+        rewritten = 0
+        start = time.perf_counter()
+
+        for rows in self.generate_batches(batches):
+            self.update_grants(rows)
+            self.write_checkpoint(rows[-1][0])
 
-        for grant in grants:
-            additional_data = generator.create(grant.data)
-            grant.additional_data = additional_data
+            rewritten = rewritten + len(rows)
+            print(
+                "Rewrote additional data of %s/%s grants (%d grants/s)"
+                % (rewritten, total, rewritten / (time.perf_counter() - start)),
+                file=self.stdout,
+            )
 
-        Grant.objects.bulk_update(grants, ["additional_data"], batch_size=10000)
+        if options["checkpoint"] and os.path.exists(options["checkpoint"]):
+            os.remove(options["checkpoint"])
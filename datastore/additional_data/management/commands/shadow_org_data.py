@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from additional_data.models import OrgInfoCache
+from db.shadow_table import ShadowTable, SwapLockTimeout
+
+
+class Command(BaseCommand):
+    help = "Replace the find that charity data without it ever being missing"
+    """ Usage:
+          ./manage.py shadow_org_data --create
+          ./manage.py load_org_data --shadow <path> [org_type]
+          (load_org_data --shadow for each source)
+          ./manage.py shadow_org_data --swap
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--create",
+            action="store_true",
+            help="Create an empty shadow table to load the new org data into",
+        )
+
+        parser.add_argument(
+            "--swap",
+            action="store_true",
+            help="Replace the org data with the shadow table's",
+        )
+
+        parser.add_argument(
+            "--drop",
+            action="store_true",
+            help="Drop the shadow table without using it",
+        )
+
+    def handle(self, *args, **options):
+        shadow = ShadowTable(OrgInfoCache)
+
+        if options["create"]:
+            shadow.create()
+
+        elif options["swap"]:
+            if not shadow.exists():
+                raise CommandError("No shadow table, use --create and load_org_data")
+            try:
+                shadow.swap()
+            except SwapLockTimeout as e:
+                raise CommandError("%s, try --swap again later" % e)
+            print("Replaced the org data", file=self.stdout)
+
+        elif options["drop"]:
+            shadow.drop()
+
+        else:
+            raise CommandError("Use --create, --swap or --drop")
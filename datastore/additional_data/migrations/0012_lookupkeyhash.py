@@ -0,0 +1,20 @@
+# Generated by Django 3.2.16 on 2026-10-18 19:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("additional_data", "0011_alter_orginfocache_org_type"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="LookupKeyHash",
+            fields=[
+                ("key", models.TextField(primary_key=True, serialize=False)),
+                ("hash", models.CharField(max_length=32)),
+            ],
+        ),
+    ]
@@ -4,7 +4,7 @@ from django.contrib.postgres.fields import ArrayField
 from django.contrib.postgres.indexes import GinIndex
 from django.core.exceptions import ValidationError
 from django.db.models import JSONField
-from django.db import models
+from django.db import connection, models
 
 
 class OrgInfoCache(models.Model):
@@ -173,3 +173,65 @@ class CodelistCode(models.Model):
 
     class Meta:
         unique_together = ("list_name", "code")
+
+
+class LookupKeyHash(models.Model):
+    """A hash of the reference data for each lookup key (see
+    AdditionalDataGenerator.lookup_keys()) recorded before reloading the
+    reference data so that the keys it changes can be found afterwards"""
+
+    LOOKUP_KEYS_SQL = """
+        SELECT key, md5(string_agg(value, ',' ORDER BY value)) AS hash
+        FROM (
+            SELECT 'org_id:' || org_ids.org_id AS key, data::text AS value
+            FROM additional_data_orginfocache, unnest(org_ids) AS org_ids(org_id)
+            UNION ALL
+            SELECT 'postcode:' || postcode, data::text
+            FROM additional_data_nspl
+            UNION ALL
+            SELECT 'geocode:' || code, data::text
+            FROM additional_data_geocodename
+            UNION ALL
+            SELECT 'geocode:' || areacode, data::text
+            FROM additional_data_geolookup
+            UNION ALL
+            SELECT 'codelist:' || list_name || ':' || code, title
+            FROM additional_data_codelistcode
+        ) AS lookups
+        WHERE key IS NOT NULL
+        GROUP BY key
+    """
+
+    key = models.TextField(primary_key=True)
+    hash = models.CharField(max_length=32)
+
+    @staticmethod
+    def record():
+        """Replaces the recorded hashes with those of the current reference data
+        and returns the number of keys"""
+        with connection.cursor() as cursor:
+            cursor.execute("TRUNCATE additional_data_lookupkeyhash")
+            cursor.execute(
+                "INSERT INTO additional_data_lookupkeyhash (key, hash) %s"
+                % LookupKeyHash.LOOKUP_KEYS_SQL
+            )
+            return cursor.rowcount
+
+    @staticmethod
+    def changed_keys():
+        """Yields the keys whose reference data has been added, changed or
+        removed since record()"""
+        with connection.chunked_cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT COALESCE(current.key, recorded.key)
+                FROM (%s) AS current
+                FULL OUTER JOIN additional_data_lookupkeyhash AS recorded
+                    ON recorded.key = current.key
+                WHERE current.hash IS DISTINCT FROM recorded.hash
+                ORDER BY 1
+                """
+                % LookupKeyHash.LOOKUP_KEYS_SQL
+            )
+            for (key,) in cursor:
+                yield key
@@ -0,0 +1,264 @@
+import bisect
+import json
+import mmap
+import os
+import struct
+
+from django.db.models.functions import Collate
+
+from additional_data.models import NSPL
+
+MAGIC = b"NSPLIDX1"
+HEADER_LENGTH = struct.Struct("<Q")
+
+# Postcodes are stored without whitespace and uppercase, so at most 7 bytes
+KEY_WIDTH = 7
+
+# Columns with at most this many distinct values are stored as codes into a
+# table of the values rather than the values themselves
+MAX_CODED_VALUES = 2**16 - 1
+
+INT32_RANGE = range(-(2**31), 2**31)
+
+
+class NSPLIndex(object):
+    """A compact, memory-mapped, read-only index of the NSPL table
+
+    The file holds the postcodes sorted and padded to a fixed width followed by
+    one fixed-width packed row per postcode, so a lookup is a binary search of
+    the keys and a single unpack of the row. As the file is memory-mapped the
+    pages are only read in when used and are shared by every process that
+    opens the same file.
+
+    Each NSPL field is stored as a column of one of these kinds:
+
+    int / float: Every postcode has a value of that type, packed as a number.
+    code: Few distinct values, packed as a 1-based index into a table of the
+      values kept in the header. 0 means the field is not in the record.
+    json: The JSON of the value padded to the widest value. Empty means the
+      field is not in the record.
+
+    Example usage:
+
+    NSPLIndex.build("/var/lib/datastore/nspl.idx")
+    index = NSPLIndex("/var/lib/datastore/nspl.idx")
+    index.get("EX364AJ")
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, "rb") as index_file:
+            self._mmap = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mmap[: len(MAGIC)] != MAGIC:
+            raise ValueError("%s is not an NSPL index" % path)
+
+        (header_length,) = HEADER_LENGTH.unpack_from(self._mmap, len(MAGIC))
+        header_offset = len(MAGIC) + HEADER_LENGTH.size
+        header = json.loads(self._mmap[header_offset : header_offset + header_length])
+
+        self.count = header["count"]
+        self.columns = header["columns"]
+        self._row_struct = struct.Struct(row_format(self.columns))
+
+        self._keys_offset = header_offset + header_length
+        self._rows_offset = self._keys_offset + self.count * KEY_WIDTH
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        """The postcode key at position i, so that bisect can search the keys"""
+        offset = self._keys_offset + i * KEY_WIDTH
+        return self._mmap[offset : offset + KEY_WIDTH]
+
+    def get(self, postcode):
+        """Returns the NSPL data for a postcode formatted as NSPL.postcode or None"""
+        key = encode_key(postcode)
+        if key is None:
+            return None
+
+        i = bisect.bisect_left(self, key)
+        if i == self.count or self[i] != key:
+            return None
+
+        values = self._row_struct.unpack_from(
+            self._mmap, self._rows_offset + i * self._row_struct.size
+        )
+
+        data = {}
+        for column, value in zip(self.columns, values):
+            if column["kind"] == "code":
+                if value:
+                    data[column["name"]] = column["values"][value - 1]
+            elif column["kind"] == "json":
+                value = value.rstrip(b"\0")
+                if value:
+                    data[column["name"]] = json.loads(value)
+            else:
+                data[column["name"]] = value
+
+        return data
+
+    def close(self):
+        self._mmap.close()
+
+    @staticmethod
+    def build(path, batch_size=10000):
+        """Writes an index of the NSPL table to path
+
+        The index is written to a temporary file which then replaces path, so
+        processes that already have the old index open keep reading it.
+
+        Returns the number of postcodes in the index.
+        """
+        nspl_rows = NSPL.objects.order_by(Collate("postcode", "C"), "pk").values_list(
+            "postcode", "data"
+        )
+
+        def unique_rows():
+            # NSPL.objects.get() would fail for duplicated postcodes, keep the first
+            previous_key = None
+            for postcode, data in nspl_rows.iterator(chunk_size=batch_size):
+                key = encode_key(postcode)
+                if key is not None and key != previous_key:
+                    previous_key = key
+                    yield key, data
+
+        count = 0
+        columns = {}
+        for key, data in unique_rows():
+            count += 1
+            for name, value in data.items():
+                columns.setdefault(name, ColumnStats(name)).add(value)
+
+        columns = [column.describe(count) for column in columns.values()]
+        row_struct = struct.Struct(row_format(columns))
+
+        header = json.dumps({"count": count, "columns": columns}).encode()
+
+        for column in columns:
+            if column["kind"] == "code":
+                column["codes"] = {
+                    json_key(value): i + 1 for i, value in enumerate(column["values"])
+                }
+
+        keys = bytearray()
+        tmp_path = "%s.tmp" % path
+        with open(tmp_path, "wb") as index_file:
+            index_file.write(MAGIC)
+            index_file.write(HEADER_LENGTH.pack(len(header)))
+            index_file.write(header)
+
+            keys_offset = index_file.tell()
+            index_file.seek(keys_offset + count * KEY_WIDTH)
+
+            for key, data in unique_rows():
+                keys += key
+                index_file.write(pack_row(row_struct, columns, data))
+
+            index_file.seek(keys_offset)
+            index_file.write(keys)
+
+        os.replace(tmp_path, path)
+
+        return count
+
+
+class ColumnStats(object):
+    """Tracks the values of one NSPL field to choose how to store it"""
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.kinds = set()
+        self.min = None
+        self.max = None
+        self.values = {}
+        self.width = 0
+
+    def add(self, value):
+        self.count += 1
+
+        if type(value) is int:
+            self.kinds.add("int")
+            self.min = value if self.min is None else min(self.min, value)
+            self.max = value if self.max is None else max(self.max, value)
+        elif type(value) is float:
+            self.kinds.add("float")
+        else:
+            self.kinds.add("json")
+
+        # Coded values are shared by every lookup so only immutable ones are coded
+        if isinstance(value, (dict, list)):
+            self.values = None
+        elif self.values is not None:
+            self.values.setdefault(json_key(value), value)
+            if len(self.values) > MAX_CODED_VALUES:
+                self.values = None
+
+        self.width = max(self.width, len(encode_json(value)))
+
+    def describe(self, count):
+        column = {"name": self.name}
+
+        if self.values is not None and len(self.values) < 2**8:
+            column["kind"] = "code"
+            column["format"] = "B"
+            column["values"] = list(self.values.values())
+        elif self.count == count and self.kinds == {"int"}:
+            column["kind"] = "int"
+            column["format"] = (
+                "i" if self.min in INT32_RANGE and self.max in INT32_RANGE else "q"
+            )
+        elif self.count == count and self.kinds == {"float"}:
+            column["kind"] = "float"
+            column["format"] = "d"
+        elif self.values is not None:
+            column["kind"] = "code"
+            column["format"] = "H"
+            column["values"] = list(self.values.values())
+        else:
+            column["kind"] = "json"
+            column["format"] = "%ss" % self.width
+
+        return column
+
+
+def row_format(columns):
+    return "<" + "".join(column["format"] for column in columns)
+
+
+def pack_row(row_struct, columns, data):
+    values = []
+    for column in columns:
+        if column["kind"] == "code":
+            value = (
+                column["codes"][json_key(data[column["name"]])]
+                if column["name"] in data
+                else 0
+            )
+        elif column["kind"] == "json":
+            value = encode_json(data[column["name"]]) if column["name"] in data else b""
+        else:
+            value = data[column["name"]]
+        values.append(value)
+
+    return row_struct.pack(*values)
+
+
+def encode_key(postcode):
+    key = postcode.encode()
+    if len(key) > KEY_WIDTH:
+        return None
+    return key.ljust(KEY_WIDTH, b"\0")
+
+
+def encode_json(value):
+    return json.dumps(value, separators=(",", ":")).encode()
+
+
+def json_key(value):
+    """A hashable key for a value that tells 1, 1.0 and True apart"""
+    return json.dumps(value, sort_keys=True)
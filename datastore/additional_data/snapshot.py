@@ -0,0 +1,212 @@
+import bisect
+import json
+import mmap
+import os
+import struct
+
+from django.conf import settings
+from django.db import connection
+
+from additional_data.nspl_index import NSPLIndex
+
+MAGIC = b"LKUPSNP1"
+ENTRY_HEADER = struct.Struct("<II")
+OFFSET = struct.Struct("<Q")
+TRAILER = struct.Struct("<QQ")
+
+
+class Snapshot(object):
+    """A read-only, memory-mapped map of strings to JSON values
+
+    The file holds the entries sorted by key followed by a table of their
+    offsets, so a lookup is a binary search of the offsets. The values are
+    decoded on every lookup so callers are free to modify them.
+
+    Example usage:
+
+    Snapshot.write("/tmp/areas.snapshot", [("E06000001", '{"areaname": "Hartlepool"}')])
+    Snapshot("/tmp/areas.snapshot").get("E06000001")
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, "rb") as snapshot_file:
+            self._mmap = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mmap[: len(MAGIC)] != MAGIC:
+            raise ValueError("%s is not a lookup snapshot" % path)
+
+        self.count, self._offsets_offset = TRAILER.unpack_from(
+            self._mmap, len(self._mmap) - TRAILER.size
+        )
+
+    def __len__(self):
+        return self.count
+
+    def _entry(self, i):
+        (offset,) = OFFSET.unpack_from(
+            self._mmap, self._offsets_offset + i * OFFSET.size
+        )
+        key_length, value_length = ENTRY_HEADER.unpack_from(self._mmap, offset)
+        key_offset = offset + ENTRY_HEADER.size
+        return key_offset, key_length, value_length
+
+    def __getitem__(self, i):
+        """The key at position i, so that bisect can search the keys"""
+        key_offset, key_length, value_length = self._entry(i)
+        return self._mmap[key_offset : key_offset + key_length]
+
+    def get(self, key, default=None):
+        key = key.encode()
+
+        i = bisect.bisect_left(self, key)
+        if i == self.count:
+            return default
+
+        key_offset, key_length, value_length = self._entry(i)
+        if self._mmap[key_offset : key_offset + key_length] != key:
+            return default
+
+        value_offset = key_offset + key_length
+        return json.loads(self._mmap[value_offset : value_offset + value_length])
+
+    def close(self):
+        self._mmap.close()
+
+    @staticmethod
+    def write(path, items):
+        """Writes the (key, JSON text) items, which must be sorted by key, to path
+
+        Returns the number of items written.
+        """
+        offsets = []
+        previous_key = None
+
+        with open(path, "wb") as snapshot_file:
+            snapshot_file.write(MAGIC)
+
+            for key, value in items:
+                key = key.encode()
+                if previous_key is not None and key <= previous_key:
+                    raise ValueError("Snapshot keys are not sorted: %r" % key)
+                previous_key = key
+
+                value = value.encode()
+
+                offsets.append(snapshot_file.tell())
+                snapshot_file.write(ENTRY_HEADER.pack(len(key), len(value)))
+                snapshot_file.write(key)
+                snapshot_file.write(value)
+
+            offsets_offset = snapshot_file.tell()
+            for offset in offsets:
+                snapshot_file.write(OFFSET.pack(offset))
+            snapshot_file.write(TRAILER.pack(len(offsets), offsets_offset))
+
+        return len(offsets)
+
+
+def query_items(sql):
+    """Yields the (key, JSON text) rows of the sql using a server side cursor"""
+    with connection.chunked_cursor() as cursor:
+        cursor.execute(sql)
+        for key, value in cursor:
+            yield key, value
+
+
+def org_infos_items():
+    """Yields each org-id and the JSON list of the data of the OrgInfoCache
+    entries that have it in their org_ids"""
+    rows = query_items(
+        """
+        SELECT org_ids.org_id, org_info.data::text
+        FROM additional_data_orginfocache AS org_info
+        CROSS JOIN LATERAL (
+            SELECT DISTINCT unnest(org_info.org_ids) AS org_id
+        ) AS org_ids
+        WHERE org_ids.org_id IS NOT NULL
+        ORDER BY org_ids.org_id COLLATE "C", org_info.id
+        """
+    )
+
+    org_id = None
+    org_infos = []
+    for row_org_id, data in rows:
+        if row_org_id != org_id:
+            if org_infos:
+                yield org_id, "[%s]" % ",".join(org_infos)
+            org_id = row_org_id
+            org_infos = []
+        org_infos.append(data)
+
+    if org_infos:
+        yield org_id, "[%s]" % ",".join(org_infos)
+
+
+def first_items(table, key_column):
+    """Yields the key and the JSON data of the first row for each key of table"""
+    return query_items(
+        """
+        SELECT DISTINCT ON ({key_column} COLLATE "C") {key_column}, data::text
+        FROM {table}
+        ORDER BY {key_column} COLLATE "C", id
+        """.format(
+            table=connection.ops.quote_name(table),
+            key_column=connection.ops.quote_name(key_column),
+        )
+    )
+
+
+class LookupSnapshot(object):
+    """The reference tables the additional data sources look things up in,
+    written once to memory-mapped files so that any number of worker
+    processes can share them rather than each loading their own copy.
+
+    TSGOrgType rules and codelist titles are small so are still loaded by
+    each source. NSPL is only written when there isn't an NSPL_INDEX_FILE.
+
+    Example usage:
+
+    LookupSnapshot.build(directory)
+    generator = AdditionalDataGenerator(snapshot=LookupSnapshot(directory))
+    """
+
+    ORG_INFOS = "org_infos.snapshot"
+    GEO_CODE_NAMES = "geo_code_names.snapshot"
+    GEO_LOOKUPS = "geo_lookups.snapshot"
+    NSPL_INDEX = "nspl.idx"
+
+    def __init__(self, directory):
+        self.directory = directory
+
+        self.org_infos = Snapshot(os.path.join(directory, self.ORG_INFOS))
+        self.geo_code_names = Snapshot(os.path.join(directory, self.GEO_CODE_NAMES))
+        self.geo_lookups = Snapshot(os.path.join(directory, self.GEO_LOOKUPS))
+
+        self.nspl_index = None
+        if os.path.exists(os.path.join(directory, self.NSPL_INDEX)):
+            self.nspl_index = NSPLIndex(os.path.join(directory, self.NSPL_INDEX))
+
+    @classmethod
+    def build(cls, directory):
+        """Writes the snapshot of the current reference tables to directory
+        and returns a dict of the number of entries in each"""
+        counts = {
+            "org_infos": Snapshot.write(
+                os.path.join(directory, cls.ORG_INFOS), org_infos_items()
+            ),
+            "geo_code_names": Snapshot.write(
+                os.path.join(directory, cls.GEO_CODE_NAMES),
+                first_items("additional_data_geocodename", "code"),
+            ),
+            "geo_lookups": Snapshot.write(
+                os.path.join(directory, cls.GEO_LOOKUPS),
+                first_items("additional_data_geolookup", "areacode"),
+            ),
+        }
+
+        if not (settings.NSPL_INDEX_FILE and os.path.exists(settings.NSPL_INDEX_FILE)):
+            counts["nspl"] = NSPLIndex.build(os.path.join(directory, cls.NSPL_INDEX))
+
+        return counts
@@ -2,6 +2,8 @@ import csv
 import requests
 
 from additional_data.models import CodelistCode
+from db.copy_loader import CopyLoader
+from db.shadow_table import ShadowTable
 
 code_lists_urls = [
     "https://raw.githubusercontent.com/ThreeSixtyGiving/standard/master/codelists/grantToIndividualsPurpose.csv",
@@ -21,24 +23,72 @@ class CodeListSource(object):
     responsible for field: codeListLookup
     """
 
+    def __init__(self):
+        # The codelists are small so keep all of the titles by (list_name, code)
+        self.load_titles()
+
+    def load_titles(self):
+        self._titles = {
+            (list_name, code): title
+            for list_name, code, title in CodelistCode.objects.values_list(
+                "list_name", "code", "title"
+            )
+        }
+
+    def get_title(self, code, list_name):
+        """Returns the title of the code in the list
+        raises CodelistCode.DoesNotExist if there isn't one"""
+        try:
+            return self._titles[(list_name, str(code))]
+        except KeyError:
+            raise CodelistCode.DoesNotExist
+
     def import_codelists(self):
-        CodelistCode.objects.all().delete()
-
-        for code_list_url in code_lists_urls:
-            # list name = last item in split -4 to remove extension .csv
-            list_name = code_list_url.split("/")[-1:][0][:-4]
-            with requests.get(code_list_url, stream=True) as r:
-                r.raise_for_status()
-                file_data = csv.DictReader(
-                    r.iter_lines(decode_unicode=True), delimiter=","
-                )
-                for value in file_data:
-                    CodelistCode.objects.create(
-                        code=value["Code"],
-                        title=value["Title"],
-                        description=value["Description"],
-                        list_name=list_name,
+        # Replaces the existing codes once all the lists are loaded
+        with ShadowTable(CodelistCode) as shadow, CopyLoader(
+            CodelistCode,
+            ["code", "title", "description", "list_name"],
+            table=shadow.table,
+        ) as loader:
+            for code_list_url in code_lists_urls:
+                # list name = last item in split -4 to remove extension .csv
+                list_name = code_list_url.split("/")[-1:][0][:-4]
+                with requests.get(code_list_url, stream=True) as r:
+                    r.raise_for_status()
+                    file_data = csv.DictReader(
+                        r.iter_lines(decode_unicode=True), delimiter=","
                     )
+                    for value in file_data:
+                        loader.add(
+                            (
+                                value["Code"],
+                                value["Title"],
+                                value["Description"],
+                                list_name,
+                            )
+                        )
+
+        self.load_titles()
+
+    def lookup_keys(self, grant, additional_data):
+        """Returns the codes looked up for the grant as lookup keys, see
+        AdditionalDataGenerator.lookup_keys()"""
+        codes = []
+
+        to_individuals_details = grant.get("toIndividualsDetails", {})
+        for field in ["primaryGrantReason", "secondaryGrantReason"]:
+            if field in to_individuals_details:
+                codes.append(
+                    ("grantToIndividualsReason", to_individuals_details[field])
+                )
+
+        for code in to_individuals_details.get("grantPurpose", []):
+            codes.append(("grantToIndividualsPurpose", code))
+
+        if "regrantType" in grant:
+            codes.append(("regrantType", grant["regrantType"]))
+
+        return ["codelist:%s:%s" % (list_name, code) for list_name, code in codes]
 
     def update_additional_data(self, grant, additional_data):
         # check All the fields in the grant data that use codelists and make additional data field versions of them
@@ -50,36 +100,26 @@ class CodeListSource(object):
 
         try:
             code = grant["toIndividualsDetails"]["primaryGrantReason"]
-            primaryGrantReason = CodelistCode.objects.get(
-                code=code, list_name="grantToIndividualsReason"
-            ).title
+            primaryGrantReason = self.get_title(code, "grantToIndividualsReason")
         except (KeyError, CodelistCode.DoesNotExist):
             pass
 
         try:
             code = grant["toIndividualsDetails"]["secondaryGrantReason"]
-            secondaryGrantReason = CodelistCode.objects.get(
-                code=code, list_name="grantToIndividualsReason"
-            ).title
+            secondaryGrantReason = self.get_title(code, "grantToIndividualsReason")
         except (KeyError, CodelistCode.DoesNotExist):
             pass
 
         try:
             codes = grant["toIndividualsDetails"]["grantPurpose"]
             for code in codes:
-                grantPurpose.append(
-                    CodelistCode.objects.get(
-                        code=code, list_name="grantToIndividualsPurpose"
-                    ).title
-                )
+                grantPurpose.append(self.get_title(code, "grantToIndividualsPurpose"))
         except (KeyError, CodelistCode.DoesNotExist):
             pass
 
         try:
             code = grant["regrantType"]
-            regrantType = CodelistCode.objects.get(
-                code=code, list_name="regrantType"
-            ).title
+            regrantType = self.get_title(code, "regrantType")
         except (KeyError, CodelistCode.DoesNotExist):
             pass
 
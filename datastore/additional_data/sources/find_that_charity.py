@@ -2,8 +2,12 @@ import csv
 import json
 
 import requests
+from django.conf import settings
+from django.utils import timezone
 
+from additional_data.cache import LRUCache
 from additional_data.models import OrgInfoCache
+from db.copy_loader import CopyLoader
 
 
 class FindThatCharitySource(object):
@@ -12,54 +16,113 @@ class FindThatCharitySource(object):
 
     ADDITIONAL_DATA_KEY = "recipientOrgInfos"
 
-    def __init__(self, *args, **kwargs):
-        # A basic internal memory cache to avoid hitting the db on duplicate
-        # requests. Vastly speeds this process up.
+    def __init__(self, *args, snapshot=None, **kwargs):
+        # A memory cache of the org infos by org-id to avoid hitting the db on
+        # duplicate requests. Vastly speeds this process up.
         # OrgInfoCache db typical size is 565,110
         # This cache object typical size 68,458
-        self._cache = {}
+        self.cache = LRUCache(settings.ORG_INFO_CACHE_SIZE)
 
-    def update_additional_data(self, grant, additional_data):
+        # Org infos by org-id shared with other processes, used instead of the
+        # db and the cache
+        self.org_infos = snapshot.org_infos if snapshot else None
+
+    def get_org_id(self, grant):
+        """Returns the recipient org-id of the grant we can look up or None"""
         # We can't do anything if this grant doesn't have a recipientOrganization
         if not grant.get("recipientOrganization"):
-            return
+            return None
 
         if "id" not in grant["recipientOrganization"][0]:
-            return
+            return None
 
         org_id = grant["recipientOrganization"][0]["id"]
 
         if "360G-" in org_id:
             # Not valid org-id
+            return None
+
+        return org_id
+
+    def lookup_keys(self, grant, additional_data):
+        """Returns the org-id looked up for the grant as a lookup key, see
+        AdditionalDataGenerator.lookup_keys()"""
+        org_id = self.get_org_id(grant)
+        return ["org_id:%s" % org_id] if org_id else []
+
+    def get_org_infos(self, org_ids):
+        """Returns a dict of the org infos for each of the org_ids from the database"""
+        org_infos = {org_id: [] for org_id in org_ids}
+
+        for org_info_ids, data in OrgInfoCache.objects.filter(
+            org_ids__overlap=list(org_ids)
+        ).values_list("org_ids", "data"):
+            for org_id in org_infos.keys() & set(org_info_ids):
+                org_infos[org_id].append(data)
+
+        return org_infos
+
+    def update_additional_data_batch(self, grants, additional_data_list):
+        """Looks up all the org-ids of the grants not already cached in one query"""
+        if self.org_infos is not None:
+            for grant, additional_data in zip(grants, additional_data_list):
+                self.update_additional_data(grant, additional_data)
             return
 
-        # Restart the cache after 300,000 this is approximately
-        # 137.6MiB of memory.
-        if len(self._cache.keys()) > 300000:
-            self._cache = {}
-
-        try:
-            try:
-                # Memory cache because a lot of these are going to be the same
-                org_infos = self._cache[org_id]
-                additional_data[self.ADDITIONAL_DATA_KEY] = org_infos
-            except KeyError:
-                org_infos = list(
-                    OrgInfoCache.objects.filter(org_ids__contains=[org_id]).values_list(
-                        "data", flat=True
-                    )
-                )
+        org_infos = {}
+
+        for grant in grants:
+            org_id = self.get_org_id(grant)
+            if org_id and org_id not in org_infos:
+                org_infos[org_id] = self.cache.get(org_id)
 
-                additional_data[self.ADDITIONAL_DATA_KEY] = org_infos
-                self._cache[org_id] = org_infos
-        except OrgInfoCache.DoesNotExist:
-            # Store no hit so that we don't bother the db for impossible queries
-            self._cache[org_id] = None
+        missing_org_ids = [
+            org_id for org_id, cached in org_infos.items() if cached is None
+        ]
 
-    def process_csv(self, file_data, org_type):
-        """Returns total added. file_data array from csv"""
+        if missing_org_ids:
+            for org_id, org_info in self.get_org_infos(missing_org_ids).items():
+                # No org infos are cached as well to avoid repeating the query
+                self.cache[org_id] = org_info
+                org_infos[org_id] = org_info
+
+        for grant, additional_data in zip(grants, additional_data_list):
+            org_id = self.get_org_id(grant)
+            if org_id:
+                additional_data[self.ADDITIONAL_DATA_KEY] = org_infos[org_id]
+
+    def update_additional_data(self, grant, additional_data):
+        org_id = self.get_org_id(grant)
+
+        if not org_id:
+            return
+
+        if self.org_infos is not None:
+            additional_data[self.ADDITIONAL_DATA_KEY] = self.org_infos.get(org_id, [])
+            return
+
+        # Memory cache because a lot of these are going to be the same
+        org_infos = self.cache.get(org_id)
+
+        if org_infos is None:
+            org_infos = self.get_org_infos([org_id])[org_id]
+            # No org infos are cached as well to avoid repeating the query
+            self.cache[org_id] = org_infos
+
+        additional_data[self.ADDITIONAL_DATA_KEY] = org_infos
+
+    def process_csv(self, file_data, org_type, table=None):
+        """Returns total added. file_data array from csv
+        table: Optional table to load into instead of OrgInfoCache's e.g. its ShadowTable
+        """
         added = 0
-        bulk_list = []
+        fetched = timezone.now()
+        loader = CopyLoader(
+            OrgInfoCache,
+            ["data", "org_type", "org_id", "org_ids", "fetched"],
+            table=table,
+            batch_size=10000,
+        )
 
         for row in file_data:
             # Re-write string array "[ 'a','b','c' ]" values in the csv into arrays
@@ -81,18 +144,14 @@ class FindThatCharitySource(object):
             if "orgIDs" not in row:
                 row["orgIDs"] = None
 
-            bulk_list.append(
-                OrgInfoCache(
-                    data=row, org_type=org_type, org_id=row["id"], org_ids=row["orgIDs"]
-                )
-            )
+            loader.add((row, org_type, row["id"], row["orgIDs"], fetched))
             added += 1
 
-        OrgInfoCache.objects.bulk_create(bulk_list)
+        loader.flush()
 
         return added
 
-    def import_from_path(self, path, org_type=None):
+    def import_from_path(self, path, org_type=None, table=None):
         """Path can be http or file path, org_type if omitted we guess from the filename"""
         added = 0
 
@@ -112,11 +171,11 @@ class FindThatCharitySource(object):
                 file_data = csv.DictReader(
                     r.iter_lines(decode_unicode=True), delimiter=","
                 )
-                added = self.process_csv(file_data, org_type)
+                added = self.process_csv(file_data, org_type, table)
         else:
             with open(path) as csv_file:
                 file_data = csv.DictReader(csv_file, delimiter=",")
-                added = self.process_csv(file_data, org_type)
+                added = self.process_csv(file_data, org_type, table)
 
         return added
 
@@ -5,6 +5,8 @@ import requests
 import logging
 
 from additional_data.models import GeoLookup
+from db.copy_loader import CopyLoader
+from db.shadow_table import ShadowTable
 
 logger = logging.getLogger(__name__)
 
@@ -49,8 +51,12 @@ class GeoLookupSource(object):
         },
     }
 
-    def __init__(self):
-        pass
+    def __init__(self, snapshot=None):
+        # Index of all the GeoLookup data by areacode, loaded on first use
+        self._areas = None
+
+        # GeoLookup data by areacode shared with other processes
+        self.geo_lookups = snapshot.geo_lookups if snapshot else None
 
     def get_lookup_data(self, areatype, areadata, areas):
         def clean_fields(row):
@@ -98,21 +104,53 @@ class GeoLookupSource(object):
             print("fetching {}".format(areatype))
             data = self.get_lookup_data(areatype, areadata, data)
 
-        if GeoLookup.objects.exists():
-            GeoLookup.objects.all().delete()
-        GeoLookup.objects.bulk_create(
-            [
-                GeoLookup(areacode=areacode, areatype=d["areatype"], data=d)
-                for areacode, d in data.items()
-            ]
-        )
+        # Replaces the existing GeoLookup entries
+        with ShadowTable(GeoLookup) as shadow, CopyLoader(
+            GeoLookup, ["areacode", "areatype", "data"], table=shadow.table
+        ) as loader:
+            for areacode, d in data.items():
+                loader.add((areacode, d["areatype"], d))
+
+        # Reload the index on next use
+        self._areas = None
+
+    def get_areas(self):
+        """Returns the index of all GeoLookup data by areacode
+
+        The table is small so it's loaded in one go rather than querying it
+        for every lookup.
+        """
+        if self._areas is None:
+            self._areas = dict(GeoLookup.objects.values_list("areacode", "data"))
+
+        return self._areas
 
     def get_area_by_code(self, areacode):
-        try:
-            area = GeoLookup.objects.get(areacode=areacode)
-            return area.data
-        except GeoLookup.DoesNotExist:
-            pass
+        if self.geo_lookups is not None:
+            return self.geo_lookups.get(str(areacode))
+
+        area = self.get_areas().get(str(areacode))
+
+        if area:
+            # The area data gets modified so return a copy to keep the index intact
+            return dict(area)
+
+    def lookup_keys(self, grant, additional_data):
+        """Returns the area codes the grant's locations could be looked up by as
+        lookup keys, see AdditionalDataGenerator.lookup_keys()"""
+        areacodes = [
+            location.get("geoCode") for location in grant.get("beneficiaryLocation", [])
+        ]
+
+        for recipient in grant.get("recipientOrganization", []):
+            for location in recipient.get("location", []):
+                areacodes.append(location.get("geoCode"))
+
+        areacodes.append(
+            additional_data.get("recipientOrganizationLocation", {}).get("lsoa11")
+        )
+
+        return ["geocode:%s" % areacode for areacode in areacodes if areacode]
 
     def update_additional_data(self, grant, additional_data):
         """Updates with 'locationLookup' based on available areas."""
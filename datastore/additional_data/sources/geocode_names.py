@@ -6,6 +6,8 @@ from datetime import datetime
 import requests
 
 from additional_data.models import GeoCodeName
+from db.copy_loader import CopyLoader
+from db.shadow_table import ShadowTable
 
 # based on 'import_chd' function in
 # https://github.com/drkane/find-that-postcode/blob/master/findthatpostcode/commands/codes.py
@@ -124,13 +126,10 @@ class GeoCodeNamesSource(object):
         print("[areas] Processed %s areas" % len(areas))
         return areas
 
-    def save_data(self, areas):
-        bulk_save = []
-
-        for code, data in areas.items():
-            bulk_save.append(GeoCodeName(code=code, data=data))
-
-        GeoCodeName.objects.bulk_create(bulk_save)
+    def save_data(self, areas, table=None):
+        with CopyLoader(GeoCodeName, ["code", "data"], table=table) as loader:
+            for code, data in areas.items():
+                loader.add((code, data))
 
     def import_code_names(self, url=CHD_URL):
         """
@@ -147,7 +146,6 @@ class GeoCodeNamesSource(object):
         zip_file = self.get_zipfile(url)
         areas = self.get_areas(zip_file)
 
-        if GeoCodeName.objects.exists():
-            GeoCodeName.objects.all().delete()
-
-        self.save_data(areas)
+        # Replaces the existing GeoCodeName entries
+        with ShadowTable(GeoCodeName) as shadow:
+            self.save_data(areas, table=shadow.table)
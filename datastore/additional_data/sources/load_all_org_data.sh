@@ -1,29 +1,36 @@
 #!/bin/bash
 # Load all the different types of org data from Find That Charity.
+# The new data is loaded into a shadow table which replaces the old data once
+# it has all loaded.
+set -euo pipefail
 
-./manage.py load_org_data https://findthatcharity.uk/orgid/source/casc.csv
-./manage.py load_org_data https://findthatcharity.uk/orgid/source/ccew.csv
-./manage.py load_org_data https://findthatcharity.uk/orgid/source/ccni.csv
-./manage.py load_org_data https://findthatcharity.uk/orgid/source/oscr.csv
-./manage.py load_org_data https://findthatcharity.uk/orgid/source/companies.csv
-./manage.py load_org_data https://findthatcharity.uk/orgid/source/mutuals.csv
-./manage.py load_org_data https://findthatcharity.uk/orgid/source/gor.csv
-./manage.py load_org_data https://findthatcharity.uk/orgid/source/ror.csv
-./manage.py load_org_data https://findthatcharity.uk/orgid/source/hesa.csv
-./manage.py load_org_data https://findthatcharity.uk/orgid/source/lae.csv
-./manage.py load_org_data https://findthatcharity.uk/orgid/source/lani.csv
-./manage.py load_org_data https://findthatcharity.uk/orgid/source/las.csv
-./manage.py load_org_data https://findthatcharity.uk/orgid/source/pla.csv
-./manage.py load_org_data https://findthatcharity.uk/orgid/source/nhsods-epraccur.csv
-./manage.py load_org_data https://findthatcharity.uk/orgid/source/nhsods-etr.csv
-./manage.py load_org_data https://findthatcharity.uk/orgid/source/nhsods-ensa.csv
-./manage.py load_org_data https://findthatcharity.uk/orgid/source/nhsods-eccg.csv
-./manage.py load_org_data https://findthatcharity.uk/orgid/source/nhsods-ecsu.csv
-./manage.py load_org_data https://findthatcharity.uk/orgid/source/nhsods-espha.csv
-./manage.py load_org_data https://findthatcharity.uk/orgid/source/nhsods-wlhb.csv
-./manage.py load_org_data https://findthatcharity.uk/orgid/source/nhsods-ect.csv
-./manage.py load_org_data https://findthatcharity.uk/orgid/source/rsl.csv
-./manage.py load_org_data https://findthatcharity.uk/orgid/source/gias.csv schools_gias
-./manage.py load_org_data https://findthatcharity.uk/orgid/source/nideptofeducation.csv schools_ni
-./manage.py load_org_data https://findthatcharity.uk/orgid/source/schoolsscotland.csv schools_scotland
-./manage.py load_org_data https://findthatcharity.uk/orgid/source/walesschools.csv schools_wales
+./manage.py shadow_org_data --create
+
+./manage.py load_org_data --shadow https://findthatcharity.uk/orgid/source/casc.csv
+./manage.py load_org_data --shadow https://findthatcharity.uk/orgid/source/ccew.csv
+./manage.py load_org_data --shadow https://findthatcharity.uk/orgid/source/ccni.csv
+./manage.py load_org_data --shadow https://findthatcharity.uk/orgid/source/oscr.csv
+./manage.py load_org_data --shadow https://findthatcharity.uk/orgid/source/companies.csv
+./manage.py load_org_data --shadow https://findthatcharity.uk/orgid/source/mutuals.csv
+./manage.py load_org_data --shadow https://findthatcharity.uk/orgid/source/gor.csv
+./manage.py load_org_data --shadow https://findthatcharity.uk/orgid/source/ror.csv
+./manage.py load_org_data --shadow https://findthatcharity.uk/orgid/source/hesa.csv
+./manage.py load_org_data --shadow https://findthatcharity.uk/orgid/source/lae.csv
+./manage.py load_org_data --shadow https://findthatcharity.uk/orgid/source/lani.csv
+./manage.py load_org_data --shadow https://findthatcharity.uk/orgid/source/las.csv
+./manage.py load_org_data --shadow https://findthatcharity.uk/orgid/source/pla.csv
+./manage.py load_org_data --shadow https://findthatcharity.uk/orgid/source/nhsods-epraccur.csv
+./manage.py load_org_data --shadow https://findthatcharity.uk/orgid/source/nhsods-etr.csv
+./manage.py load_org_data --shadow https://findthatcharity.uk/orgid/source/nhsods-ensa.csv
+./manage.py load_org_data --shadow https://findthatcharity.uk/orgid/source/nhsods-eccg.csv
+./manage.py load_org_data --shadow https://findthatcharity.uk/orgid/source/nhsods-ecsu.csv
+./manage.py load_org_data --shadow https://findthatcharity.uk/orgid/source/nhsods-espha.csv
+./manage.py load_org_data --shadow https://findthatcharity.uk/orgid/source/nhsods-wlhb.csv
+./manage.py load_org_data --shadow https://findthatcharity.uk/orgid/source/nhsods-ect.csv
+./manage.py load_org_data --shadow https://findthatcharity.uk/orgid/source/rsl.csv
+./manage.py load_org_data --shadow https://findthatcharity.uk/orgid/source/gias.csv schools_gias
+./manage.py load_org_data --shadow https://findthatcharity.uk/orgid/source/nideptofeducation.csv schools_ni
+./manage.py load_org_data --shadow https://findthatcharity.uk/orgid/source/schoolsscotland.csv schools_scotland
+./manage.py load_org_data --shadow https://findthatcharity.uk/orgid/source/walesschools.csv schools_wales
+
+./manage.py shadow_org_data --swap
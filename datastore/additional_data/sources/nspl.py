@@ -3,16 +3,30 @@ import hashlib
 import io
 import zipfile
 import logging
+import os
+import re
+import tempfile
+import time
 from datetime import datetime
 
 import requests
+from django.conf import settings
 
+from additional_data.cache import LRUCache
 from additional_data.models import NSPL, GeoCodeName
+from additional_data.nspl_index import NSPLIndex
+from db.copy_loader import CopyLoader
+from db.shadow_table import ShadowTable
 
 # Code based on https://github.com/drkane/find-that-postcode/blob/main/findthatpostcode/commands/postcodes.py
 
 logger = logging.getLogger(__name__)
 
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# GSS codes e.g. E07000043, the format of the GeoCodeName codes
+GSS_CODE = re.compile(r"^[A-Z][0-9]{8}$")
+
 
 class NSPLSource(object):
     """Imports NSPL (National Statistics Postcode Lookup) data and
@@ -25,16 +39,119 @@ class NSPLSource(object):
     #  https://geoportal.statistics.gov.uk/search?collection=Dataset&q=National%20Statistics%20Postcode%20Lookup%20-%202021%20Census&sort=-modified&source=office%20for%20national%20statistics&tags=national%20statistics%20postcode%20lookup%2C2021_cencus&type=csv%20collection
     NSPL_URL = "https://www.arcgis.com/sharing/rest/content/items/204e40244d4d4903ba1861d492f47d29/data"
 
-    def __init__(self):
-        self._nspl_cache = {}
-        self._code_name_cache = {}
-
-    def get_zipfile(self, url=NSPL_URL):
+    def __init__(self, snapshot=None):
+        # The NSPL data of each formatted postcode, when there isn't an index
+        self._nspl_cache = LRUCache(settings.NSPL_CACHE_SIZE)
+        # GeoCodeName names by code, loaded on first use when there isn't a
+        # snapshot
+        self._code_names = None
+        # The location data with code names of each formatted postcode
+        self._named_locations = LRUCache(settings.NAMED_LOCATION_CACHE_SIZE)
+
+        self.nspl_index = None
+        if snapshot and snapshot.nspl_index is not None:
+            self.nspl_index = snapshot.nspl_index
+        elif settings.NSPL_INDEX_FILE and os.path.exists(settings.NSPL_INDEX_FILE):
+            self.nspl_index = NSPLIndex(settings.NSPL_INDEX_FILE)
+
+        # GeoCodeName data by code shared with other processes
+        self.geo_code_names = snapshot.geo_code_names if snapshot else None
+
+    def get_zipfile(self, url, zip_fp):
+        """Streams the zipfile at url into the zip_fp temporary file so that
+        the whole archive isn't held in memory"""
         r = requests.get(url, stream=True)
+        r.raise_for_status()
+
+        for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            zip_fp.write(chunk)
+        zip_fp.seek(0)
+
+        return zipfile.ZipFile(zip_fp)
+
+    def process_nspl_record(self, record):
+        """Converts an NSPL CSV record into NSPL.data in place"""
+        # null any blank fields (or ones with a dummy code in)
+        for key in record:
+            if record[key] == "" or record[key] in [
+                "E99999999",
+                "S99999999",
+                "W99999999",
+                "N99999999",
+            ]:
+                record[key] = None
+
+        # date fields
+        for field in ["dointr", "doterm"]:
+            if record[field]:
+                date_field = datetime.strptime(record[field][:6], "%Y%m")
+                record[field] = str(date_field)
+
+        # latitude and longitude
+        for field in ["lat", "long"]:
+            if record[field]:
+                record[field] = float(record[field])
+                if record[field] == 99.999999:
+                    record[field] = None
+        if record["lat"] and record["long"] and self.keeps_field("location"):
+            record["location"] = {
+                "lat": record["lat"],
+                "lon": record["long"],
+            }
+
+        # integer fields
+        for field in [
+            "oseast1m",
+            "osnrth1m",
+            "usertype",
+            "osgrdind",
+            "imd",
+        ]:
+            if record[field]:
+                record[field] = int(record[field])
+
+        # add postcode hash
+        if self.keeps_field("hash"):
+            record["hash"] = hashlib.md5(
+                record["pcds"].lower().replace(" ", "").encode()
+            ).hexdigest()
+
+        return record
+
+    def keeps_field(self, field):
+        """Returns whether the field is one of the NSPL_FIELDS kept"""
+        return not settings.NSPL_FIELDS or field in settings.NSPL_FIELDS
+
+    def project_nspl_record(self, record):
+        """Returns the NSPL_FIELDS of the record that have a value"""
+        if not settings.NSPL_FIELDS:
+            return record
+
+        return {
+            field: record[field]
+            for field in settings.NSPL_FIELDS
+            if record.get(field) is not None
+        }
 
-        return zipfile.ZipFile(io.BytesIO(r.content))
-
-    def process_nspl_data(self, zip_file):
+    def nspl_postcode(self, record):
+        nspl_postcode = (
+            record["pcd"]
+            if record["pcd"]
+            else record["pcd2"]
+            if record["pcd2"]
+            else record["pcds"]
+        )
+        return "".join(nspl_postcode.split()).upper()
+
+    def process_nspl_data(self, zip_file, batch_size=10000, table=None):
+        """Reads each NSPL CSV in the zip_file a row at a time and COPYs them
+        into the NSPL table, or table, batch_size rows at a time"""
+        total_count = 0
+        start = time.perf_counter()
+
+        loader = CopyLoader(
+            NSPL, ["postcode", "data"], table=table, batch_size=batch_size
+        )
 
         for file in zip_file.filelist:
             if not file.filename.endswith(".csv") or not file.filename.startswith(
@@ -51,77 +168,24 @@ class NSPLSource(object):
                 postcode_csv = io.TextIOWrapper(postcode_csv)
                 reader = csv.DictReader(postcode_csv)
 
-                postcodes = []
                 for record in reader:
-
-                    # null any blank fields (or ones with a dummy code in)
-                    for key in record:
-                        if record[key] == "" or record[key] in [
-                            "E99999999",
-                            "S99999999",
-                            "W99999999",
-                            "N99999999",
-                        ]:
-                            record[key] = None
-
-                    # date fields
-                    for field in ["dointr", "doterm"]:
-                        if record[field]:
-                            date_field = datetime.strptime(record[field][:6], "%Y%m")
-                            record[field] = str(date_field)
-
-                    # latitude and longitude
-                    for field in ["lat", "long"]:
-                        if record[field]:
-                            record[field] = float(record[field])
-                            if record[field] == 99.999999:
-                                record[field] = None
-                    if record["lat"] and record["long"]:
-                        record["location"] = {
-                            "lat": record["lat"],
-                            "lon": record["long"],
-                        }
-
-                    # integer fields
-                    for field in [
-                        "oseast1m",
-                        "osnrth1m",
-                        "usertype",
-                        "osgrdind",
-                        "imd",
-                    ]:
-                        if record[field]:
-                            record[field] = int(record[field])
-
-                    # add postcode hash
-                    record["hash"] = hashlib.md5(
-                        record["pcds"].lower().replace(" ", "").encode()
-                    ).hexdigest()
-
-                    postcodes.append(record)
+                    record = self.process_nspl_record(record)
+                    loader.add(
+                        (self.nspl_postcode(record), self.project_nspl_record(record))
+                    )
                     postcode_count += 1
 
-                self.save_nspl_data(postcodes)
+            loader.flush()
+            total_count += postcode_count
 
-                print("[postcodes] Processed %s postcodes" % postcode_count)
-
-    def save_nspl_data(self, data):
-        bulk_save = []
-
-        for record in data:
-            nspl_postcode = (
-                record["pcd"]
-                if record["pcd"]
-                else record["pcd2"]
-                if record["pcd2"]
-                else record["pcds"]
+            print(
+                "[postcodes] Processed %s postcodes (%d postcodes/s)"
+                % (postcode_count, total_count / (time.perf_counter() - start))
             )
-            postcode = "".join(nspl_postcode.split()).upper()
-            bulk_save.append(NSPL(postcode=postcode, data=record))
 
-        NSPL.objects.bulk_create(bulk_save)
+        return total_count
 
-    def import_nspl(self, url=None):
+    def import_nspl(self, url=None, batch_size=10000):
         """
         Example of a data db entry:
         {
@@ -136,59 +200,159 @@ class NSPLSource(object):
             'oseast1m': 385386, 'osgrdind': 1, 'osnrth1m': 801193, 'usertype': 0
         }
         Field names information can be found in NSPL User Guide at https://geoportal.statistics.gov.uk/
+
+        Only the NSPL_FIELDS that have a value are kept when it is set.
         """
 
         if url is None:
             url = self.NSPL_URL
 
-        if NSPL.objects.exists():
-            logger.info("Deleting existing NSPL entries")
-            NSPL.objects.all().delete()
-        else:
-            logger.info("No existing NSPL entries found")
+        # The existing NSPL entries are replaced once all the new ones are loaded
+        with tempfile.TemporaryFile() as zip_fp, ShadowTable(NSPL) as shadow:
+            logger.info(f"Fetching NSPL zipfile from {url}")
+            zip_file = self.get_zipfile(url, zip_fp)
 
-        logger.info(f"Fetching NSPL zipfile from {url}")
-        zip_file = self.get_zipfile(url)
+            logger.info(f"Got NSPL zipfile containing {len(zip_file.filelist)} files")
+            self.process_nspl_data(zip_file, batch_size, table=shadow.table)
 
-        logger.info(f"Got NSPL zipfile containing {len(zip_file.filelist)} files")
-        self.process_nspl_data(zip_file)
+        if settings.NSPL_INDEX_FILE:
+            self.build_nspl_index(settings.NSPL_INDEX_FILE)
+
+    def build_nspl_index(self, path):
+        print("[postcodes] Building NSPL index %s" % path)
+        count = NSPLIndex.build(path)
+        print("[postcodes] Indexed %s postcodes" % count)
+
+    def format_postcode(self, postcode):
+        return "".join(postcode.split()).upper()
 
     def get_location_data_by_postcode(self, postcode):
-        format_postcode = "".join(postcode.split()).upper()
-        try:
-            return self._nspl_cache[format_postcode]
-        except KeyError:
-            try:
-                nspl = NSPL.objects.get(postcode=format_postcode)
-                self._nspl_cache[format_postcode] = nspl.data
-                return nspl.data
-            except NSPL.DoesNotExist:
-                self._nspl_cache[format_postcode] = None
-                pass
+        format_postcode = self.format_postcode(postcode)
+
+        # The index is shared between processes and cheap to read so the
+        # location data isn't cached
+        if self.nspl_index is not None:
+            return self.nspl_index.get(format_postcode)
+
+        # Postcodes without NSPL data are cached as None
+        location_data = self._nspl_cache.get(format_postcode, False)
+        if location_data is False:
+            location_data = (
+                NSPL.objects.filter(postcode=format_postcode)
+                .values_list("data", flat=True)
+                .first()
+            )
+            self._nspl_cache[format_postcode] = location_data
+        return location_data
+
+    def get_code_names(self):
+        """Returns the name of each GeoCodeName code, loading them all the
+        first time"""
+        if self._code_names is None:
+            # The first by id wins when a code is duplicated, as in a snapshot
+            self._code_names = dict(
+                GeoCodeName.objects.order_by("-id")
+                .values_list("code", "data__name")
+                .iterator()
+            )
+        return self._code_names
+
+    def get_code_name(self, code):
+        """Returns (True, name) if there is a GeoCodeName for code, otherwise
+        (False, None)"""
+        if self.geo_code_names is not None:
+            code_name_data = self.geo_code_names.get(code)
+            if code_name_data is None:
+                return False, None
+            return True, code_name_data.get("name")
+
+        code_names = self.get_code_names()
+        if code not in code_names:
+            return False, None
+        return True, code_names[code]
 
     def update_location_data_code_names(self, location_data):
         """Adds new entries to location data dict with code names."""
         for field_name, field_value in location_data.copy().items():
-            if type(field_value) is not str:
+            # Only GSS codes have names, not the postcodes, coordinates, etc.
+            if type(field_value) is not str or not GSS_CODE.match(field_value):
                 continue
 
-            try:
-                code_name_obj = self._code_name_cache[field_value]
-                if code_name_obj is None:
-                    continue
-            except KeyError:
-                try:
-                    code_name_obj = GeoCodeName.objects.get(code=field_value)
-                    self._code_name_cache[field_value] = code_name_obj
-                except GeoCodeName.DoesNotExist:
-                    self._code_name_cache[field_value] = None
-                    continue
-
-            code_name = code_name_obj.data.get("name")
-            location_data["{}_name".format(field_name)] = code_name
+            found, code_name = self.get_code_name(field_value)
+            if found:
+                location_data["{}_name".format(field_name)] = code_name
 
         return location_data
 
+    def get_named_location_data(self, postcode):
+        """Returns a copy of the location data of the postcode with its code
+        names, or None. The code names are only added once per postcode."""
+        format_postcode = self.format_postcode(postcode)
+
+        named_location_data = self._named_locations.get(format_postcode, False)
+        if named_location_data is False:
+            location_data = self.get_location_data_by_postcode(format_postcode)
+            if location_data:
+                # Copied to leave the cached location data as it is
+                named_location_data = self.update_location_data_code_names(
+                    dict(location_data)
+                )
+            else:
+                named_location_data = None
+            self._named_locations[format_postcode] = named_location_data
+
+        if named_location_data is None:
+            return None
+        return dict(named_location_data)
+
+    def update_additional_data_batch(self, grants, additional_data_list):
+        """Looks up all the postcodes of the grants in advance, see prefetch_postcodes()"""
+        postcodes = set()
+        for grant in grants:
+            for recipient_org in grant.get("recipientOrganization", []):
+                postcode = recipient_org.get("postalCode")
+                if postcode and type(postcode) is str:
+                    postcodes.add(self.format_postcode(postcode))
+
+        self.prefetch_postcodes(postcodes)
+
+        for grant, additional_data in zip(grants, additional_data_list):
+            self.update_additional_data(grant, additional_data)
+
+    def prefetch_postcodes(self, postcodes):
+        """Looks up all the formatted postcodes not already cached in one query
+        (unless there is an NSPL index)"""
+        postcodes = {
+            postcode for postcode in postcodes if postcode not in self._nspl_cache
+        }
+
+        if postcodes and self.nspl_index is None:
+            found = dict(
+                NSPL.objects.filter(postcode__in=postcodes).values_list(
+                    "postcode", "data"
+                )
+            )
+            # Only up to NSPL_CACHE_SIZE of them are kept
+            for postcode in postcodes:
+                self._nspl_cache[postcode] = found.get(postcode)
+
+    def lookup_keys(self, grant, additional_data):
+        """Returns the postcodes and the location data codes looked up for the
+        grant as lookup keys, see AdditionalDataGenerator.lookup_keys()"""
+        keys = []
+
+        for recipient_org in grant.get("recipientOrganization", []):
+            postcode = recipient_org.get("postalCode")
+            if postcode and type(postcode) is str:
+                keys.append("postcode:%s" % self.format_postcode(postcode))
+
+        location_data = additional_data.get("recipientOrganizationLocation", {})
+        for field_value in location_data.values():
+            if type(field_value) is str and GSS_CODE.match(field_value):
+                keys.append("geocode:%s" % field_value)
+
+        return keys
+
     def update_additional_data(self, grant, additional_data):
         """
         Updates with 'recipientOrganizationLocation' based on it's postcode.
@@ -199,8 +363,7 @@ class NSPLSource(object):
         for recipient_org in recipient_orgs:
             postcode = recipient_org.get("postalCode")
             if postcode:
-                location_data = self.get_location_data_by_postcode(postcode)
+                location_data = self.get_named_location_data(postcode)
                 if location_data:
-                    self.update_location_data_code_names(location_data)
                     additional_data["recipientOrganizationLocation"] = location_data
                     break
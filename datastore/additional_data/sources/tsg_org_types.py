@@ -2,6 +2,9 @@ import re
 
 from additional_data.models import TSGOrgType
 
+# e.g. \\1, the numbers change when the rules are combined
+NUMBERED_BACKREFERENCE = re.compile(r"\\[1-9]")
+
 
 class TSGOrgTypesSource(object):
     """This adds a custom ThreeSixtyGiving organisation type of the funding organisation to the additional data"""
@@ -13,9 +16,9 @@ class TSGOrgTypesSource(object):
         self.VALUE = 1
         self.tsg_org_type_rules = []
 
-        # Order - The highest priority rule gets added last as this is the one that will
-        # be processed last and therefore overwrite any existing value.
-        for tsg_org_type_rule in TSGOrgType.objects.all().order_by("priority"):
+        # Order - The highest priority rule goes first as the first rule that
+        # matches is the one used.
+        for tsg_org_type_rule in TSGOrgType.objects.all().order_by("-priority"):
             try:
                 self.tsg_org_type_rules.append(
                     (
@@ -27,6 +30,60 @@ class TSGOrgTypesSource(object):
             except re.error:
                 continue
 
+        self.matcher, self.rule_groups = self.combine_rules()
+
+        # The TSG org type of each funder org-id, a file usually only has a few
+        self._org_types = {}
+
+    def combine_rules(self):
+        """Returns all the rules as a single regex of alternatives in priority
+        order, so the first alternative to match is the highest priority rule
+        that matches, and the index of the group around each alternative
+
+        Returns None, None if the rules can't be combined, e.g. a rule refers to
+        its own groups by number, in which case they are tried one at a time.
+        """
+        if not self.tsg_org_type_rules or any(
+            NUMBERED_BACKREFERENCE.search(rule[self.REGEX].pattern)
+            for rule in self.tsg_org_type_rules
+        ):
+            return None, None
+
+        rule_groups = {}
+        group = 1
+        for i, rule in enumerate(self.tsg_org_type_rules):
+            rule_groups[group] = i
+            group += 1 + rule[self.REGEX].groups
+
+        try:
+            matcher = re.compile(
+                "|".join(
+                    "(%s)" % rule[self.REGEX].pattern
+                    for rule in self.tsg_org_type_rules
+                )
+            )
+        except re.error:
+            return None, None
+
+        return matcher, rule_groups
+
+    def get_org_type(self, funding_org_id):
+        """Returns the TSG org type of the highest priority rule matching the
+        funder org-id, or None"""
+        if self.matcher is not None:
+            match = self.matcher.match(funding_org_id)
+            if match:
+                # The group around the rule closes last so is the lastindex
+                rule = self.tsg_org_type_rules[self.rule_groups[match.lastindex]]
+                return rule[self.VALUE]
+            return None
+
+        for org_type_rule in self.tsg_org_type_rules:
+            if org_type_rule[self.REGEX].match(funding_org_id):
+                return org_type_rule[self.VALUE]
+
+        return None
+
     def update_additional_data(self, grant, additional_data):
         try:
             funding_org_id = grant["fundingOrganization"][0]["id"]
@@ -34,6 +91,11 @@ class TSGOrgTypesSource(object):
             print(e)
             return
 
-        for org_type_rule in self.tsg_org_type_rules:
-            if org_type_rule[self.REGEX].match(funding_org_id):
-                additional_data[self.ADDITIONAL_DATA_KEY] = org_type_rule[self.VALUE]
+        try:
+            org_type = self._org_types[funding_org_id]
+        except KeyError:
+            org_type = self.get_org_type(funding_org_id)
+            self._org_types[funding_org_id] = org_type
+
+        if org_type is not None:
+            additional_data[self.ADDITIONAL_DATA_KEY] = org_type
@@ -1,12 +1,15 @@
 #!/bin/bash
 set -euo pipefail
 
-# Replace all additional data i.e. delete the old, load in the new
+# Replace all additional data i.e. load in the new, then swap it for the old
 
 manage_py="./manage.py"
 
 set -x
 
+# Remember the reference data so the grants affected by the changes can be found
+$manage_py lookup_key_changes --start
+
 # 360 CodeLists
 
 $manage_py load_codelist_codes
@@ -19,8 +22,9 @@ $manage_py load_nspl
 
 # Org data
 
-$manage_py delete_org_data --no-prompt
 bash ./additional_data/sources/load_all_org_data.sh
 
-# $manage_py rewrite_additional_data
+$manage_py lookup_key_changes --finish ./changed_lookup_keys.txt
+
+# $manage_py rewrite_additional_data latest --lookup-keys-file ./changed_lookup_keys.txt
 # $manage_py rewrite_quality_data
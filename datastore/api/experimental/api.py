@@ -22,4 +22,4 @@ class CurrentLatestGrants(generics.ListAPIView):
     )
 
     def get_queryset(self):
-        return db.Latest.objects.get(series=db.Latest.CURRENT).grant_set.all()
+        return db.Latest.grants()
@@ -1,9 +1,29 @@
 from rest_framework import serializers
 
 import db.models as db
+from additional_data.location_refs import LocationResolver
+
+
+class CurrentLatestGrantListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        # The data of compacted grants is in their blobs
+        grants = db.GrantBlob.fill(list(data))
+
+        # Puts the area and postcode data in place of any references to them
+        LocationResolver().resolve_many([grant.additional_data for grant in grants])
+
+        return super().to_representation(grants)
 
 
 class CurrentLatestGrantSerializer(serializers.ModelSerializer):
     class Meta:
         model = db.Grant
-        exclude = ["id", "getter_run", "latest", "source_file"]
+        list_serializer_class = CurrentLatestGrantListSerializer
+        exclude = [
+            "id",
+            "getter_run",
+            "latest",
+            "source_file",
+            "blob",
+            "additional_data_keys",
+        ]
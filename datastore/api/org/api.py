@@ -114,7 +114,8 @@ class OrganisationGrantsMadeView(generics.ListAPIView):
             raise rest_framework.exceptions.NotFound()
 
         return db.Grant.objects.filter(
-            source_file__latest__series=db.Latest.CURRENT
+            source_file__latest__series=db.Latest.CURRENT,
+            getter_run__in=db.Latest.current_getter_run_ids(),
         ).filter(funding_org_ids__contains=[org_id])
 
 
@@ -137,5 +138,6 @@ class OrganisationGrantsReceivedView(generics.ListAPIView):
             raise rest_framework.exceptions.NotFound()
 
         return db.Grant.objects.filter(
-            source_file__latest__series=db.Latest.CURRENT
+            source_file__latest__series=db.Latest.CURRENT,
+            getter_run__in=db.Latest.current_getter_run_ids(),
         ).filter(recipient_org_ids__contains=[org_id])
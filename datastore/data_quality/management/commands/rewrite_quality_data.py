@@ -3,19 +3,29 @@ from django.core.cache import cache
 from django.db import connection
 
 from data_quality import quality_data
+from db.management import parallel
 import db.models as db
 
-from multiprocessing import Pool, dummy
+from multiprocessing import dummy
 
+# The number of grants fetched at a time by the server side cursor that reads
+# a source file's grants
+GRANTS_CHUNK_SIZE = 2000
 
-def process_source_file(source_file):
+
+def process_source_file(source_file_pk):
+    """Process pool worker that reads the grants of the source file itself and
+    returns its (pk, quality, aggregate), or None if they couldn't be created"""
     try:
-        source_file["quality"], source_file["aggregate"] = quality_data.create(
-            source_file["grants"]
+        grants = list(
+            db.Grant.objects.filter(source_file_id=source_file_pk)
+            .values_list("data", flat=True)
+            .iterator(chunk_size=GRANTS_CHUNK_SIZE)
         )
-        return source_file
+        quality, aggregate = quality_data.create(grants)
+        return source_file_pk, quality, aggregate
     except Exception as e:
-        print(f"{e} Could not create source file data for: {source_file}")
+        print(f"{e} Could not create source file data for: {source_file_pk}")
 
 
 class Command(BaseCommand):
@@ -50,7 +60,92 @@ class Command(BaseCommand):
             help="Update the quality data for specified publisher (prefix)",
         )
 
+        parser.add_argument(
+            "--parallel",
+            type=int,
+            action="store",
+            dest="parallel",
+            help="Create the source file quality data using this number of worker processes",
+            default=8,
+        )
+
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help=(
+                "Create the source file quality data even when a source file with"
+                " the same grant data already has it"
+            ),
+        )
+
+    def reuse_quality_data(self, source_file_pk, grants_hash):
+        """Copies the quality and aggregate of the most recent other SourceFile
+        with the same grants hash, if there is one, to the source file.
+        Returns whether they were copied."""
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                UPDATE db_sourcefile SET
+                    quality = previous.quality,
+                    aggregate = previous.aggregate,
+                    grants_hash = previous.grants_hash
+                FROM (
+                    SELECT quality, aggregate, grants_hash FROM db_sourcefile
+                    WHERE grants_hash = %s AND id != %s
+                    AND quality IS NOT NULL AND aggregate IS NOT NULL
+                    ORDER BY id DESC
+                    LIMIT 1
+                ) AS previous
+                WHERE db_sourcefile.id = %s
+                """,
+                [grants_hash, source_file_pk, source_file_pk],
+            )
+            return cursor.rowcount > 0
+
+    def process_source_files(self, source_files):
+        grants_hashes = db.SourceFile.grants_hashes(source_files)
+
+        unchanged = 0
+        to_create = []
+        for pk, current_grants_hash in source_files.values_list("pk", "grants_hash"):
+            grants_count, grants_hash = grants_hashes.get(pk, (0, None))
+
+            if grants_hash and not self.options["force"]:
+                # The grants hash is only set along with the quality data
+                if grants_hash == current_grants_hash or self.reuse_quality_data(
+                    pk, grants_hash
+                ):
+                    unchanged = unchanged + 1
+                    continue
+
+            to_create.append((grants_count, pk))
+
+        print(
+            "Reused the quality data of %s unchanged source files, creating %s"
+            % (unchanged, len(to_create))
+        )
+
+        # Largest first so that a big source file isn't left running on its own
+        # at the end. Each worker reads its source file's grants so they are
+        # never all held by this process.
+        to_create.sort(reverse=True)
+
+        with parallel.Pool(self.options["parallel"]) as process_pool:
+            for source_file_result in process_pool.imap_unordered(
+                process_source_file, [pk for grants_count, pk in to_create]
+            ):
+                if source_file_result is None:
+                    continue
+
+                pk, quality, aggregate = source_file_result
+                db.SourceFile.objects.filter(pk=pk).update(
+                    quality=quality,
+                    aggregate=aggregate,
+                    grants_hash=grants_hashes.get(pk, (0, None))[1],
+                )
+
     def handle(self, *args, **options):
+        self.options = options
 
         if "latest" in options["getter_run"]:
             source_files = db.Latest.objects.get(
@@ -60,6 +155,7 @@ class Command(BaseCommand):
             source_files = db.SourceFile.objects.filter(
                 getter_run=options["getter_run"]
             )
+            db.GrantBlob.hydrate(source_files)
 
         if options.get("publisher"):
             source_files = source_files.filter(
@@ -67,35 +163,10 @@ class Command(BaseCommand):
             )
 
         publisher_objs_for_update = []
-        sourcefile_objs_for_update = []
 
         if not options["publisher_only"]:
             print("Processing sourcefile data")
-            process_sf_list = []
-            for source_file in source_files:
-                process_sf_list.append(
-                    {
-                        "pk": source_file.pk,
-                        "grants": list(
-                            source_file.grant_set.values_list("data", flat=True)
-                        ),
-                    }
-                )
-
-            with Pool(8) as process_pool:
-                source_file_results = process_pool.map(
-                    process_source_file, process_sf_list
-                )
-
-                for source_file_result in source_file_results:
-                    sf = db.SourceFile.objects.get(pk=source_file_result["pk"])
-                    sf.quality = source_file_result["quality"]
-                    sf.aggregate = source_file_result["aggregate"]
-                    sourcefile_objs_for_update.append(sf)
-
-            db.SourceFile.objects.bulk_update(
-                sourcefile_objs_for_update, ["quality", "aggregate"], batch_size=10000
-            )
+            self.process_source_files(source_files)
 
         def process_publishers(source_file):
             publisher = source_file.get_publisher()
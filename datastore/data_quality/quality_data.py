@@ -8,189 +8,418 @@ from lib360dataquality.cove.threesixtygiving import (
 from lib360dataquality.cove.schema import Schema360
 from lib360dataquality import check_field_present
 
-from django.db.models import Sum
-from django.db.models.expressions import RawSQL
+from django.db.models import Count, Q
 from django.db import connection
 
 from tempfile import TemporaryDirectory
 from datetime import datetime, timedelta
+import json
 
 
-def create(grants):
-    """Creates data quality data for a set of grants
-    grants: grants json"""
+# Extra tests added to the default set of USEFULNESS TEST CLASS
+EXTRA_USEFULNESS_TESTS = [
+    check_field_present.ClassificationNotPresent,
+    check_field_present.BeneficiaryLocationNameNotPresent,
+    check_field_present.BeneficiaryLocationCountryCodeNotPresent,
+    check_field_present.BeneficiaryLocationGeoCodeNotPresent,
+    check_field_present.PlannedDurationNotPresent,
+    check_field_present.GrantProgrammeTitleNotPresent,
+    check_field_present.IndividualsCodeListsNotPresent,
+]
 
-    cove_results = {"file_type": "json"}
 
-    # Inject some extra tests to the default set of USEFULNESS TEST CLASS
+class QualityEngine(object):
+    """Creates data quality data for sets of grants, reusing the schema and
+    tests set up once for every set
 
-    TEST_CLASSES[USEFULNESS_TEST_CLASS] = TEST_CLASSES[USEFULNESS_TEST_CLASS] + [
-        check_field_present.ClassificationNotPresent,
-        check_field_present.BeneficiaryLocationNameNotPresent,
-        check_field_present.BeneficiaryLocationCountryCodeNotPresent,
-        check_field_present.BeneficiaryLocationGeoCodeNotPresent,
-        check_field_present.PlannedDurationNotPresent,
-        check_field_present.GrantProgrammeTitleNotPresent,
-        check_field_present.IndividualsCodeListsNotPresent,
-    ]
-
-    with TemporaryDirectory() as tempdir:
-        common_checks_360(
-            cove_results,
-            tempdir,
-            {"grants": grants},
-            Schema360(),
-            test_classes=[USEFULNESS_TEST_CLASS],
-        )
+    Example usage:
 
-    # We don't quite want the result as-is from cove/lib360dataquality
-    # our format is:
-    # {
-    #   "TestClassName": { "heading": "text", "count": n, "fail": false },
-    #   ...
-    # }
-    # We only get results when a quality test finds an issue, so to provide a count 0
-    # value we template out all the expected results with 0 from all the available tests.
-
-    quality_results = {}
-
-    # Create the template
-    for available_test in TEST_CLASSES[USEFULNESS_TEST_CLASS]:
-        quality_results[available_test.__name__] = {"count": 0, "fail": False}
-
-    # Initialise two new tests
-    # These will be derived from RecipientOrg360GPrefix
-    quality_results["RecipientOrgPrefixExternal"] = {"count": 0, "fail": False}
-    quality_results["RecipientOrgPrefix50pcExternal"] = {"count": 0, "fail": False}
-
-    # Update with a heading and count template.
-    for test in cove_results["usefulness_checks"]:
-        quality_results[test[0]["type"]] = {
-            "heading": test[0]["heading"],
-            # The number of grants that failed the check
-            "count": test[0]["count"],
-            # The % of the relevant grants that failed the check
-            "percentage": test[0]["percentage"],
-            # If all the grants fail a test then we mark as fail true
-            "fail": test[0]["percentage"] == 1.0,
-        }
+    engine = QualityEngine()
+    quality, aggregate = engine.create(grants)
+    """
 
-        if "RecipientOrg360GPrefix" in test[0]["type"]:
-            # This test tells us the number and % of grants which use a 360G-something prefix
-            # in the org-ids in the recipient organisation for a grant.
-            #
-            # We can use this test's data to fill in the data for the two new tests RecipientOrgPrefixExternal and RecipientOrgPrefix50pcExternal
-            # RecipientOrgPrefixExternal is  (number of grants) - (count of recipient orgs with a 360 prefix) - (recipient individual grants)
-            grants_recipient_ext_org = (
-                cove_results["grants_aggregates"]["count"]
-                - cove_results["grants_aggregates"]["recipient_individuals_count"]
-                - test[0]["count"]
+    def __init__(self):
+        # lib360dataquality looks the tests up by class name in TEST_CLASSES,
+        # so the extra tests are added there, once
+        TEST_CLASSES[USEFULNESS_TEST_CLASS] = [
+            test
+            for test in TEST_CLASSES[USEFULNESS_TEST_CLASS]
+            if test not in EXTRA_USEFULNESS_TESTS
+        ] + EXTRA_USEFULNESS_TESTS
+        self.usefulness_tests = TEST_CLASSES[USEFULNESS_TEST_CLASS]
+
+        self.schema = Schema360()
+
+    def create(self, grants):
+        """Creates data quality data for a set of grants
+        grants: grants json"""
+
+        cove_results = {"file_type": "json"}
+
+        # A new directory each time as cove caches its results in it
+        with TemporaryDirectory() as tempdir:
+            common_checks_360(
+                cove_results,
+                tempdir,
+                {"grants": grants},
+                self.schema,
+                test_classes=[USEFULNESS_TEST_CLASS],
             )
-            quality_results["RecipientOrgPrefixExternal"] = {
-                "count": grants_recipient_ext_org,
-                "percentage": grants_recipient_ext_org
-                / (
+
+        return self.format_results(cove_results, grants)
+
+    def format_results(self, cove_results, grants):
+        """Returns the quality results and aggregates from the cove results"""
+        # We don't quite want the result as-is from cove/lib360dataquality
+        # our format is:
+        # {
+        #   "TestClassName": { "heading": "text", "count": n, "fail": false },
+        #   ...
+        # }
+        # We only get results when a quality test finds an issue, so to provide a count 0
+        # value we template out all the expected results with 0 from all the available tests.
+
+        quality_results = {}
+
+        # Create the template
+        for available_test in self.usefulness_tests:
+            quality_results[available_test.__name__] = {"count": 0, "fail": False}
+
+        # Initialise two new tests
+        # These will be derived from RecipientOrg360GPrefix
+        quality_results["RecipientOrgPrefixExternal"] = {"count": 0, "fail": False}
+        quality_results["RecipientOrgPrefix50pcExternal"] = {"count": 0, "fail": False}
+
+        # Update with a heading and count template.
+        for test in cove_results["usefulness_checks"]:
+            quality_results[test[0]["type"]] = {
+                "heading": test[0]["heading"],
+                # The number of grants that failed the check
+                "count": test[0]["count"],
+                # The % of the relevant grants that failed the check
+                "percentage": test[0]["percentage"],
+                # If all the grants fail a test then we mark as fail true
+                "fail": test[0]["percentage"] == 1.0,
+            }
+
+            if "RecipientOrg360GPrefix" in test[0]["type"]:
+                # This test tells us the number and % of grants which use a 360G-something prefix
+                # in the org-ids in the recipient organisation for a grant.
+                #
+                # We can use this test's data to fill in the data for the two new tests RecipientOrgPrefixExternal and RecipientOrgPrefix50pcExternal
+                # RecipientOrgPrefixExternal is  (number of grants) - (count of recipient orgs with a 360 prefix) - (recipient individual grants)
+                grants_recipient_ext_org = (
                     cove_results["grants_aggregates"]["count"]
                     - cove_results["grants_aggregates"]["recipient_individuals_count"]
-                ),
-                "fail": grants_recipient_ext_org == 0,
-                "heading": "Recipient Orgs with external org identifier",
-            }
-            # Add test to see if more than 50% of the recipient org ids are external
-            quality_results["RecipientOrgPrefix50pcExternal"] = {
-                "fail": quality_results["RecipientOrgPrefixExternal"]["percentage"]
-                < 0.5,
-                "count": grants_recipient_ext_org / 2,
-                "percentage": quality_results["RecipientOrgPrefixExternal"][
-                    "percentage"
-                ],
-            }
+                    - test[0]["count"]
+                )
+                quality_results["RecipientOrgPrefixExternal"] = {
+                    "count": grants_recipient_ext_org,
+                    "percentage": grants_recipient_ext_org
+                    / (
+                        cove_results["grants_aggregates"]["count"]
+                        - cove_results["grants_aggregates"][
+                            "recipient_individuals_count"
+                        ]
+                    ),
+                    "fail": grants_recipient_ext_org == 0,
+                    "heading": "Recipient Orgs with external org identifier",
+                }
+                # Add test to see if more than 50% of the recipient org ids are external
+                quality_results["RecipientOrgPrefix50pcExternal"] = {
+                    "fail": quality_results["RecipientOrgPrefixExternal"]["percentage"]
+                    < 0.5,
+                    "count": grants_recipient_ext_org / 2,
+                    "percentage": quality_results["RecipientOrgPrefixExternal"][
+                        "percentage"
+                    ],
+                }
+
+        aggregates = {
+            "count": cove_results["grants_aggregates"]["count"],
+            "recipient_organisations": list(
+                cove_results["grants_aggregates"]["distinct_recipient_org_identifier"]
+            ),
+            "recipient_individuals": cove_results["grants_aggregates"][
+                "recipient_individuals_count"
+            ],
+            "funders": list(
+                cove_results["grants_aggregates"]["distinct_funding_org_identifier"]
+            ),
+            "max_award_date": cove_results["grants_aggregates"]["max_award_date"],
+            "min_award_date": cove_results["grants_aggregates"]["min_award_date"],
+            "currencies": cove_results["grants_aggregates"]["currencies"],
+            "award_years": cove_results["grants_aggregates"]["award_years"],
+        }
 
-    aggregates = {
-        "count": cove_results["grants_aggregates"]["count"],
-        "recipient_organisations": list(
-            cove_results["grants_aggregates"]["distinct_recipient_org_identifier"]
-        ),
-        "recipient_individuals": cove_results["grants_aggregates"][
-            "recipient_individuals_count"
-        ],
-        "funders": list(
-            cove_results["grants_aggregates"]["distinct_funding_org_identifier"]
-        ),
-        "max_award_date": cove_results["grants_aggregates"]["max_award_date"],
-        "min_award_date": cove_results["grants_aggregates"]["min_award_date"],
-        "currencies": cove_results["grants_aggregates"]["currencies"],
-        "award_years": cove_results["grants_aggregates"]["award_years"],
-    }
+        # Create a list of the org_id types e.g. COH with the count
+        # e.g. recipient_org_types: { "COH": 20, "ABC": 12 }
+        # TODO this could be added to dataquality if the aggregate mechanism were
+        # extensible.
 
-    # Create a list of the org_id types e.g. COH with the count
-    # e.g. recipient_org_types: { "COH": 20, "ABC": 12 }
-    # TODO this could be added to dataquality if the aggregate mechanism were
-    # extensible.
+        aggregates["recipient_org_types"] = {}
 
-    aggregates["recipient_org_types"] = {}
+        def extract_org_id_type(org_id):
+            # Ignore internal org ids
+            if org_id.lower().startswith("360g"):
+                return None
 
-    def extract_org_id_type(org_id):
-        # Ignore internal org ids
-        if org_id.lower().startswith("360g"):
-            return None
+            try:
+                return org_id.split("-")[1]
+            except IndexError:
+                return None
 
-        try:
-            return org_id.split("-")[1]
-        except IndexError:
-            return None
+        for grant in grants:
+            # skip if grant isn't for an organization
+            if not grant.get("recipientOrganization"):
+                continue
 
-    for grant in grants:
-        # skip if grant isn't for an organization
-        if not grant.get("recipientOrganization"):
-            continue
+            org_id_type = extract_org_id_type(grant["recipientOrganization"][0]["id"])
+            if org_id_type:
+                try:
+                    aggregates["recipient_org_types"][org_id_type] += 1
+                except KeyError:
+                    aggregates["recipient_org_types"][org_id_type] = 1
 
-        org_id_type = extract_org_id_type(grant["recipientOrganization"][0]["id"])
-        if org_id_type:
-            try:
-                aggregates["recipient_org_types"][org_id_type] += 1
-            except KeyError:
-                aggregates["recipient_org_types"][org_id_type] = 1
+        return quality_results, aggregates
+
+
+# The engine of this process, see create()
+_engine = None
+
+
+def create(grants):
+    """Creates data quality data for a set of grants using the QualityEngine
+    of this process
+    grants: grants json"""
+    global _engine
+    if _engine is None:
+        _engine = QualityEngine()
 
-    return quality_results, aggregates
+    return _engine.create(grants)
+
+
+def iso_datetime_sql(text_sql):
+    """Returns SQL for the text as a "YYYY-MM-DDTHH:MM:SS" string if it is an
+    ISO 8601 date or date and time, or NULL
+
+    These compare in date order with iso_datetime() strings without casting
+    the text, so one source file with a malformed date can't fail every
+    statistic computed alongside it.
+    """
+    return (
+        r"CASE WHEN %s ~ '^\d{4}-\d{2}-\d{2}([T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?)?"
+        r"(Z|[+-]\d{2}(:?\d{2})?)?$'"
+        " THEN replace(left(%s, 19), ' ', 'T') END COLLATE \"C\"" % (text_sql, text_sql)
+    )
+
+
+def iso_datetime(value):
+    return value.strftime("%Y-%m-%dT%H:%M:%S")
 
 
 class SourceFilesStats(object):
+    """Statistics of a set of source files, from their quality and aggregate
+    data
+
+    Most of the statistics are computed together by scan(), in one query that
+    groups the source files both as a whole and by publisher.
+    """
+
+    # The periods in days get_pc_publishers_awarding_in_last() and
+    # get_pc_publishers_publishing_in_last() can be used with
+    PERIODS = [366, 92]
+
+    RECIPIENT_EXT_ORG_RANGES = [
+        [0, 10],
+        [10, 20],
+        [20, 30],
+        [30, 40],
+        [40, 50],
+        [50, 60],
+        [60, 70],
+        [70, 80],
+        [90, 100],
+    ]
+
     def __init__(self, source_file_set):
         self.source_file_set = source_file_set
 
-        self.quality_query_parameters = {
-            "hasBeneficiaryLocationName": {
-                "quality__BeneficiaryLocationNameNotPresent__fail": False
-            },
-            "hasGrantDuration": {"quality__PlannedDurationNotPresent__fail": False},
-            "hasGrantProgrammeTitle": {
-                "quality__GrantProgrammeTitleNotPresent__fail": False
-            },
-            "hasGrantClassification": {
-                "quality__ClassificationNotPresent__fail": False
-            },
-            "hasBeneficiaryLocationGeoCode": {
-                "quality__BeneficiaryLocationGeoCodeNotPresent__fail": False
-            },
-            "hasRecipientOrgLocations": {
-                "quality__IncompleteRecipientOrg__fail": False
-            },
-            "hasRecipientOrgCompanyOrCharityNumber": {
-                "quality__NoRecipientOrgCompanyCharityNumber__fail": False
-            },
-            "has50pcExternalOrgId": {
-                "quality__RecipientOrgPrefix50pcExternal__fail": False
-            },
-            "hasRecipientIndividualsCodelists": {
-                "quality__IndividualsCodeListsNotPresent__fail": False
-            },
+        # The metrics and the quality test their source files must not fail
+        self.quality_tests = {
+            "hasBeneficiaryLocationName": "BeneficiaryLocationNameNotPresent",
+            "hasGrantDuration": "PlannedDurationNotPresent",
+            "hasGrantProgrammeTitle": "GrantProgrammeTitleNotPresent",
+            "hasGrantClassification": "ClassificationNotPresent",
+            "hasBeneficiaryLocationGeoCode": "BeneficiaryLocationGeoCodeNotPresent",
+            "hasRecipientOrgLocations": "IncompleteRecipientOrg",
+            "hasRecipientOrgCompanyOrCharityNumber": "NoRecipientOrgCompanyCharityNumber",
+            "has50pcExternalOrgId": "RecipientOrgPrefix50pcExternal",
+            "hasRecipientIndividualsCodelists": "IndividualsCodeListsNotPresent",
         }
 
         self.file_types = ["json", "csv", "xlsx", "ods"]
 
+        this_year_int = datetime.now().year
+        self.award_years = [str(this_year_int - i) for i in range(0, 10)]
+
+        self._totals = None
+        self._publishers = None
+        self._distinct_counts = None
+        self._latest_id = None
+
+    def scan_columns(self):
+        """Returns the (name, sql, params) of each of the columns of scan()"""
+        now = datetime.now()
+        columns = [
+            ("source_files", "count(*)", []),
+            ("grants", "sum((aggregate->>'count')::int)", []),
+            # Summed exactly so that the total doesn't depend on the order
+            (
+                "gbp",
+                "sum((aggregate->'currencies'->'GBP'->>'total_amount')::numeric)",
+                [],
+            ),
+            (
+                "recipient_individuals",
+                "sum((aggregate->>'recipient_individuals')::int)",
+                [],
+            ),
+        ]
+
+        for file_type in self.file_types:
+            columns.append(
+                (
+                    "%s_files" % file_type,
+                    "count(*) FILTER (WHERE "
+                    "data->'datagetter_metadata'->'file_type' @> %s::jsonb)",
+                    [json.dumps(file_type)],
+                )
+            )
+
+        for metric, test in self.quality_tests.items():
+            passed = "quality->%s->'fail' = 'false'::jsonb"
+            columns.append(
+                (
+                    "%s_grants" % metric,
+                    "sum((aggregate->>'count')::int) FILTER (WHERE %s)" % passed,
+                    [test],
+                )
+            )
+            columns.append(
+                ("%s_files" % metric, "count(*) FILTER (WHERE %s)" % passed, [test])
+            )
+
+        for delta in self.PERIODS:
+            data_delta = now - timedelta(days=delta)
+            columns.append(
+                (
+                    "awarded_%s" % delta,
+                    "count(*) FILTER (WHERE %s >= %%s)"
+                    % iso_datetime_sql("aggregate->>'max_award_date'"),
+                    [iso_datetime(data_delta)],
+                )
+            )
+            columns.append(
+                (
+                    "published_%s" % delta,
+                    "count(*) FILTER (WHERE %s >= %%s)"
+                    % iso_datetime_sql("data->>'modified'"),
+                    [iso_datetime(data_delta)],
+                )
+            )
+
+        for i, pc_range in enumerate(self.RECIPIENT_EXT_ORG_RANGES):
+            # This is incorrect as it is counting all in the file where we don't always have all orgs some are indi
+            columns.append(
+                (
+                    "recipient_ext_org_%s" % i,
+                    "count(*) FILTER (WHERE "
+                    "(quality->'RecipientOrgPrefixExternal'->>'count')::float"
+                    " / NULLIF((aggregate->>'count')::float, 0) * 100"
+                    " BETWEEN %s AND %s)",
+                    pc_range,
+                )
+            )
+
+        for year_str in self.award_years:
+            year_total = "(aggregate->'award_years'->>%s)::int"
+            columns.append(
+                ("award_year_%s" % year_str, "sum(%s)" % year_total, [year_str])
+            )
+            columns.append(
+                (
+                    "award_year_%s_files" % year_str,
+                    "count(*) FILTER (WHERE %s > 0)" % year_total,
+                    [year_str],
+                )
+            )
+
+        return columns
+
+    def scan(self):
+        """Computes the totals of the source files and, for each publisher, the
+        totals of their source files in one grouped query, the first time"""
+        if self._totals is not None:
+            return
+
+        columns = self.scan_columns()
+        source_files_sql, source_files_params = (
+            self.source_file_set.order_by().values("pk").query.sql_with_params()
+        )
+
+        params = []
+        for name, sql, column_params in columns:
+            params.extend(column_params)
+        params.extend(source_files_params)
+
+        # The empty grouping set gives the totals of all of the source files
+        query = """
+            SELECT GROUPING(data->'publisher'->'prefix'), {columns}
+            FROM db_sourcefile
+            WHERE id IN ({source_files})
+            GROUP BY GROUPING SETS ((), (data->'publisher'->'prefix'))
+        """.format(
+            columns=", ".join(sql for name, sql, column_params in columns),
+            source_files=source_files_sql,
+        )
+
+        self._publishers = []
+        with connection.cursor() as cursor:
+            cursor.execute(query, params)
+            for row in cursor.fetchall():
+                totals = dict(zip([name for name, sql, params in columns], row[1:]))
+                if row[0]:
+                    self._totals = totals
+                else:
+                    self._publishers.append(totals)
+
+    @property
+    def totals(self):
+        self.scan()
+        return self._totals
+
+    @property
+    def publishers(self):
+        self.scan()
+        return self._publishers
+
+    def get_pc_of_publishers(self, name):
+        """Returns the % of publishers with source files counted by the scan()
+        column"""
+        return (
+            len([publisher for publisher in self.publishers if publisher[name] > 0])
+            / self.get_total_publishers()
+            * 100
+        )
+
+    def get_latest_id(self):
+        if self._latest_id is None:
+            self._latest_id = db.Latest.objects.get(series=db.Latest.CURRENT).pk
+        return self._latest_id
+
     def count(self):
-        return self.source_file_set.count()
+        return self.totals["source_files"]
 
     def get_pc_total_file_types(self):
         """Returns the % of different file types"""
@@ -198,11 +427,7 @@ class SourceFilesStats(object):
 
         for file_type in self.file_types:
             ret["%sFiles" % file_type] = round(
-                self.source_file_set.filter(
-                    data__datagetter_metadata__file_type__contains=file_type
-                ).count()
-                / self.count()
-                * 100
+                self.totals["%s_files" % file_type] / self.count() * 100
             )
 
         return ret
@@ -213,32 +438,17 @@ class SourceFilesStats(object):
 
         for file_type in self.file_types:
             ret["%sFiles" % file_type] = round(
-                self.source_file_set.filter(
-                    data__datagetter_metadata__file_type__contains=file_type
-                )
-                .distinct("data__publisher__prefix")
-                .count()
-                / self.get_total_publishers()
-                * 100
+                self.get_pc_of_publishers("%s_files" % file_type)
             )
 
         return ret
 
     def get_total_grants(self):
-        return self.source_file_set.annotate(
-            total=RawSQL("((aggregate->>%s)::int)", ("count",))
-        ).aggregate(Sum("total"))["total__sum"]
+        return self.totals["grants"]
 
     def get_total_gbp(self):
         try:
-            total_gbp = float(
-                self.source_file_set.annotate(
-                    total=RawSQL(
-                        "((aggregate->'currencies'->'GBP'->>%s)::float)",
-                        ("total_amount",),
-                    )
-                ).aggregate(Sum("total"))["total__sum"]
-            )
+            total_gbp = float(self.totals["gbp"])
         except TypeError:
             # Happens if the source file has no GBP
             total_gbp = 0
@@ -246,72 +456,64 @@ class SourceFilesStats(object):
         return total_gbp
 
     def get_total_publishers(self):
-        return self.source_file_set.distinct("data__publisher__prefix").count()
+        return len(self.publishers)
+
+    def get_distinct_counts(self):
+        """Returns the number of distinct recipient organisations and funders in
+        one query, the first time"""
+        if self._distinct_counts is not None:
+            return self._distinct_counts
 
-    def get_total_recipient_organisations(self):
         # Determine if we're dealing with just one publisher and whether we need to limit
         # the source files to that publisher rather than all in 'latest'
-        if self.source_file_set.distinct("data__publisher__prefix").count() == 1:
-            source_file_ids = ",".join(
-                map(str, self.source_file_set.values_list("id", flat=True))
+        if self.get_total_publishers() == 1:
+            source_files_sql, params = (
+                self.source_file_set.order_by().values("pk").query.sql_with_params()
             )
-            query = f"""
-            SELECT DISTINCT(jsonb_array_elements(db_sourcefile.aggregate->'recipient_organisations'))
-            FROM db_sourcefile
-            WHERE db_sourcefile.id IN ({source_file_ids})
-            """
+            where = "db_sourcefile.id IN (%s)" % source_files_sql
         else:
-            latest_id = db.Latest.objects.get(series=db.Latest.CURRENT).pk
-            query = f"""
-            SELECT DISTINCT(jsonb_array_elements(db_sourcefile.aggregate->'recipient_organisations'))
-            FROM db_sourcefile
-            INNER JOIN db_sourcefile_latest on db_sourcefile.id=db_sourcefile_latest.sourcefile_id
-            WHERE db_sourcefile_latest.latest_id={latest_id}
-            """
+            where = (
+                "db_sourcefile.id IN (SELECT sourcefile_id FROM db_sourcefile_latest"
+                " WHERE latest_id = %s)"
+            )
+            params = (self.get_latest_id(),)
+
+        query = """
+            SELECT
+                (SELECT count(DISTINCT recipient_organisation)
+                FROM db_sourcefile,
+                    jsonb_array_elements(db_sourcefile.aggregate->'recipient_organisations')
+                    AS recipient_organisation
+                WHERE {where}),
+                (SELECT count(DISTINCT funder)
+                FROM db_sourcefile,
+                    jsonb_array_elements(db_sourcefile.aggregate->'funders') AS funder
+                WHERE {where})
+        """.format(
+            where=where
+        )
 
         with connection.cursor() as cursor:
-            cursor.execute(query)
-            total = len(cursor.fetchall())
+            cursor.execute(query, list(params) * 2)
+            recipient_organisations, funders = cursor.fetchone()
 
-        if not total:
-            return 0
+        self._distinct_counts = {
+            "recipient_organisations": recipient_organisations,
+            "funders": funders,
+        }
+        return self._distinct_counts
 
-        return total
+    def get_total_recipient_organisations(self):
+        return self.get_distinct_counts()["recipient_organisations"]
 
     def get_total_recipient_individuals(self):
-        ret = self.source_file_set.annotate(
-            total=RawSQL("((aggregate->>%s)::int)", ("recipient_individuals",))
-        ).aggregate(Sum("total"))["total__sum"]
+        ret = self.totals["recipient_individuals"]
         if not ret:
             return 0
         return ret
 
     def get_total_funders(self):
-        # Determine if we're dealing with just one publisher and whether we need to limit
-        # the source files to that publisher rather than all in 'latest'
-        if self.source_file_set.distinct("data__publisher__prefix").count() == 1:
-            source_file_ids = ",".join(
-                map(str, self.source_file_set.values_list("id", flat=True))
-            )
-            query = f"""
-            SELECT DISTINCT(jsonb_array_elements(db_sourcefile.aggregate->'funders'))
-            FROM db_sourcefile
-            WHERE db_sourcefile.id IN ({source_file_ids})
-            """
-        else:
-            latest_id = db.Latest.objects.get(series=db.Latest.CURRENT).pk
-            query = f"""
-            SELECT DISTINCT(jsonb_array_elements(db_sourcefile.aggregate->'funders'))
-            FROM db_sourcefile
-            INNER JOIN db_sourcefile_latest on db_sourcefile.id=db_sourcefile_latest.sourcefile_id
-            WHERE db_sourcefile_latest.latest_id={latest_id}
-            """
-
-        with connection.cursor() as cursor:
-            cursor.execute(query)
-            total = len(cursor.fetchall())
-
-        return total
+        return self.get_distinct_counts()["funders"]
 
     def get_pc_quality_grants(self):
         ret = {}
@@ -320,13 +522,9 @@ class SourceFilesStats(object):
             total_grants - self.get_total_recipient_individuals()
         )
 
-        for metric, query in self.quality_query_parameters.items():
+        for metric in self.quality_tests:
             # Aggregate total number of errors for the metric
-            ret[metric] = (
-                self.source_file_set.filter(**query)
-                .annotate(total=RawSQL("((aggregate->>%s)::int)", ("count",)))
-                .aggregate(Sum("total"))["total__sum"]
-            )
+            ret[metric] = self.totals["%s_grants" % metric]
 
             if ret[metric] == None:
                 ret[metric] = 0
@@ -344,7 +542,7 @@ class SourceFilesStats(object):
         has_grants_to_individuals = self.get_total_recipient_individuals() > 0
         has_grants_to_orgs = self.get_total_recipient_organisations() > 0
 
-        for metric, query in self.quality_query_parameters.items():
+        for metric in self.quality_tests:
             # If the metric we're looking at is for individuals but we have
             # no grants to individuals skip
             if (
@@ -363,7 +561,7 @@ class SourceFilesStats(object):
                 continue
 
             # For compatibility badge value 100 = True , 0 = False
-            ret[metric] = 100 if self.source_file_set.filter(**query).count() > 0 else 0
+            ret[metric] = 100 if self.totals["%s_files" % metric] > 0 else 0
 
         return ret
 
@@ -372,19 +570,22 @@ class SourceFilesStats(object):
 
         publishers = db.Publisher.objects.filter(getter_run=db.GetterRun.latest())
 
-        total_publishers_all = publishers.count()
-
-        total_org_recp_publishers = publishers.filter(
-            aggregate__total__recipientOrganisations__gt=0
-        ).count()
-        total_indv_recp_publishers = publishers.filter(
-            aggregate__total__recipientIndividuals__gt=0
-        ).count()
-
-        for metric, query in self.quality_query_parameters.items():
-            publisher_query = {f"quality__{metric}": 100}
+        counts = publishers.aggregate(
+            total_publishers_all=Count("pk"),
+            total_org_recp_publishers=Count(
+                "pk", filter=Q(aggregate__total__recipientOrganisations__gt=0)
+            ),
+            total_indv_recp_publishers=Count(
+                "pk", filter=Q(aggregate__total__recipientIndividuals__gt=0)
+            ),
+            **{
+                metric: Count("pk", filter=Q(**{f"quality__{metric}": 100}))
+                for metric in self.quality_tests
+            },
+        )
 
-            total_publishers = total_publishers_all
+        for metric in self.quality_tests:
+            total_publishers = counts["total_publishers_all"]
 
             # If this is an org metric exclude publishers
             if (
@@ -392,92 +593,38 @@ class SourceFilesStats(object):
                 or metric == "hasRecipientOrgCompanyOrCharityNumber"
                 or metric == "has50pcExternalOrgId"
             ):
-                total_publishers = total_org_recp_publishers
+                total_publishers = counts["total_org_recp_publishers"]
             elif metric == "hasRecipientIndividualsCodelists":
-                total_publishers = total_indv_recp_publishers
+                total_publishers = counts["total_indv_recp_publishers"]
 
             if total_publishers == 0:
                 total_publishers = 1
 
-            ret[metric] = round(
-                publishers.filter(**publisher_query).count() / total_publishers * 100
-            )
+            ret[metric] = round(counts[metric] / total_publishers * 100)
 
         return ret
 
     def get_pc_publishers_awarding_in_last(self, delta):
-        data_delta = datetime.now() - timedelta(days=delta)
-        return round(
-            self.source_file_set.annotate(
-                modified=RawSQL("(aggregate->>'max_award_date')::timestamp", [])
-            )
-            .filter(modified__gte=data_delta)
-            .distinct("data__publisher__prefix")
-            .count()
-            / self.get_total_publishers()
-            * 100
-        )
+        return round(self.get_pc_of_publishers("awarded_%s" % delta))
 
     def get_pc_publishers_publishing_in_last(self, delta):
-        data_delta = datetime.now() - timedelta(days=delta)
-        return round(
-            self.source_file_set.annotate(
-                modified=RawSQL("(data->>'modified')::timestamp", [])
-            )
-            .filter(modified__gte=data_delta)
-            .distinct("data__publisher__prefix")
-            .count()
-            / self.get_total_publishers()
-            * 100
-        )
+        return round(self.get_pc_of_publishers("published_%s" % delta))
 
     def get_pc_publishers_with_recipient_ext_org(self):
-
         ret = {}
-        total_publishers = self.get_total_publishers()
-
-        ranges = [
-            [0, 10],
-            [10, 20],
-            [20, 30],
-            [30, 40],
-            [40, 50],
-            [50, 60],
-            [60, 70],
-            [70, 80],
-            [90, 100],
-        ]
 
-        # This is incorrect as it is counting all in the file where we don't always have all orgs some are indi
-        query = self.source_file_set.annotate(
-            pc=RawSQL(
-                "(quality->'RecipientOrgPrefixExternal'->>'count')::float / (aggregate->>'count')::float * 100",
-                [],
-            ),
-        )
-
-        for range in ranges:
-            ret["{}% - {}%".format(*range)] = (
-                query.filter(pc__range=(range[0], range[1]))
-                .distinct("data__publisher__prefix")
-                .count()
-                / total_publishers
-                * 100
+        for i, pc_range in enumerate(self.RECIPIENT_EXT_ORG_RANGES):
+            ret["{}% - {}%".format(*pc_range)] = self.get_pc_of_publishers(
+                "recipient_ext_org_%s" % i
             )
 
         return ret
 
     def get_total_grants_awarded_in_last_ten_years(self):
-
-        this_year_int = datetime.now().year
         award_years = {}
 
-        for i in range(0, 10):
-            year_str = str(this_year_int - i)
-
-            award_years[year_str] = self.source_file_set.annotate(
-                year_total=RawSQL("((aggregate->'award_years'->>%s)::int)", (year_str,))
-            ).aggregate(Sum("year_total"))["year_total__sum"]
+        for year_str in self.award_years:
+            award_years[year_str] = self.totals["award_year_%s" % year_str]
 
             if award_years[year_str] == None:
                 award_years[year_str] = 0
@@ -485,33 +632,17 @@ class SourceFilesStats(object):
         return award_years
 
     def get_pc_publishers_with_grants_awarded_in_last_ten_years(self):
-
-        this_year_int = datetime.now().year
         award_years = {}
 
-        for i in range(0, 10):
-            year_str = str(this_year_int - i)
-
+        for year_str in self.award_years:
             award_years[year_str] = round(
-                self.source_file_set.annotate(
-                    year_total=RawSQL(
-                        "((aggregate->'award_years'->>%s)::int)", (year_str,)
-                    )
-                )
-                .filter(year_total__gt=0)
-                .distinct("data__publisher__prefix")
-                .count()
-                / self.get_total_publishers()
-                * 100
+                self.get_pc_of_publishers("award_year_%s_files" % year_str)
             )
 
-            if award_years[year_str] == None:
-                award_years[year_str] = 0
-
         return award_years
 
     def get_grant_org_id_types_used(self):
-        latest_id = db.Latest.objects.get(series=db.Latest.CURRENT).pk
+        latest_id = self.get_latest_id()
 
         # Django ORM doesn't allow raw sql if you don't SELECT an id field and as
         # we want to do an aggregate fall back to fully raw sql
@@ -0,0 +1,163 @@
+import io
+import json
+
+from django.contrib.postgres.fields import ArrayField
+from django.db import connection
+from django.db.models import JSONField
+
+import db.models as db
+
+
+def escape_copy_text(value):
+    """Escape a value for the PostgreSQL COPY text format"""
+    return (
+        value.replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def array_literal(values):
+    """Returns the PostgreSQL array literal for a list of strings"""
+    return "{%s}" % ",".join(
+        '"%s"' % str(value).replace("\\", "\\\\").replace('"', '\\"')
+        for value in values
+    )
+
+
+class CopyLoader(object):
+    """Writes rows into a model's table using COPY ... FROM STDIN
+
+    Rows are encoded to the COPY text format as they are added and buffered
+    until flush() is called, or the buffer reaches batch_size rows. This avoids
+    constructing model instances and binding SQL parameters for bulk loads.
+
+    model: The model the rows are for, used to find the columns and how to encode them.
+    fields: The names of the model fields in the order the row values will be given.
+    table: Optional table to load into instead of the model's table.
+    """
+
+    def __init__(self, model, fields, table=None, batch_size=None):
+        self.fields = [model._meta.get_field(name) for name in fields]
+        self.table = table if table else model._meta.db_table
+        self.batch_size = batch_size
+        self.rows_added = 0
+
+        self._buffer = io.StringIO()
+        self._buffered_rows = 0
+
+    def copy_sql(self):
+        return "COPY %s (%s) FROM STDIN" % (
+            connection.ops.quote_name(self.table),
+            ", ".join(connection.ops.quote_name(field.column) for field in self.fields),
+        )
+
+    def encode_value(self, field, value):
+        if value is None:
+            return "\\N"
+
+        if isinstance(field, JSONField):
+            value = json.dumps(value)
+        elif isinstance(field, ArrayField):
+            value = array_literal(value)
+        elif isinstance(value, bool):
+            value = "t" if value else "f"
+        else:
+            value = str(value)
+
+        return escape_copy_text(value)
+
+    def encode_row(self, values):
+        """Returns the COPY text format line for the row values"""
+        return "%s\n" % "\t".join(
+            self.encode_value(field, value) for field, value in zip(self.fields, values)
+        )
+
+    def add(self, values):
+        self._buffer.write(self.encode_row(values))
+        self._buffered_rows += 1
+
+        if self.batch_size and self._buffered_rows >= self.batch_size:
+            self.flush()
+
+    def copy_from(self, fp):
+        """COPY the already encoded rows in the file-like object fp into the table"""
+        with connection.cursor() as cursor:
+            cursor.copy_expert(self.copy_sql(), fp)
+
+    def flush(self):
+        if not self._buffered_rows:
+            return
+
+        self._buffer.seek(0)
+        self.copy_from(self._buffer)
+        self.rows_added += self._buffered_rows
+
+        self._buffer = io.StringIO()
+        self._buffered_rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+
+class GrantCopyLoader(CopyLoader):
+    """Loads the grants of a SourceFile into db_grant using COPY
+
+    The denormalised convenience fields are computed from the grant data as
+    the rows are written.
+    """
+
+    FIELDS = [
+        "grant_id",
+        "data",
+        "getter_run",
+        "publisher",
+        "source_file",
+        "additional_data",
+        "additional_data_keys",
+        "publisher_org_id",
+        "recipient_org_ids",
+        "funding_org_ids",
+    ]
+
+    def __init__(
+        self, getter_run_id, publisher_id, publisher_org_id, source_file_id, **kwargs
+    ):
+        super().__init__(db.Grant, self.FIELDS, **kwargs)
+
+        self.getter_run_id = getter_run_id
+        self.publisher_id = publisher_id
+        self.publisher_org_id = publisher_org_id
+        self.source_file_id = source_file_id
+
+    def grant_row(self, data, additional_data, additional_data_keys=None):
+        convenience_fields = db.Grant.convenience_fields_from_data(
+            data, self.publisher_org_id
+        )
+
+        return [
+            data["id"],
+            data,
+            self.getter_run_id,
+            self.publisher_id,
+            self.source_file_id,
+            additional_data,
+            additional_data_keys,
+            convenience_fields["publisher_org_id"],
+            convenience_fields["recipient_org_ids"],
+            convenience_fields["funding_org_ids"],
+        ]
+
+    def encode_grant(self, data, additional_data, additional_data_keys=None):
+        """Returns the COPY text format line for the grant"""
+        return self.encode_row(
+            self.grant_row(data, additional_data, additional_data_keys)
+        )
+
+    def add_grant(self, data, additional_data, additional_data_keys=None):
+        self.add(self.grant_row(data, additional_data, additional_data_keys))
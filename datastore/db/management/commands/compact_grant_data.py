@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+import db.models as db
+from db.management.commands.load_datagetter_data import batched
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves the grant data of SourceFiles that aren't in use by any Latest into"
+        " shared GrantBlobs and deletes GrantBlobs that are no longer referenced"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            action="store",
+            dest="batch_size",
+            help="The number of source files to compact in each transaction",
+            default=100,
+        )
+
+    def handle(self, *args, **options):
+        source_files = db.SourceFile.objects.filter(
+            latest__isnull=True, getter_run__archived=False
+        )
+
+        # The GetterRuns loaded since the last Latest.update are about to be
+        # used, compacting them would only have it hydrate them again
+        current = db.Latest.objects.filter(series=db.Latest.CURRENT).first()
+        if current:
+            source_files = source_files.filter(getter_run__datetime__lt=current.updated)
+        else:
+            source_files = source_files.none()
+
+        grants_compacted = 0
+
+        for pks in batched(
+            list(source_files.order_by("pk").values_list("pk", flat=True)),
+            options["batch_size"],
+        ):
+            with transaction.atomic():
+                grants_compacted = grants_compacted + db.GrantBlob.compact(
+                    db.SourceFile.objects.filter(pk__in=pks)
+                )
+
+        print("Compacted %s grants" % grants_compacted, file=self.stdout)
+
+        blobs_deleted = db.GrantBlob.delete_unused()
+        print("Deleted %s unused grant blobs" % blobs_deleted, file=self.stdout)
@@ -3,6 +3,7 @@ import os
 
 from django.core.management.base import BaseCommand
 
+from additional_data.location_refs import LocationResolver
 from db.management.spinner import Spinner
 from db.models import Latest
 
@@ -62,6 +63,9 @@ class Command(BaseCommand):
         with open(recipients_file, "w") as recipients_fp:
             create_orgs_list("recipient", recipients_fp)
 
+        # Puts the area and postcode data in place of any references to them
+        location_resolver = LocationResolver()
+
         def flatten_grant(in_grant):
             """Add the additional_data inside grant object"""
             out_grant = {}
@@ -88,6 +92,9 @@ class Command(BaseCommand):
                 grants_list = list(
                     source.grant_set.all().values("data", "additional_data")
                 )
+                location_resolver.resolve_many(
+                    [grant["additional_data"] for grant in grants_list]
+                )
 
                 grants_list_flattened = map(flatten_grant, grants_list)
 
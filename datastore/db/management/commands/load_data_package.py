@@ -1,6 +1,5 @@
-import copy
-
 import db.models as db
+from additional_data.generator import AdditionalDataGenerator
 
 from db.management.commands.load_datagetter_data import (
     Command as LoadDatagetterDataCommand,
@@ -17,7 +16,16 @@ class Command(LoadDatagetterDataCommand):
           * This separates the data by treating it like a new GetterRun
     """
 
+    def create_additional_data(self, grant):
+        """The additional_data is already in the grant data from the data package"""
+        return grant.pop("additional_data")
+
+    def create_additional_data_batch(self, grants):
+        return [self.create_additional_data(grant) for grant in grants]
+
     def load_data(self):
+        # Only used to find the lookup keys of the additional data and normalise it
+        self.additional_data_generator = AdditionalDataGenerator()
         grants_added = 0
         dataset = self.load_dataset_data()
 
@@ -36,25 +44,8 @@ class Command(LoadDatagetterDataCommand):
 
             source_file = db.SourceFile.objects.create(data=ob, getter_run=getter_run)
 
-            grant_data = self.load_grant_data(ob["datagetter_metadata"]["json"])
-
-            grant_bulk_insert = []
-
-            for grant in grant_data["grants"]:
-                additional_data = copy.deepcopy(grant["additional_data"])
-                del grant["additional_data"]
-
-                grant_bulk_insert.append(
-                    db.Grant.from_data(
-                        source_file=source_file,
-                        publisher=publisher,
-                        data=grant,
-                        additional_data=additional_data,
-                        getter_run=getter_run,
-                    )
-                )
-
-            db.Grant.objects.bulk_create(grant_bulk_insert)
-            grants_added = grants_added + len(grant_data["grants"])
+            grants_added = grants_added + self.load_source_file_grants(
+                ob["datagetter_metadata"]["json"], getter_run, publisher, source_file
+            )
 
         return grants_added
@@ -1,14 +1,117 @@
+import functools
+import hashlib
+import io
 import json
 import os
-from django.db import transaction
+import tempfile
+
+import ijson
+from django.db import connection, transaction
 from django.core.management import call_command
 from django.core.management.base import BaseCommand, CommandError
 from django.core.cache import cache
 
 import db.models as db
 from additional_data.generator import AdditionalDataGenerator
+from additional_data.snapshot import LookupSnapshot
+from db.copy_loader import CopyLoader, GrantCopyLoader
+from db.management import parallel
 from db.management.spinner import Spinner
 
+# Errors that cause a source file to be skipped rather than failing the load
+SKIP_SOURCE_FILE_ERRORS = (
+    FileNotFoundError,
+    KeyError,
+    TypeError,
+    ijson.JSONError,
+)
+
+# The Command instance of each worker process, kept between jobs so that the
+# additional data sources' caches are reused
+_worker_commands = {}
+
+
+def batched(iterable, size):
+    """Yield lists of up to size items from the iterable"""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def file_hash(path):
+    """Returns the sha256 hex digest of the file at path"""
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def spool_source_file_grants(command_class, options, spool_dir, snapshot_dir, job):
+    """Process pool worker that parses and generates the additional data for
+    the grants of a source file, writing them to a file in spool_dir in the
+    COPY text format. Returns a dict describing the result for the parent.
+
+    The additional data sources look things up in the LookupSnapshot in
+    snapshot_dir, which all the workers share."""
+
+    command = _worker_commands.get(command_class)
+    if not command:
+        command = command_class()
+        command.additional_data_generator = AdditionalDataGenerator(
+            snapshot=LookupSnapshot(snapshot_dir)
+        )
+        _worker_commands[command_class] = command
+
+    command.options = options
+    command.stdout = io.StringIO()
+    command.stderr = io.StringIO()
+
+    loader = GrantCopyLoader(
+        getter_run_id=job["getter_run_id"],
+        publisher_id=job["publisher_id"],
+        publisher_org_id=job["publisher_org_id"],
+        source_file_id=job["source_file_id"],
+    )
+
+    result = {
+        "source_file_id": job["source_file_id"],
+        "spool_path": os.path.join(spool_dir, "%s.copy" % job["source_file_id"]),
+        "grants": 0,
+        "error": None,
+    }
+
+    try:
+        with open(result["spool_path"], "w", encoding="utf-8") as spool:
+            for grants in batched(
+                command.iter_grant_data(job["path"]), options["batch_size"]
+            ):
+                for grant, additional_data in zip(
+                    grants, command.create_additional_data_batch(grants)
+                ):
+                    lookup_keys = command.create_lookup_keys(grant, additional_data)
+                    spool.write(
+                        loader.encode_grant(
+                            grant,
+                            command.normalise_additional_data(grant, additional_data),
+                            lookup_keys,
+                        )
+                    )
+
+                result["grants"] = result["grants"] + len(grants)
+    except SKIP_SOURCE_FILE_ERRORS as e:
+        result["error"] = str(e)
+
+    result["stdout"] = command.stdout.getvalue()
+    result["stderr"] = command.stderr.getvalue()
+
+    return result
+
 
 class Command(BaseCommand):
     help = "Loads data that has been downloaded and processed by the datagetter"
@@ -29,6 +132,36 @@ class Command(BaseCommand):
             default=False,
         )
 
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            action="store",
+            dest="batch_size",
+            help="The number of grants to parse and insert at a time",
+            default=5000,
+        )
+
+        parser.add_argument(
+            "--reuse-unchanged",
+            action="store_true",
+            dest="reuse_unchanged",
+            help=(
+                "Copy the grants of source files that are unchanged since a previous"
+                " run instead of processing them again. Note the additional data is"
+                " copied as well so won't reflect any changes to its sources"
+            ),
+            default=False,
+        )
+
+        parser.add_argument(
+            "--parallel",
+            type=int,
+            action="store",
+            dest="parallel",
+            help="Load the source files using this number of worker processes",
+            default=0,
+        )
+
     def check_dir_looks_right(self):
         """Quickly check if the supplied dir looks correct"""
         ls = os.listdir(self.options["data_dir"][0])
@@ -45,76 +178,333 @@ class Command(BaseCommand):
         with open(path, encoding="utf-8") as f:
             return json.loads(f.read())
 
-    def load_grant_data(self, path):
-        """return the grant json for the given path"""
+    def source_file_path(self, path):
+        """As we want to use the path given by option to the command
+        reconstruct the file path with this value"""
+        filename = os.path.split(path)[-1]
+        return os.path.join(self.options["data_dir"][0], "json_all", filename)
+
+    def iter_grant_data(self, path):
+        """Yields the grants in the grant json for the given path one at a time
 
-        # As we want to use the path given by option to the command
-        # reconstruct the file path with this value
+        The file is parsed incrementally so that only the grant currently
+        being yielded needs to be in memory.
+        """
 
         filename = os.path.split(path)[-1]
         print("Loading %s" % filename, file=self.stdout)
 
-        new_path = os.path.join(self.options["data_dir"][0], "json_all", filename)
+        new_path = self.source_file_path(path)
 
         try:
-            with open(new_path, encoding="utf-8") as f:
-                return json.loads(f.read())
+            f = open(new_path, "rb")
         except FileNotFoundError as e:
             if self.options["skip_missing"]:
-                return {"grants": []}
+                return
             else:
                 raise e
 
-    def load_data(self):
-        grant_additional_data_generator = AdditionalDataGenerator()
-        grants_added = 0
-        dataset = self.load_dataset_data()
+        with f:
+            grants_count = 0
+            for grant in ijson.items(f, "grants.item", use_float=True):
+                grants_count = grants_count + 1
+                yield grant
+
+            # Check that a file without any grants isn't missing the grants
+            # altogether, which is an error like any other broken file
+            if not grants_count:
+                f.seek(0)
+                if not any(
+                    prefix == "" and event == "map_key" and value == "grants"
+                    for prefix, event, value in ijson.parse(f)
+                ):
+                    raise KeyError("grants")
+
+    def create_additional_data(self, grant):
+        """Returns the additional_data for the grant"""
+        try:
+            return self.additional_data_generator.create(grant)
+        except Exception as e:
+            print(
+                "Generating additional for grant %s failed %s" % (grant["id"], e),
+                file=self.stderr,
+            )
+            return None
 
-        getter_run = db.GetterRun.objects.create()
+    def create_additional_data_batch(self, grants):
+        """Returns the additional_data for each of the grants
+
+        If generating it for the batch fails it is generated a grant at a time
+        so that only the problem grants are affected.
+        """
+        try:
+            # A failed query would otherwise abort the whole load's transaction
+            with transaction.atomic():
+                return self.additional_data_generator.create_many(grants)
+        except Exception:
+            return [self.create_additional_data(grant) for grant in grants]
+
+    def create_lookup_keys(self, grant, additional_data):
+        """Returns the lookup keys of the grant's additional_data"""
+        if additional_data is None:
+            return None
+
+        try:
+            return self.additional_data_generator.lookup_keys(grant, additional_data)
+        except Exception as e:
+            print(
+                "Finding the lookup keys for grant %s failed %s" % (grant["id"], e),
+                file=self.stderr,
+            )
+            return None
+
+    def normalise_additional_data(self, grant, additional_data):
+        """Returns the grant's additional_data to store, after finding its
+        lookup keys, see AdditionalDataGenerator.normalise()"""
+        return self.additional_data_generator.normalise(grant, additional_data)
+
+    def load_source_file_grants(self, path, getter_run, publisher, source_file):
+        """Inserts the grants from the grant json at path using COPY in fixed
+        size batches returns the number of grants added"""
+        loader = GrantCopyLoader(
+            getter_run_id=getter_run.pk,
+            publisher_id=publisher.pk,
+            publisher_org_id=publisher.org_id,
+            source_file_id=source_file.pk,
+        )
+
+        for grants in batched(self.iter_grant_data(path), self.options["batch_size"]):
+            for grant, additional_data in zip(
+                grants, self.create_additional_data_batch(grants)
+            ):
+                lookup_keys = self.create_lookup_keys(grant, additional_data)
+                loader.add_grant(
+                    grant,
+                    self.normalise_additional_data(grant, additional_data),
+                    lookup_keys,
+                )
+
+            loader.flush()
+
+        return loader.rows_added
+
+    def create_source_file(self, getter_run, ob):
+        """Creates the Publisher and SourceFile for an item of the dataset"""
+        prefix = ob["publisher"]["prefix"]
+        publisher, c = db.Publisher.objects.get_or_create(
+            getter_run=getter_run,
+            prefix=prefix,
+            data=ob["publisher"],
+            org_id=ob["publisher"].get("org_id", "unknown"),
+            name=ob["publisher"]["name"],
+            source=db.Entity.PUBLISHER,
+        )
+
+        try:
+            content_hash = file_hash(
+                self.source_file_path(ob["datagetter_metadata"]["json"])
+            )
+        except (FileNotFoundError, KeyError, TypeError):
+            content_hash = None
+
+        source_file = db.SourceFile.objects.create(
+            data=ob, getter_run=getter_run, content_hash=content_hash
+        )
+
+        return publisher, source_file
+
+    def reuse_source_file_grants(self, getter_run, publisher, source_file):
+        """Copies the grants of the most recent previous SourceFile with the
+        same identifier and content, if there is one, into this source file.
+        Returns the number of grants copied or None if nothing could be reused.
+        """
+        identifier = source_file.data.get("identifier")
+
+        if not source_file.content_hash or not identifier:
+            return None
+
+        previous_source_files = (
+            db.SourceFile.objects.filter(
+                data__identifier=identifier,
+                content_hash=source_file.content_hash,
+                getter_run__archived=False,
+            )
+            .exclude(getter_run=getter_run)
+            .order_by("-getter_run__datetime")
+        )
+
+        for previous_source_file in previous_source_files:
+            # The grants may have been deleted
+            if not previous_source_file.grant_set.exists():
+                continue
 
-        for ob in dataset:
-            prefix = ob["publisher"]["prefix"]
-            publisher, c = db.Publisher.objects.get_or_create(
-                getter_run=getter_run,
-                prefix=prefix,
-                data=ob["publisher"],
-                org_id=ob["publisher"].get("org_id", "unknown"),
-                name=ob["publisher"]["name"],
-                source=db.Entity.PUBLISHER,
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """
+                    INSERT INTO db_grant (
+                        grant_id, data, getter_run_id, publisher_id, source_file_id,
+                        additional_data, additional_data_keys, publisher_org_id,
+                        recipient_org_ids, funding_org_ids
+                    )
+                    SELECT
+                        grant_id,
+                        COALESCE(db_grant.data, db_grantblob.data),
+                        %s, %s, %s,
+                        CASE WHEN blob_id IS NULL
+                            THEN db_grant.additional_data
+                            ELSE db_grantblob.additional_data
+                        END,
+                        additional_data_keys,
+                        %s, recipient_org_ids, funding_org_ids
+                    FROM db_grant
+                    LEFT JOIN db_grantblob ON db_grantblob.hash = db_grant.blob_id
+                    WHERE db_grant.getter_run_id = %s AND source_file_id = %s
+                    """,
+                    [
+                        getter_run.pk,
+                        publisher.pk,
+                        source_file.pk,
+                        publisher.org_id,
+                        previous_source_file.getter_run_id,
+                        previous_source_file.pk,
+                    ],
+                )
+                grants_copied = cursor.rowcount
+
+            print(
+                "Reusing %s unchanged grants of %s from GetterRun %s"
+                % (
+                    grants_copied,
+                    identifier,
+                    previous_source_file.getter_run_id,
+                ),
+                file=self.stdout,
             )
+            return grants_copied
+
+        return None
 
-            source_file = db.SourceFile.objects.create(data=ob, getter_run=getter_run)
+    def load_source_files_parallel(self, getter_run, source_files):
+        """Loads the grants of the source files using a pool of worker processes
 
+        The workers parse the grant data and generate the additional data,
+        writing the rows to spool files which are then inserted using COPY in
+        this process. This keeps all the inserts within our transaction so
+        nothing from the GetterRun is visible unless the whole load succeeds.
+        """
+        grants_added = 0
+        jobs = []
+
+        for ob, publisher, source_file in source_files:
             try:
-                grant_data = self.load_grant_data(ob["datagetter_metadata"]["json"])
+                path = ob["datagetter_metadata"]["json"]
+                size = os.path.getsize(self.source_file_path(path))
+            except KeyError as e:
+                print("Skipping loading due to: '%s'" % e, file=self.stdout)
+                continue
+            except (FileNotFoundError, TypeError):
+                # Leave the worker to report it
+                size = 0
+
+            jobs.append(
+                {
+                    "path": path,
+                    "size": size,
+                    "getter_run_id": getter_run.pk,
+                    "publisher_id": publisher.pk,
+                    "publisher_org_id": publisher.org_id,
+                    "source_file_id": source_file.pk,
+                }
+            )
+
+        # Start the largest files first so that they don't hold up the end of the run
+        jobs.sort(key=lambda job: job["size"], reverse=True)
+
+        options = {
+            "data_dir": self.options["data_dir"],
+            "skip_missing": self.options["skip_missing"],
+            "batch_size": self.options["batch_size"],
+        }
+
+        loader = CopyLoader(db.Grant, GrantCopyLoader.FIELDS)
+
+        with tempfile.TemporaryDirectory() as spool_dir, tempfile.TemporaryDirectory() as snapshot_dir:
+            print(
+                "Lookup snapshot: %s" % LookupSnapshot.build(snapshot_dir),
+                file=self.stdout,
+            )
+
+            with parallel.Pool(self.options["parallel"]) as pool:
+                worker = functools.partial(
+                    spool_source_file_grants,
+                    type(self),
+                    options,
+                    spool_dir,
+                    snapshot_dir,
+                )
 
-                grant_bulk_insert = []
+                for result in pool.imap_unordered(worker, jobs):
+                    self.stdout.write(result["stdout"], ending="")
+                    self.stderr.write(result["stderr"], ending="")
 
-                for grant in grant_data["grants"]:
-                    try:
-                        additional_data = grant_additional_data_generator.create(grant)
-                    except Exception as e:
+                    if result["error"] is None:
+                        with open(result["spool_path"], encoding="utf-8") as spool:
+                            loader.copy_from(spool)
+
+                        grants_added = grants_added + result["grants"]
+                    else:
                         print(
-                            "Generating additional for grant %s failed %s"
-                            % (grant["id"], e),
-                            file=self.stderr,
-                        )
-                        additional_data = None
-
-                    grant_bulk_insert.append(
-                        db.Grant.from_data(
-                            source_file=source_file,
-                            publisher=publisher,
-                            data=grant,
-                            additional_data=additional_data,
-                            getter_run=getter_run,
+                            "Skipping loading due to: '%s'" % result["error"],
+                            file=self.stdout,
                         )
-                    )
 
-                db.Grant.objects.bulk_create(grant_bulk_insert)
-                grants_added = grants_added + len(grant_data["grants"])
+                    os.remove(result["spool_path"])
+
+        return grants_added
+
+    def load_data(self):
+        self.additional_data_generator = AdditionalDataGenerator()
+        grants_added = 0
+        dataset = self.load_dataset_data()
+
+        getter_run = db.GetterRun.objects.create()
+
+        source_files = [
+            (ob, *self.create_source_file(getter_run, ob)) for ob in dataset
+        ]
 
-            except (FileNotFoundError, KeyError, TypeError, json.JSONDecodeError) as e:
+        if self.options["reuse_unchanged"]:
+            changed_source_files = []
+
+            for ob, publisher, source_file in source_files:
+                grants_copied = self.reuse_source_file_grants(
+                    getter_run, publisher, source_file
+                )
+                if grants_copied is None:
+                    changed_source_files.append((ob, publisher, source_file))
+                else:
+                    grants_added = grants_added + grants_copied
+
+            source_files = changed_source_files
+
+        if self.options["parallel"]:
+            return grants_added + self.load_source_files_parallel(
+                getter_run, source_files
+            )
+
+        for ob, publisher, source_file in source_files:
+            try:
+                # Grants are inserted in batches as the file is parsed so use a
+                # savepoint to avoid keeping half of a file that fails part way
+                with transaction.atomic():
+                    grants_added = grants_added + self.load_source_file_grants(
+                        ob["datagetter_metadata"]["json"],
+                        getter_run,
+                        publisher,
+                        source_file,
+                    )
+
+            except SKIP_SOURCE_FILE_ERRORS as e:
                 print(
                     "Skipping loading due to: '%s'" % e,
                     file=self.stdout,
@@ -122,6 +512,12 @@ class Command(BaseCommand):
                 # For debug    raise e
                 continue
 
+        print(
+            "Org info cache: %s"
+            % self.additional_data_generator.find_that_charity_source.cache,
+            file=self.stdout,
+        )
+
         return grants_added
 
     def handle(self, *args, **options):
@@ -12,9 +12,7 @@ from additional_data.sources.find_that_charity import non_primary_org_ids_map
 
 def update_entities():
 
-    grants = db.Latest.objects.get(series=db.Latest.CURRENT).grant_set.values_list(
-        "data", flat=True
-    )
+    grants = db.Latest.grants().values_list("data", flat=True)
 
     # Delete old entities from previous latest
     print("Removing old entity data")
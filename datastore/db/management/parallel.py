@@ -0,0 +1,27 @@
+import multiprocessing
+
+import django
+from django.conf import settings
+from django.db import connection
+
+
+def init_worker(database_name):
+    """Pool initializer for worker processes that use the Django ORM
+
+    Workers are started with the "spawn" method so that they don't share the
+    parent's database connection, which means Django needs setting up again in
+    each of them. The database name is passed on from the parent as it may
+    not be the configured one e.g. when running tests. Nothing that depends
+    on the app registry can be imported by this module.
+    """
+    django.setup()
+    settings.DATABASES["default"]["NAME"] = database_name
+
+
+def Pool(processes):
+    """Returns a pool of worker processes ready to use the Django ORM"""
+    return multiprocessing.get_context("spawn").Pool(
+        processes,
+        initializer=init_worker,
+        initargs=(connection.settings_dict["NAME"],),
+    )
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.16 on 2026-10-18 18:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("db", "0023_auto_20240318_1952"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="sourcefile",
+            name="content_hash",
+            field=models.CharField(db_index=True, max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 3.2.16 on 2026-10-18 18:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("db", "0024_sourcefile_content_hash"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="GrantBlob",
+            fields=[
+                (
+                    "hash",
+                    models.CharField(max_length=64, primary_key=True, serialize=False),
+                ),
+                ("data", models.JSONField()),
+                ("additional_data", models.JSONField(null=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name="grant",
+            name="data",
+            field=models.JSONField(null=True, verbose_name="Grant data"),
+        ),
+        migrations.AddField(
+            model_name="grant",
+            name="blob",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                to="db.grantblob",
+            ),
+        ),
+    ]
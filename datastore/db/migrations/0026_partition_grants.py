@@ -0,0 +1,109 @@
+"""
+Partitions db_grant by getter_run_id and its Latest through table db_grant_latest
+by latest_id, so that the grants of a GetterRun (or a Latest) can be removed by
+dropping a partition instead of deleting rows.
+
+Each table is recreated as a partitioned table with a partition for every
+existing GetterRun/Latest plus a default partition and the data copied across.
+The indexes and constraints are recreated from the existing definitions.
+
+The primary key of a partitioned table has to include the partition key so it
+becomes (id, getter_run_id), which means db_grant_latest can no longer have a
+foreign key to db_grant.
+"""
+
+from django.db import migrations
+
+
+PARTITION_TABLE_SQL = """
+DO $$
+DECLARE
+    index_defs text[];
+    constraint_defs text[];
+    sequence_name text;
+    def text;
+    r record;
+BEGIN
+    -- Indexes that aren't part of a constraint, these are recreated as is
+    SELECT coalesce(array_agg(pg_get_indexdef(i.indexrelid)), '{{}}') INTO index_defs
+    FROM pg_index i
+    WHERE i.indrelid = '{table}'::regclass
+    AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = i.indexrelid);
+
+    -- Foreign key and unique constraints
+    SELECT coalesce(array_agg(format(
+        'ALTER TABLE {table} ADD CONSTRAINT %I %s', conname, pg_get_constraintdef(oid)
+    )), '{{}}') INTO constraint_defs
+    FROM pg_constraint
+    WHERE conrelid = '{table}'::regclass AND contype IN ('f', 'u');
+
+    -- A partitioned table can't be referenced by a foreign key that doesn't
+    -- include the partition key
+    FOR r IN
+        SELECT conrelid::regclass AS referencing_table, conname
+        FROM pg_constraint
+        WHERE confrelid = '{table}'::regclass AND contype = 'f'
+    LOOP
+        EXECUTE format(
+            'ALTER TABLE %s DROP CONSTRAINT %I', r.referencing_table, r.conname
+        );
+    END LOOP;
+
+    CREATE TABLE {table}_partitioned (LIKE {table} INCLUDING DEFAULTS)
+    PARTITION BY LIST ({key});
+
+    CREATE TABLE {table}_default PARTITION OF {table}_partitioned DEFAULT;
+
+    FOR r IN {partition_values_sql} LOOP
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF {table}_partitioned FOR VALUES IN (%s)',
+            '{table}_' || r.value,
+            r.value
+        );
+    END LOOP;
+
+    INSERT INTO {table}_partitioned SELECT * FROM {table};
+
+    sequence_name := pg_get_serial_sequence('{table}', 'id');
+    EXECUTE format('ALTER SEQUENCE %s OWNED BY NONE', sequence_name);
+
+    DROP TABLE {table};
+    ALTER TABLE {table}_partitioned RENAME TO {table};
+
+    EXECUTE format('ALTER SEQUENCE %s OWNED BY {table}.id', sequence_name);
+
+    ALTER TABLE {table} ADD CONSTRAINT {table}_pkey PRIMARY KEY (id, {key});
+
+    FOREACH def IN ARRAY index_defs LOOP
+        EXECUTE def;
+    END LOOP;
+
+    FOREACH def IN ARRAY constraint_defs LOOP
+        EXECUTE def;
+    END LOOP;
+END $$;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("db", "0025_auto_20261018_1840"),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            PARTITION_TABLE_SQL.format(
+                table="db_grant",
+                key="getter_run_id",
+                partition_values_sql="SELECT id AS value FROM db_getterrun",
+            )
+        ),
+        migrations.RunSQL(
+            PARTITION_TABLE_SQL.format(
+                table="db_grant_latest",
+                key="latest_id",
+                partition_values_sql="SELECT id AS value FROM db_latest",
+            )
+        ),
+    ]
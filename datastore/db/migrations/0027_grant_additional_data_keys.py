@@ -0,0 +1,28 @@
+# Generated by Django 3.2.16 on 2026-10-18 19:04
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("db", "0026_partition_grants"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="grant",
+            name="additional_data_keys",
+            field=django.contrib.postgres.fields.ArrayField(
+                base_field=models.TextField(), blank=True, null=True, size=None
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="grant",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["additional_data_keys"], name="db_grant_additio_5ed358_gin"
+            ),
+        ),
+    ]
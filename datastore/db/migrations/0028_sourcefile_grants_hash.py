@@ -0,0 +1,18 @@
+# Generated by Django 3.2.16 on 2026-10-18 19:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("db", "0027_grant_additional_data_keys"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="sourcefile",
+            name="grants_hash",
+            field=models.CharField(db_index=True, max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,59 @@
+"""
+Moves any rows in the default partitions of db_grant and db_grant_latest to
+partitions of their own and drops the default partitions.
+
+Attaching a partition takes an ACCESS EXCLUSIVE lock on the default partition
+for the rest of the transaction, which would block reading the grants for as
+long as a data load runs. Every GetterRun and Latest has a partition, see
+db.models.create_partition().
+"""
+
+from django.db import migrations
+
+
+DROP_DEFAULT_PARTITION_SQL = """
+DO $$
+DECLARE
+    r record;
+BEGIN
+    IF to_regclass('{table}_default') IS NULL THEN
+        RETURN;
+    END IF;
+
+    ALTER TABLE {table} DETACH PARTITION {table}_default;
+
+    FOR r IN
+        SELECT id AS value FROM {partition_table}
+        UNION SELECT DISTINCT {key} FROM {table}_default
+    LOOP
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS %I PARTITION OF {table} FOR VALUES IN (%s)',
+            '{table}_' || r.value,
+            r.value
+        );
+    END LOOP;
+
+    INSERT INTO {table} SELECT * FROM {table}_default;
+    DROP TABLE {table}_default;
+END $$;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("db", "0028_sourcefile_grants_hash"),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            DROP_DEFAULT_PARTITION_SQL.format(
+                table="db_grant", key="getter_run_id", partition_table="db_getterrun"
+            )
+        ),
+        migrations.RunSQL(
+            DROP_DEFAULT_PARTITION_SQL.format(
+                table="db_grant_latest", key="latest_id", partition_table="db_latest"
+            )
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 3.2.16 on 2026-10-18 19:35
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("db", "0029_drop_default_grant_partitions"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="grant",
+            index=django.contrib.postgres.indexes.BTreeIndex(
+                condition=models.Q(("additional_data_keys__isnull", True)),
+                fields=["id"],
+                name="db_grant_no_lookup_keys",
+            ),
+        ),
+    ]
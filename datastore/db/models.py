@@ -1,14 +1,46 @@
 from typing import Dict, Any
 from django.db.models import JSONField, Index
+from django.db.models.signals import post_save
 from django.db import connection, models
 from django.db.utils import DataError
 from django.contrib.postgres.fields import ArrayField
 from django.contrib.postgres.indexes import GinIndex, BTreeIndex
+from django.dispatch import receiver
 from django.utils import timezone
 
 import datetime
 
 
+def create_partition(table, partition, value):
+    """Creates the partition of the partitioned table for the value, if there
+    isn't one already
+
+    The partition is created as a table of its own and then attached. This only
+    takes a SHARE UPDATE EXCLUSIVE lock on the partitioned table, rather than
+    the ACCESS EXCLUSIVE lock CREATE TABLE ... PARTITION OF takes, so reading
+    the table isn't blocked until the transaction creating the partition ends.
+    There is no default partition as attaching would lock that instead.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT to_regclass(%s) IS NOT NULL,"
+            " EXISTS (SELECT 1 FROM pg_inherits WHERE inhrelid = to_regclass(%s))",
+            [partition, partition],
+        )
+        exists, attached = cursor.fetchone()
+
+        if not exists:
+            cursor.execute(
+                "CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"
+                % (partition, table)
+            )
+        if not attached:
+            cursor.execute(
+                "ALTER TABLE %s ATTACH PARTITION %s FOR VALUES IN (%s)"
+                % (table, partition, int(value))
+            )
+
+
 class Latest(models.Model):
     """Latest best data we have"""
 
@@ -24,71 +56,146 @@ class Latest(models.Model):
     @classmethod
     def grants(cls):
         """Return the QuerySet of latest best Grants."""
-        return cls.objects.get(series=cls.CURRENT).grant_set.all()
+        return cls.objects.get(series=cls.CURRENT).grant_set.filter(
+            getter_run__in=cls.current_getter_run_ids()
+        )
+
+    @classmethod
+    def current_getter_run_ids(cls):
+        """Return the ids of the GetterRuns of the latest best data.
+
+        Filtering grants by these lets the query only scan their db_grant partitions.
+        """
+        return list(
+            SourceFile.objects.filter(latest__series=cls.CURRENT)
+            .values_list("getter_run", flat=True)
+            .distinct()
+        )
+
+    def grants_partition_name(self):
+        return "db_grant_latest_%s" % int(self.pk)
+
+    def delete(self, *args, **kwargs):
+        # Drop the grant_set partition rather than deleting the rows from it
+        with connection.cursor() as cursor:
+            cursor.execute("DROP TABLE IF EXISTS %s" % self.grants_partition_name())
+        return super().delete(*args, **kwargs)
 
     @staticmethod
     def update():
         latest_getter = GetterRun.objects.order_by("-datetime")[:1].get()
 
         # Delete any old nexts hanging around
-        Latest.objects.filter(series=Latest.NEXT).delete()
+        for old_next in Latest.objects.filter(series=Latest.NEXT):
+            old_next.delete()
         latest_next = Latest.objects.create(series=Latest.NEXT)
 
-        grant_count = 0
-
         # All the good downloads
-        for good_source in latest_getter.sourcefile_set.filter(
-            downloads=True, data_valid=True, acceptable_license=True
-        ):
-            # Extra check make sure the source actually has grants.
-            # It isn't much good if not.
-            source_grant_count = good_source.grant_set.count()
+        # Extra check make sure the source actually has grants.
+        # It isn't much good if not.
+        latest_next.sourcefile_set.add(
+            *latest_getter.sourcefile_set.filter(
+                models.Exists(
+                    Grant.objects.filter(
+                        getter_run=latest_getter, source_file=models.OuterRef("pk")
+                    )
+                ),
+                downloads=True,
+                data_valid=True,
+                acceptable_license=True,
+            ).values_list("pk", flat=True)
+        )
+
+        failed_sources = latest_getter.sourcefile_set.filter(
+            models.Q(downloads=False) | models.Q(data_valid=False)
+        )
 
-            grant_count += source_grant_count
+        # Find a replacement source for each failed one, the good source with
+        # the same identifier and some grants from the most recent GetterRun
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT failed_id, source_file_id FROM (
+                    SELECT
+                        failed.id AS failed_id,
+                        candidate.id AS source_file_id,
+                        row_number() OVER (
+                            PARTITION BY failed.id
+                            ORDER BY candidate.getter_run_id DESC, candidate.id DESC
+                        ) AS rank
+                    FROM db_sourcefile AS failed
+                    JOIN db_sourcefile AS candidate
+                        ON candidate.data -> 'identifier' = failed.data -> 'identifier'
+                    WHERE failed.id = ANY(%s)
+                    AND candidate.data_valid
+                    AND candidate.acceptable_license
+                    AND candidate.downloads
+                    AND EXISTS (
+                        SELECT 1 FROM db_grant
+                        WHERE db_grant.getter_run_id = candidate.getter_run_id
+                        AND db_grant.source_file_id = candidate.id
+                    )
+                ) AS candidates
+                WHERE rank = 1
+                """,
+                [list(failed_sources.values_list("pk", flat=True))],
+            )
+            replacements = dict(cursor.fetchall())
 
-            if source_grant_count > 0:
-                latest_next.sourcefile_set.add(good_source)
+        replacement_sources = SourceFile.objects.in_bulk(replacements.values())
 
-        for failed_source in latest_getter.sourcefile_set.filter(
-            models.Q(downloads=False) | models.Q(data_valid=False)
-        ):
+        for failed_source in failed_sources:
             failed_id = failed_source.data["identifier"]
             print(
                 "Processing the failed source %s\n%s" % (failed_id, failed_source.data)
             )
-            replacement_found = False
 
-            # Find a replacement source for a failed one
-            for candidate_replacement_source in SourceFile.objects.filter(
-                data__identifier=failed_id,
-                data_valid=True,
-                acceptable_license=True,
-                downloads=True,
-            ).order_by("-getter_run"):
-                # Extra check make sure the source actually has grants.
-                # It isn't much good if not.
-                source_grant_count = candidate_replacement_source.grant_set.count()
-
-                grant_count += source_grant_count
-
-                if source_grant_count > 0:
-                    print(
-                        "Found new source for failed_source %s which is %s"
-                        % (failed_id, candidate_replacement_source)
-                    )
-                    latest_next.sourcefile_set.add(candidate_replacement_source)
-                    # We found a replacement:
-                    replacement_found = True
-                    break
-
-            if not replacement_found:
+            if failed_source.pk in replacements:
+                replacement_source = replacement_sources[replacements[failed_source.pk]]
+                print(
+                    "Found new source for failed_source %s which is %s"
+                    % (failed_id, replacement_source)
+                )
+                latest_next.sourcefile_set.add(replacement_source)
+            else:
                 print("Warning - No replacement source available for %s" % failed_id)
 
+        # A source that was compacted while out of use, e.g. an older
+        # replacement, needs the data of its grants back now that it's in use
+        compacted_sources = GrantBlob.compacted(latest_next.sourcefile_set.all())
+        if compacted_sources.exists():
+            GrantBlob.hydrate(compacted_sources)
+
+        # Update our shortcut latest->grants
+        # Fill the through table (the m2m table) directly from the grants of the sources
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO db_grant_latest (grant_id, latest_id)
+                SELECT db_grant.id, db_sourcefile_latest.latest_id
+                FROM db_grant
+                JOIN db_sourcefile_latest
+                    ON db_sourcefile_latest.sourcefile_id = db_grant.source_file_id
+                WHERE db_sourcefile_latest.latest_id = %s
+                AND db_grant.getter_run_id = ANY(%s)
+                """,
+                [
+                    latest_next.pk,
+                    list(
+                        latest_next.sourcefile_set.values_list(
+                            "getter_run", flat=True
+                        ).distinct()
+                    ),
+                ],
+            )
+            grant_count = cursor.rowcount
+
         # Before we set this as current check that there are more than 0 grants
         # Do the switcher-round
         if grant_count > 0:
             # Delete the old previous
-            Latest.objects.filter(series=Latest.PREVIOUS).delete()
+            for old_previous in Latest.objects.filter(series=Latest.PREVIOUS):
+                old_previous.delete()
             # Make the current the previous
             current, c_created = Latest.objects.get_or_create(series=Latest.CURRENT)
             current.series = Latest.PREVIOUS
@@ -97,22 +204,6 @@ class Latest(models.Model):
             # Make the next the current
             latest_next.series = Latest.CURRENT
             latest_next.save()
-            # Just to be less confusing later on
-            latest_current = latest_next
-
-            # Update our shortcut latest->grants
-            # Access the through model (the m2m table) directly to do bulk update
-            ThroughModel = Latest.grant_set.through
-            grants_for_latest = []
-
-            for grant in latest_next.sourcefile_set.values_list(
-                "grant", flat=True
-            ).iterator():
-                grants_for_latest.append(
-                    ThroughModel(grant_id=grant, latest_id=latest_current.pk)
-                )
-
-            ThroughModel.objects.bulk_create(grants_for_latest)
 
         else:
             raise Exception("The data provided no grants to generate an update")
@@ -121,6 +212,16 @@ class Latest(models.Model):
         return self.series
 
 
+# Each Latest has its own partition of the grant_set through table, created by
+# a signal handler so that Latests loaded from fixtures get one too
+@receiver(post_save, sender=Latest)
+def create_latest_grants_partition(sender, instance, created, **kwargs):
+    if created:
+        create_partition(
+            "db_grant_latest", instance.grants_partition_name(), instance.pk
+        )
+
+
 class GetterRunManager(models.Manager):
     def in_use(self):
         """Return the QuerySet of all GetterRuns in-use by any Latest best."""
@@ -137,19 +238,44 @@ class GetterRun(models.Model):
     datetime = models.DateTimeField(default=timezone.now)
     archived = models.BooleanField(default=False)
 
-    def delete_all_data_from_run(self):
-        # Delete the Grants one SourceFile at a time to save on memory usage
-        # because Django loads objects into memory before deleting them in
-        # order to trigger signals, cascade deletes etc.
-        for sourcefile in self.sourcefile_set.all():
-            sourcefile.grant_set.all().delete()
-            sourcefile.delete()
+    def grants_partition_name(self):
+        return "db_grant_%s" % int(self.pk)
+
+    def delete_grants(self, drop_partition=False):
+        """Delete the Grants of the run by truncating or dropping its partition
+
+        This avoids Django loading every Grant into memory to delete them.
+        """
+        partition = self.grants_partition_name()
 
+        with connection.cursor() as cursor:
+            # db_grant_latest can't have a foreign key to the partitioned db_grant
+            # so the references have to be cleared up here
+            cursor.execute(
+                "DELETE FROM db_grant_latest WHERE grant_id IN ("
+                " SELECT id FROM db_grant WHERE getter_run_id = %s"
+                ")",
+                [self.pk],
+            )
+
+            cursor.execute("SELECT to_regclass(%s)", [partition])
+            if cursor.fetchone()[0]:
+                if drop_partition:
+                    cursor.execute("DROP TABLE %s" % partition)
+                else:
+                    cursor.execute("TRUNCATE %s" % partition)
+
+            # In case the partition is missing
+            cursor.execute("DELETE FROM db_grant WHERE getter_run_id = %s", [self.pk])
+
+    def delete_all_data_from_run(self):
+        self.delete_grants(drop_partition=True)
+        self.sourcefile_set.all().delete()
         self.publisher_set.all().delete()
 
     def archive_run(self):
         """Archive the run and delete grant data"""
-        self.grant_set.all().delete()
+        self.delete_grants()
         self.archived = True
         self.save()
 
@@ -166,6 +292,14 @@ class GetterRun(models.Model):
         return GetterRun.objects.in_use().filter(pk=self.pk).exists()
 
 
+# Each GetterRun has its own partition of db_grant, see
+# create_latest_grants_partition()
+@receiver(post_save, sender=GetterRun)
+def create_getter_run_grants_partition(sender, instance, created, **kwargs):
+    if created:
+        create_partition("db_grant", instance.grants_partition_name(), instance.pk)
+
+
 class SourceFile(models.Model):
     data = JSONField()
     getter_run = models.ForeignKey(GetterRun, on_delete=models.CASCADE)
@@ -178,6 +312,35 @@ class SourceFile(models.Model):
     data_valid = models.BooleanField(default=False)
     acceptable_license = models.BooleanField(default=False)
     downloads = models.BooleanField(default=False)
+    # sha256 of the grant data file, used to spot files unchanged between runs
+    content_hash = models.CharField(max_length=64, null=True, db_index=True)
+    # sha256 of the grant data the quality and aggregate were created from,
+    # see grants_hashes()
+    grants_hash = models.CharField(max_length=64, null=True, db_index=True)
+
+    @staticmethod
+    def grants_hashes(source_files):
+        """Returns the (number of grants, hash of the grant data) of each of the
+        SourceFiles with grants by pk
+
+        The hash doesn't depend on the order of the grants and, as jsonb has a
+        normalised text representation, is the same for the same grant data
+        whichever file format it was published in.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT source_file_id, count(*),"
+                " encode(sha256(convert_to(string_agg(grant_hash, '' ORDER BY grant_hash),"
+                " 'UTF8')), 'hex')"
+                " FROM ("
+                "  SELECT source_file_id,"
+                "  encode(sha256(convert_to(data::text, 'UTF8')), 'hex') AS grant_hash"
+                "  FROM db_grant WHERE source_file_id = ANY(%s)"
+                " ) AS grants"
+                " GROUP BY source_file_id",
+                [list(source_files.values_list("pk", flat=True))],
+            )
+            return {pk: (count, grants_hash) for pk, count, grants_hash in cursor}
 
     # We have this as an array but for now we can assume it will only have
     # one item for the purposes of our api.
@@ -370,9 +533,115 @@ class Funder(Entity):
         indexes = [Index(fields=["org_id", "name"])]
 
 
+class GrantBlob(models.Model):
+    """Grant data and additional data stored once by a hash of their content
+
+    The Grants of SourceFiles that aren't in use by any Latest are compacted
+    to reference a GrantBlob instead of each GetterRun keeping its own copy
+    of what is mostly unchanged data.
+    """
+
+    hash = models.CharField(max_length=64, primary_key=True)
+    data = JSONField()
+    additional_data = JSONField(null=True)
+
+    # jsonb has a normalised text representation so the same content always
+    # produces the same hash
+    HASH_SQL = (
+        "encode(sha256(convert_to("
+        "jsonb_build_array(data, additional_data)::text, 'UTF8')), 'hex')"
+    )
+
+    @staticmethod
+    def compact(source_files):
+        """Moves the data of the grants of the SourceFiles into GrantBlobs"""
+        params = [
+            list(source_files.values_list("getter_run", flat=True).distinct()),
+            list(source_files.values_list("pk", flat=True)),
+        ]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO db_grantblob (hash, data, additional_data) "
+                " SELECT DISTINCT ON (hash) hash, data, additional_data FROM ("
+                "  SELECT %s AS hash, data, additional_data FROM db_grant "
+                "  WHERE getter_run_id = ANY(%%s) AND source_file_id = ANY(%%s)"
+                "  AND data IS NOT NULL"
+                " ) AS grants "
+                " ON CONFLICT (hash) DO NOTHING" % GrantBlob.HASH_SQL,
+                params,
+            )
+            cursor.execute(
+                "UPDATE db_grant SET blob_id = %s, data = NULL, additional_data = NULL"
+                " WHERE getter_run_id = ANY(%%s) AND source_file_id = ANY(%%s)"
+                " AND data IS NOT NULL" % GrantBlob.HASH_SQL,
+                params,
+            )
+            return cursor.rowcount
+
+    @staticmethod
+    def compacted(source_files):
+        """Returns the SourceFiles that have any compacted grants"""
+        return source_files.filter(
+            models.Exists(
+                Grant.objects.filter(
+                    getter_run=models.OuterRef("getter_run"),
+                    source_file=models.OuterRef("pk"),
+                    blob__isnull=False,
+                )
+            )
+        )
+
+    @staticmethod
+    def hydrate(source_files):
+        """Copies the data back into any compacted grants of the SourceFiles"""
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "UPDATE db_grant SET "
+                " data = db_grantblob.data,"
+                " additional_data = db_grantblob.additional_data,"
+                " blob_id = NULL"
+                " FROM db_grantblob"
+                " WHERE db_grant.blob_id = db_grantblob.hash"
+                " AND db_grant.getter_run_id = ANY(%s)"
+                " AND db_grant.source_file_id = ANY(%s)",
+                [
+                    list(source_files.values_list("getter_run", flat=True).distinct()),
+                    list(source_files.values_list("pk", flat=True)),
+                ],
+            )
+            return cursor.rowcount
+
+    @staticmethod
+    def fill(grants):
+        """Sets the data and additional data of any of the compacted Grant
+        instances from their GrantBlobs, in one query, without updating the
+        Grants"""
+        blobs = GrantBlob.objects.in_bulk(
+            {grant.blob_id for grant in grants if grant.blob_id}
+        )
+        for grant in grants:
+            if grant.blob_id:
+                grant.data = blobs[grant.blob_id].data
+                grant.additional_data = blobs[grant.blob_id].additional_data
+        return grants
+
+    @staticmethod
+    def delete_unused():
+        """Deletes GrantBlobs that no Grant references"""
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "DELETE FROM db_grantblob WHERE NOT EXISTS ("
+                " SELECT 1 FROM db_grant WHERE db_grant.blob_id = db_grantblob.hash"
+                ")"
+            )
+            return cursor.rowcount
+
+
 class Grant(models.Model):
     grant_id = models.CharField(max_length=300)
-    data = JSONField(verbose_name="Grant data")
+    # Null when the data has been compacted into the blob
+    data = JSONField(verbose_name="Grant data", null=True)
+    blob = models.ForeignKey(GrantBlob, null=True, on_delete=models.PROTECT)
 
     getter_run = models.ForeignKey(GetterRun, on_delete=models.CASCADE)
     publisher = models.ForeignKey(Publisher, on_delete=models.DO_NOTHING)
@@ -384,6 +653,10 @@ class Grant(models.Model):
         verbose_name="Additional Grant data", null=True, blank=True
     )
 
+    # The keys of the reference data looked up to create the additional data
+    # see AdditionalDataGenerator.lookup_keys()
+    additional_data_keys = ArrayField(models.TextField(), null=True, blank=True)
+
     # Convenience denormalised fields to aid creating indexes and speedup queries
     publisher_org_id = models.TextField()
     recipient_org_ids = ArrayField(models.TextField())
@@ -395,12 +668,18 @@ class Grant(models.Model):
         try:
             with connection.cursor() as c:
                 # https://www.citusdata.com/blog/2016/10/12/count-performance/
+                # db_grant is partitioned so sum up the estimates of its partitions
                 c.execute(
-                    " SELECT (reltuples/relpages) * (pg_relation_size('db_grant') / "
-                    " (current_setting('block_size')::integer)) "
-                    " FROM pg_class where relname = 'db_grant'"
+                    " SELECT SUM((reltuples/relpages) * (pg_relation_size(oid) / "
+                    " (current_setting('block_size')::integer))) "
+                    " FROM pg_class WHERE relpages > 0 AND oid IN "
+                    " (SELECT inhrelid FROM pg_inherits "
+                    "  WHERE inhparent = 'db_grant'::regclass)"
                 )
-                return int(c.fetchone()[0])
+                estimate = c.fetchone()[0]
+                if estimate is None:
+                    return Grant.objects.count()
+                return int(estimate)
         except DataError:
             return Grant.objects.count()
 
@@ -416,6 +695,14 @@ class Grant(models.Model):
             GinIndex(fields=["source_file", "recipient_org_ids"]),
             GinIndex(fields=["funding_org_ids"]),
             GinIndex(fields=["source_file", "funding_org_ids"]),
+            GinIndex(fields=["additional_data_keys"]),
+            # The grants loaded before the lookup keys were, which are
+            # rewritten along with any looking up changed keys
+            BTreeIndex(
+                fields=["id"],
+                name="db_grant_no_lookup_keys",
+                condition=models.Q(additional_data_keys__isnull=True),
+            ),
         ]
 
     @staticmethod
@@ -434,17 +721,26 @@ class Grant(models.Model):
             publisher=publisher,
             source_file=source_file,
             additional_data=additional_data,
-            publisher_org_id=publisher.org_id,
-            recipient_org_ids=[
+            **Grant.convenience_fields_from_data(data, publisher.org_id),
+        )
+
+    @staticmethod
+    def convenience_fields_from_data(
+        data: Dict[str, Any], publisher_org_id: str
+    ) -> Dict[str, Any]:
+        """Returns the denormalised convenience fields for the grant data"""
+        return {
+            "publisher_org_id": publisher_org_id,
+            "recipient_org_ids": [
                 org["id"]
                 # recipientOrganization isn't present in grants to individuals
                 for org in data.get("recipientOrganization", list())
                 if "id" in org
             ],
-            funding_org_ids=[
+            "funding_org_ids": [
                 org["id"] for org in data["fundingOrganization"] if "id" in org
             ],
-        )
+        }
 
 
 class Statuses(object):
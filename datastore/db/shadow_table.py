@@ -0,0 +1,209 @@
+import time
+
+from django.db import OperationalError, connection, transaction
+from psycopg2.errors import LockNotAvailable
+
+
+def quote(name):
+    return connection.ops.quote_name(name)
+
+
+class SwapLockTimeout(Exception):
+    pass
+
+
+class ShadowTable(object):
+    """Replaces all of the rows of a model's table without anything reading it
+    seeing it empty or partly loaded
+
+    The new rows are loaded into a copy of the table that has no indexes, the
+    indexes and constraints of the table are then built on the copy and
+    finally the copy is renamed to replace the table in a short transaction.
+    This also avoids the bloat left by deleting all of the old rows.
+
+    Example usage:
+
+    with ShadowTable(NSPL) as shadow:
+        with CopyLoader(NSPL, ["postcode", "data"], table=shadow.table) as loader:
+            loader.add(["EX364AJ", {"pcd": "EX364AJ"}])
+
+    Or when loaded by separate processes:
+
+    ShadowTable(OrgInfoCache).create()
+    (load the rows into ShadowTable(OrgInfoCache).table)
+    ShadowTable(OrgInfoCache).swap()
+    """
+
+    # How long the swap waits for the lock on the live table, rather than
+    # queueing everything else that reads it behind a long running query
+    lock_timeout = "5s"
+    lock_attempts = 5
+    lock_retry_delay = 10
+
+    def __init__(self, model):
+        self.model = model
+        self.live_table = model._meta.db_table
+        self.table = "%s_shadow" % self.live_table
+
+    def exists(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT to_regclass(%s)", [self.table])
+            return cursor.fetchone()[0] is not None
+
+    def create(self):
+        """Creates the empty shadow table, replacing any left over from before"""
+        with connection.cursor() as cursor:
+            cursor.execute("DROP TABLE IF EXISTS %s" % quote(self.table))
+            # The defaults include the id sequence, so ids carry on from the
+            # live table's
+            cursor.execute(
+                "CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING CONSTRAINTS "
+                "INCLUDING STORAGE)" % (quote(self.table), quote(self.live_table))
+            )
+
+    def drop(self):
+        with connection.cursor() as cursor:
+            cursor.execute("DROP TABLE IF EXISTS %s" % quote(self.table))
+
+    def live_indexes(self, cursor):
+        """Returns the name, definition of the primary key or unique
+        constraint if it is for one, and definition of each live table index"""
+        cursor.execute(
+            """
+            SELECT index_class.relname,
+                pg_get_constraintdef(index_constraint.oid),
+                pg_get_indexdef(pg_index.indexrelid)
+            FROM pg_index
+            JOIN pg_class AS index_class ON index_class.oid = pg_index.indexrelid
+            LEFT JOIN pg_constraint AS index_constraint
+                ON index_constraint.conindid = pg_index.indexrelid
+                AND index_constraint.conrelid = pg_index.indrelid
+                AND index_constraint.contype IN ('p', 'u')
+            WHERE pg_index.indrelid = %s::regclass
+            ORDER BY index_class.relname
+            """,
+            [self.live_table],
+        )
+        return cursor.fetchall()
+
+    def build_indexes(self):
+        """Builds the live table's indexes and constraints on the shadow table
+
+        Returns the (shadow name, live name, is a constraint) of each.
+        """
+        renames = []
+
+        with connection.cursor() as cursor:
+            for i, (name, constraint, index) in enumerate(self.live_indexes(cursor)):
+                shadow_name = "%s_%s" % (self.table, i)
+
+                # Already built by a swap that couldn't lock the live table
+                cursor.execute("SELECT to_regclass(%s)", [shadow_name])
+                if cursor.fetchone()[0] is not None:
+                    pass
+                elif constraint:
+                    cursor.execute(
+                        "ALTER TABLE %s ADD CONSTRAINT %s %s"
+                        % (quote(self.table), quote(shadow_name), constraint)
+                    )
+                else:
+                    # e.g. CREATE INDEX name ON public.table USING btree (column)
+                    unique = "UNIQUE " if index.startswith("CREATE UNIQUE ") else ""
+                    cursor.execute(
+                        "CREATE %sINDEX %s ON %s USING %s"
+                        % (
+                            unique,
+                            quote(shadow_name),
+                            quote(self.table),
+                            index.split(" USING ", 1)[1],
+                        )
+                    )
+
+                renames.append((shadow_name, name, bool(constraint)))
+
+            cursor.execute("ANALYZE %s" % quote(self.table))
+
+        return renames
+
+    def swap(self):
+        """Builds the indexes of the shadow table and then replaces the live
+        table with it
+
+        Raises SwapLockTimeout, leaving the shadow table to swap later, if the
+        live table can't be locked after lock_attempts tries.
+        """
+        renames = self.build_indexes()
+
+        for attempt in range(1, self.lock_attempts + 1):
+            try:
+                self.replace_live_table(renames)
+                return
+            except OperationalError as e:
+                if not isinstance(e.__cause__, LockNotAvailable):
+                    raise
+                if attempt == self.lock_attempts:
+                    raise SwapLockTimeout(
+                        "Couldn't lock %s to replace it after %d attempts"
+                        % (self.live_table, attempt)
+                    ) from e
+                time.sleep(self.lock_retry_delay)
+
+    def replace_live_table(self, renames):
+        with transaction.atomic(), connection.cursor() as cursor:
+            # Waits for anything already reading the live table to finish
+            cursor.execute("SET LOCAL lock_timeout = %s", [self.lock_timeout])
+            cursor.execute(
+                "LOCK TABLE %s IN ACCESS EXCLUSIVE MODE" % quote(self.live_table)
+            )
+            cursor.execute("SET LOCAL lock_timeout = DEFAULT")
+
+            # The id sequence is dropped along with the table that owns it
+            cursor.execute(
+                "SELECT pg_get_serial_sequence(%s, %s)",
+                [self.live_table, self.model._meta.pk.column],
+            )
+            sequence = cursor.fetchone()[0]
+            if sequence:
+                cursor.execute(
+                    "ALTER SEQUENCE %s OWNED BY %s.%s"
+                    % (
+                        sequence,
+                        quote(self.table),
+                        quote(self.model._meta.pk.column),
+                    )
+                )
+
+            cursor.execute("DROP TABLE %s" % quote(self.live_table))
+            cursor.execute(
+                "ALTER TABLE %s RENAME TO %s"
+                % (quote(self.table), quote(self.live_table))
+            )
+
+            for shadow_name, name, is_constraint in renames:
+                if is_constraint:
+                    # Renames the constraint's index as well
+                    cursor.execute(
+                        "ALTER TABLE %s RENAME CONSTRAINT %s TO %s"
+                        % (quote(self.live_table), quote(shadow_name), quote(name))
+                    )
+                else:
+                    cursor.execute(
+                        "ALTER INDEX %s RENAME TO %s"
+                        % (quote(shadow_name), quote(name))
+                    )
+
+    def __enter__(self):
+        self.create()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            try:
+                self.swap()
+            except SwapLockTimeout:
+                if not connection.in_atomic_block:
+                    self.drop()
+                raise
+        elif not connection.in_atomic_block:
+            # Otherwise rolling back the transaction removes the shadow table
+            self.drop()
@@ -19,6 +19,12 @@ from django.utils.crypto import get_random_string
 env = environ.Env(  # set default values and casting
     # TODO could use $XDG_RUNTIME_DIR ?
     DATA_RUN_PID_FILE=(str, "/var/run/user/%s/datarun.pid" % os.getuid()),
+    ORG_INFO_CACHE_SIZE=(int, 300000),
+    NAMED_LOCATION_CACHE_SIZE=(int, 100000),
+    NSPL_CACHE_SIZE=(int, 100000),
+    NSPL_INDEX_FILE=(str, None),
+    ADDITIONAL_DATA_LOCATION_REFS=(bool, False),
+    NSPL_FIELDS=(list, []),
 )
 
 
@@ -175,6 +181,34 @@ DATA_RUN_PID_FILE = env("DATA_RUN_PID_FILE")
 
 DATA_RUN_SCRIPT = "data_run.sh"
 
+# The number of org-ids FindThatCharitySource keeps the org info of in memory
+# each is approximately 0.5KiB
+ORG_INFO_CACHE_SIZE = env("ORG_INFO_CACHE_SIZE")
+
+# The number of postcodes NSPLSource keeps the location data with code names of
+# in memory, each is approximately 2KiB
+NAMED_LOCATION_CACHE_SIZE = env("NAMED_LOCATION_CACHE_SIZE")
+
+# The number of postcodes NSPLSource keeps the NSPL data of in memory when
+# there isn't an NSPL index, each is approximately 1.5KiB
+NSPL_CACHE_SIZE = env("NSPL_CACHE_SIZE")
+
+# Optional path of the memory-mapped NSPL index written by load_nspl, when it
+# exists NSPLSource looks postcodes up in it instead of the NSPL table
+NSPL_INDEX_FILE = env("NSPL_INDEX_FILE")
+
+# The NSPL fields load_nspl keeps for each postcode, and so the fields of a
+# grant's recipientOrganizationLocation (with the names of their codes). When
+# set, fields without a value are left out too. Empty, the default, keeps every
+# field. recipientOrganizationLocation is published so only set this when the
+# users of the data don't need the other fields.
+NSPL_FIELDS = env("NSPL_FIELDS")
+
+# Store references to the GeoLookup areas and NSPL postcodes in the grants'
+# additional data rather than copies of them. They are put back in place when
+# the grants are output by create_data_package and the API
+ADDITIONAL_DATA_LOCATION_REFS = env("ADDITIONAL_DATA_LOCATION_REFS")
+
 GRANTNAV_PACKAGE_DOWNLOAD_URL = (
     "https://localhost:8000/grantnav_packages/latest_grantnav_data.tar.gz"
 )
@@ -1,4 +1,5 @@
 from django.test import TestCase
+from additional_data.models import CodelistCode
 from additional_data.sources.codelist_code import CodeListSource
 
 
@@ -35,3 +36,40 @@ class TestCodeLists(TestCase):
             additional_data_out,
             "The expected additional data isn't correct",
         )
+
+    def test_code_list_preloaded(self):
+        CodelistCode.objects.create(
+            list_name="regrantType", code="FRG010", title="Common Regrant"
+        )
+        source = CodeListSource()
+
+        CodelistCode.objects.create(
+            list_name="grantToIndividualsPurpose",
+            code="GTIP170",
+            title="Exceptional costs",
+        )
+
+        grant = {
+            "toIndividualsDetails": {"grantPurpose": ["GTIP170"]},
+            "regrantType": "FRG010",
+        }
+
+        additional_data = {}
+        with self.assertNumQueries(0):
+            source.update_additional_data(grant, additional_data)
+
+        self.assertEqual(
+            additional_data["codeListLookup"]["regrantType"], "Common Regrant"
+        )
+        # Codes added after the source was created aren't known until it's reloaded
+        self.assertEqual(
+            additional_data["codeListLookup"]["toIndividualsDetails"]["grantPurpose"],
+            [],
+        )
+
+        source.load_titles()
+        source.update_additional_data(grant, additional_data)
+        self.assertEqual(
+            additional_data["codeListLookup"]["toIndividualsDetails"]["grantPurpose"],
+            ["Exceptional costs"],
+        )
@@ -1,4 +1,4 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
 
 from additional_data.models import OrgInfoCache
 from additional_data.sources.find_that_charity import FindThatCharitySource
@@ -41,3 +41,61 @@ class TestAdditionalData(TestCase):
             True,
             "Additional data should have been added",
         )
+
+    def test_find_that_charity_update_additional_data_batch(self):
+        find_that_charity_source = FindThatCharitySource()
+        find_that_charity_source.process_csv(self.ftc_file_data, "ccew")
+
+        grants = []
+        for org_id in ["two-345", "one-234", "ABC-119843", "360G-example", "two-345"]:
+            grant = Grant.objects.first().data
+            grant["recipientOrganization"][0]["id"] = org_id
+            grants.append(grant)
+
+        additional_data_list = [{} for grant in grants]
+        with self.assertNumQueries(1):
+            find_that_charity_source.update_additional_data_batch(
+                grants, additional_data_list
+            )
+
+        expected_additional_data_list = []
+        for grant in grants:
+            additional_data = {}
+            FindThatCharitySource().update_additional_data(grant, additional_data)
+            expected_additional_data_list.append(additional_data)
+
+        self.assertEqual(additional_data_list, expected_additional_data_list)
+        self.assertEqual(
+            additional_data_list[0][FindThatCharitySource.ADDITIONAL_DATA_KEY][0]["id"],
+            "ABC-119841",
+        )
+
+    @override_settings(ORG_INFO_CACHE_SIZE=2)
+    def test_find_that_charity_cache(self):
+        find_that_charity_source = FindThatCharitySource()
+        find_that_charity_source.process_csv(self.ftc_file_data, "ccew")
+
+        grant = Grant.objects.first().data
+
+        def lookup(org_id):
+            grant["recipientOrganization"][0]["id"] = org_id
+            additional_data = {}
+            find_that_charity_source.update_additional_data(grant, additional_data)
+            return additional_data[FindThatCharitySource.ADDITIONAL_DATA_KEY]
+
+        self.assertEqual(len(lookup("one-234")), 1)
+        # Org-ids with no org info are cached too
+        self.assertEqual(lookup("GB-CHC-0"), [])
+
+        with self.assertNumQueries(0):
+            self.assertEqual(len(lookup("one-234")), 1)
+            self.assertEqual(lookup("GB-CHC-0"), [])
+
+        # Evicts the least recently used "one-234"
+        self.assertEqual(len(lookup("two-345")), 1)
+        self.assertNotIn("one-234", find_that_charity_source.cache)
+
+        self.assertEqual(
+            find_that_charity_source.cache.stats(),
+            {"size": 2, "max_size": 2, "hits": 2, "misses": 3, "evictions": 1},
+        )
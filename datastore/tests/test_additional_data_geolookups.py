@@ -193,3 +193,14 @@ class TestAdditionalDataGeoLookup(TestCase):
                 GeoLookup.objects.get(areacode=self.EXISTING_AREA).data["latitude"], 5
             ),
         )
+
+    def test_get_area_by_code_preloaded(self):
+        self.save_mock_data()
+        geo = GeoLookupSource()
+
+        area = geo.get_area_by_code(self.EXISTING_AREA)
+        area["source"] = "beneficiaryLocation"
+
+        with self.assertNumQueries(0):
+            self.assertNotIn("source", geo.get_area_by_code(self.EXISTING_AREA))
+            self.assertIsNone(geo.get_area_by_code("E99999999"))
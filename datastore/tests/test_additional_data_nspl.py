@@ -1,9 +1,12 @@
 import json
+import os
+import tempfile
 
 import requests_mock
-from django.test import TestCase
+from django.test import TestCase, override_settings
 
-from additional_data.models import NSPL
+from additional_data.models import NSPL, GeoCodeName
+from additional_data.nspl_index import NSPLIndex
 from additional_data.sources.geocode_names import GeoCodeNamesSource
 from additional_data.sources.nspl import NSPLSource
 from db.models import Grant
@@ -77,6 +80,40 @@ class TestAdditionalDataNSPL(TestCase):
                     },
                 )
 
+    @override_settings(NSPL_FIELDS=["pcds", "lat", "long", "laua", "lep2", "hash"])
+    def test_import_nspl_projected_fields(self):
+        nspl = NSPLSource()
+
+        with requests_mock.Mocker() as m:
+            with open("./datastore/tests/files/nspl_with_data.zip", "rb") as infile:
+                m.get(nspl.NSPL_URL, body=infile)
+                nspl.import_nspl()
+
+        # Only the NSPL_FIELDS with a value
+        self.assertEqual(
+            NSPL.objects.get(postcode=self.EXITING_POSTCODE).data,
+            {
+                "pcds": "EX36 4AJ",
+                "lat": 51.013971,
+                "long": -3.834169,
+                "laua": "E07000043",
+                "hash": "406d4d87706c78d0cb4018521c82d56b",
+            },
+        )
+
+    def test_import_nspl_in_batches(self):
+        nspl = NSPLSource()
+
+        with requests_mock.Mocker() as m:
+            with open("./datastore/tests/files/nspl_with_data.zip", "rb") as infile:
+                m.get(nspl.NSPL_URL, body=infile)
+                nspl.import_nspl(batch_size=4)
+
+        self.assertEqual(NSPL.objects.count(), 6)
+        self.assertEqual(
+            NSPL.objects.get(postcode=self.EXITING_POSTCODE).data["lat"], 51.013971
+        )
+
     def test_import_nspl_without_data(self):
         nspl = NSPLSource()
 
@@ -182,6 +219,64 @@ class TestAdditionalDataNSPL(TestCase):
                     "Devon",
                 )
 
+    def test_nspl_named_location_data_cached(self):
+        GeoCodeName.objects.create(code="E10000008", data={"name": "Devon"})
+        GeoCodeName.objects.create(code="EX364AJ", data={"name": "Not a GSS code"})
+        self.save_nspl_mock_data()
+        nspl_data = NSPL.objects.get(postcode=self.EXITING_POSTCODE).data
+
+        nspl = NSPLSource()
+        nspl.prefetch_postcodes([self.EXITING_POSTCODE])
+
+        additional_data_list = []
+        # The code names are loaded once and each postcode only named once
+        with self.assertNumQueries(1):
+            for postcode in ["EX36 4AJ", "ex364aj"]:
+                additional_data = {}
+                nspl.update_additional_data(
+                    {"recipientOrganization": [{"postalCode": postcode}]},
+                    additional_data,
+                )
+                additional_data_list.append(additional_data)
+
+        location_data = additional_data_list[0]["recipientOrganizationLocation"]
+        self.assertEqual(location_data["cty_name"], "Devon")
+        self.assertNotIn("pcd_name", location_data)
+        self.assertEqual(additional_data_list[1], additional_data_list[0])
+        # Not shared between grants or with the cached location data
+        self.assertIsNot(
+            additional_data_list[1]["recipientOrganizationLocation"], location_data
+        )
+        self.assertEqual(
+            nspl.get_location_data_by_postcode(self.EXITING_POSTCODE), nspl_data
+        )
+
+    @override_settings(NSPL_CACHE_SIZE=2, NAMED_LOCATION_CACHE_SIZE=2)
+    def test_nspl_caches_size(self):
+        self.save_nspl_mock_data()
+        postcodes = list(NSPL.objects.values_list("postcode", flat=True))
+        self.assertGreater(len(postcodes), 2)
+
+        nspl = NSPLSource()
+        nspl.prefetch_postcodes(postcodes)
+        self.assertEqual(len(nspl._nspl_cache), 2)
+
+        for postcode in postcodes + ["AB10AA"]:
+            additional_data = {}
+            nspl.update_additional_data(
+                {"recipientOrganization": [{"postalCode": postcode}]}, additional_data
+            )
+            if postcode != "AB10AA":
+                self.assertEqual(
+                    additional_data["recipientOrganizationLocation"]["pcd"].replace(
+                        " ", ""
+                    ),
+                    postcode,
+                )
+
+        self.assertEqual(len(nspl._nspl_cache), 2)
+        self.assertEqual(len(nspl._named_locations), 2)
+
     def test_nspl_update_additional_data_with_not_existing_postcode(self):
         self.save_nspl_mock_data()
 
@@ -226,3 +321,39 @@ class TestAdditionalDataNSPL(TestCase):
             additional_data["recipientOrganizationLocation"],
             NSPL.objects.get(postcode=self.EXITING_POSTCODE).data,
         )
+
+    def test_nspl_index(self):
+        self.save_nspl_mock_data()
+        # Mixed types and missing fields are stored as they are
+        NSPL.objects.create(
+            postcode="ZZ11ZZ", data={"pcd": "ZZ1 1ZZ", "usertype": "1", "imd": None}
+        )
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            index_file = os.path.join(tmp_dir, "nspl.idx")
+            self.assertEqual(NSPLIndex.build(index_file), 16)
+
+            index = NSPLIndex(index_file)
+            for nspl in NSPL.objects.all():
+                self.assertEqual(index.get(nspl.postcode), nspl.data)
+            self.assertIsNone(index.get("AB10AA"))
+            self.assertIsNone(index.get("ZZ99ZZZZ"))
+            index.close()
+
+            grant = Grant.objects.first()
+            grant.data["recipientOrganization"][0]["postalCode"] = "ex36 4aj"
+
+            additional_data = {}
+            NSPLSource().update_additional_data(grant.data, additional_data)
+
+            with override_settings(NSPL_INDEX_FILE=index_file):
+                nspl = NSPLSource()
+                with self.assertNumQueries(0):
+                    location_data = nspl.get_location_data_by_postcode("ex36 4aj")
+
+                index_additional_data = {}
+                nspl.update_additional_data(grant.data, index_additional_data)
+                nspl.nspl_index.close()
+
+        self.assertEqual(location_data, NSPL.objects.get(postcode="EX364AJ").data)
+        self.assertEqual(index_additional_data, additional_data)
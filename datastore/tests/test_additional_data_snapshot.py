@@ -0,0 +1,74 @@
+import os
+import tempfile
+
+from django.test import TestCase
+
+from additional_data.generator import AdditionalDataGenerator
+from additional_data.models import NSPL, GeoCodeName, GeoLookup
+from additional_data.snapshot import LookupSnapshot, Snapshot
+from additional_data.sources.find_that_charity import FindThatCharitySource
+from db.models import Grant
+
+
+class TestAdditionalDataSnapshot(TestCase):
+    fixtures = ["test_data.json"]
+
+    def test_snapshot(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "test.snapshot")
+
+            self.assertEqual(
+                Snapshot.write(path, [("A", "[1]"), ("Bé", '{"b": null}')]), 2
+            )
+
+            snapshot = Snapshot(path)
+            self.assertEqual(snapshot.get("A"), [1])
+            self.assertEqual(snapshot.get("Bé"), {"b": None})
+            self.assertIsNone(snapshot.get("B"))
+            self.assertEqual(snapshot.get("C", []), [])
+            snapshot.close()
+
+            with self.assertRaises(ValueError):
+                Snapshot.write(path, [("B", "1"), ("A", "2")])
+
+    def test_generator_with_snapshot(self):
+        FindThatCharitySource().process_csv(
+            [
+                {"id": "GB-CHC-1", "name": "One", "orgIDs": '["GB-CHC-1", "GB-COH-1"]'},
+                {"id": "GB-COH-1", "name": "One Ltd", "orgIDs": '["GB-COH-1"]'},
+            ],
+            "ccew",
+        )
+        NSPL.objects.create(
+            postcode="EX364AJ", data={"pcd": "EX364AJ", "laua": "E07000043"}
+        )
+        GeoCodeName.objects.create(code="E07000043", data={"name": "North Devon"})
+        GeoLookup.objects.create(
+            areacode="E07000043",
+            areatype="la",
+            data={"areacode": "E07000043", "areatype": "la"},
+        )
+
+        grants = []
+        for grant in Grant.objects.all()[:5]:
+            grant.data["recipientOrganization"][0]["id"] = "GB-COH-1"
+            grant.data["recipientOrganization"][0]["postalCode"] = "EX36 4AJ"
+            grant.data["beneficiaryLocation"] = [{"geoCode": "E07000043"}]
+            grants.append(grant.data)
+
+        expected = [AdditionalDataGenerator().create(grant) for grant in grants]
+        self.assertEqual(len(expected[0]["recipientOrgInfos"]), 2)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            self.assertEqual(
+                LookupSnapshot.build(tmp_dir),
+                {"org_infos": 2, "geo_code_names": 1, "geo_lookups": 1, "nspl": 1},
+            )
+
+            generator = AdditionalDataGenerator(snapshot=LookupSnapshot(tmp_dir))
+
+            with self.assertNumQueries(0):
+                self.assertEqual(
+                    [generator.create(grant) for grant in grants], expected
+                )
+                self.assertEqual(generator.create_many(grants), expected)
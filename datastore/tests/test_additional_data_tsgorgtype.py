@@ -43,3 +43,44 @@ class TestTSGOrgTypeAdditionalData(TestCase):
             in additional_data[TSGOrgTypesSource.ADDITIONAL_DATA_KEY],
             "Expected 'Lottery Distributor'",
         )
+
+    def test_combined_rules(self):
+        TSGOrgType.objects.create(regex="^XI-TEST-", priority=1000, tsg_org_type="Test")
+        TSGOrgType.objects.create(
+            regex="^XI-(TEST|X)-(1)", priority=999, tsg_org_type="X"
+        )
+        TSGOrgType.objects.create(regex=r"^(A)\1", priority=998, tsg_org_type="AA")
+
+        org_ids = ["GB-GOR-PC390", "GB-LAS-1", "XI-TEST-1", "XI-X-1", "AA", "AB"]
+        expected = [
+            "Lottery Distributor",
+            "Local Government",
+            "Test",
+            "X",
+            "AA",
+            "Grantmaking Organisation",
+        ]
+
+        tsg_org_types = TSGOrgTypesSource()
+        # The rule with a backreference can't be combined with the others
+        self.assertIsNone(tsg_org_types.matcher)
+        self.assertEqual(
+            [tsg_org_types.get_org_type(org_id) for org_id in org_ids], expected
+        )
+
+        TSGOrgType.objects.filter(tsg_org_type="AA").update(regex="^(A)A")
+        tsg_org_types = TSGOrgTypesSource()
+        self.assertIsNotNone(tsg_org_types.matcher)
+        self.assertEqual(
+            [tsg_org_types.get_org_type(org_id) for org_id in org_ids], expected
+        )
+
+        grant = Grant.objects.last()
+        grant.data["fundingOrganization"][0]["id"] = "XI-TEST-1"
+        for i in range(2):
+            additional_data = {}
+            tsg_org_types.update_additional_data(grant.data, additional_data)
+            self.assertEqual(
+                additional_data[TSGOrgTypesSource.ADDITIONAL_DATA_KEY], "Test"
+            )
+        self.assertEqual(tsg_org_types._org_types, {"XI-TEST-1": "Test"})
@@ -5,9 +5,13 @@ import json
 
 from django.core.management import call_command
 from django.core.management.base import CommandError
-from django.test import TransactionTestCase
+from django.test import TransactionTestCase, override_settings
 
 import db.models as db
+from additional_data.location_refs import LocationResolver
+from additional_data.models import NSPL, GeoCodeName, GeoLookup
+from db.management.commands import load_datagetter_data
+from tests.generate_testdata import generate_data
 
 
 class CustomMgmtCommandsTest(TransactionTestCase):
@@ -39,6 +43,100 @@ class CustomMgmtCommandsTest(TransactionTestCase):
                 len(err_out.getvalue()), 0, "Errors output by load command"
             )
 
+    def test_load_datagetter_data_batched(self):
+        err_out = StringIO()
+        with TemporaryDirectory() as tmpdir:
+            generate_data(tmpdir)
+            grants_before = db.Grant.objects.count()
+
+            call_command(
+                "load_datagetter_data", tmpdir, "--batch-size", "2", stderr=err_out
+            )
+            self.assertEqual(
+                len(err_out.getvalue()), 0, "Errors output by load command"
+            )
+
+            getter_run = db.GetterRun.latest()
+            self.assertEqual(db.Grant.objects.count() - grants_before, 50)
+            for source_file in getter_run.sourcefile_set.all():
+                self.assertEqual(source_file.grant_set.count(), 5)
+
+    def test_load_datagetter_data_without_grants_key(self):
+        command = load_datagetter_data.Command(stdout=StringIO())
+
+        with TemporaryDirectory() as tmpdir:
+            command.options = {"data_dir": [tmpdir], "skip_missing": False}
+            os.mkdir(os.path.join(tmpdir, "json_all"))
+            for name, content in [
+                ("grants.json", {"grants": [{"id": "360G-1"}]}),
+                ("empty.json", {"grants": []}),
+                ("missing.json", {"not_grants": [{"id": "360G-1"}]}),
+            ]:
+                with open(os.path.join(tmpdir, "json_all", name), "w") as fp:
+                    json.dump(content, fp)
+
+            self.assertEqual(
+                list(command.iter_grant_data("grants.json")), [{"id": "360G-1"}]
+            )
+            self.assertEqual(list(command.iter_grant_data("empty.json")), [])
+            # Skipped like any other broken file rather than loading no grants
+            with self.assertRaises(KeyError):
+                list(command.iter_grant_data("missing.json"))
+
+    def test_load_datagetter_data_parallel(self):
+        err_out = StringIO()
+        with TemporaryDirectory() as tmpdir:
+            generate_data(tmpdir)
+            grants_before = db.Grant.objects.count()
+
+            call_command(
+                "load_datagetter_data", tmpdir, "--parallel", "2", stderr=err_out
+            )
+            self.assertEqual(
+                len(err_out.getvalue()), 0, "Errors output by load command"
+            )
+
+            getter_run = db.GetterRun.latest()
+            self.assertEqual(db.Grant.objects.count() - grants_before, 50)
+            for source_file in getter_run.sourcefile_set.all():
+                self.assertEqual(source_file.grant_set.count(), 5)
+
+    def test_load_datagetter_data_reuse_unchanged(self):
+        with TemporaryDirectory() as tmpdir:
+            generate_data(tmpdir)
+
+            call_command("load_datagetter_data", tmpdir, stdout=StringIO())
+            first_getter_run = db.GetterRun.latest()
+
+            out = StringIO()
+            call_command(
+                "load_datagetter_data", tmpdir, "--reuse-unchanged", stdout=out
+            )
+            getter_run = db.GetterRun.latest()
+
+            self.assertNotEqual(first_getter_run, getter_run)
+            self.assertEqual(out.getvalue().count("Reusing 5 unchanged grants"), 10)
+
+            for source_file in getter_run.sourcefile_set.all():
+                first_source_file = first_getter_run.sourcefile_set.get(
+                    data__identifier=source_file.data["identifier"]
+                )
+                self.assertEqual(
+                    source_file.content_hash, first_source_file.content_hash
+                )
+                self.assertEqual(
+                    sorted(source_file.grant_set.values_list("grant_id", flat=True)),
+                    sorted(
+                        first_source_file.grant_set.values_list("grant_id", flat=True)
+                    ),
+                )
+                self.assertEqual(
+                    source_file.grant_set.exclude(
+                        publisher__getter_run=getter_run
+                    ).count(),
+                    0,
+                )
+
     def test_delete_datagetter_data(self):
         """
         Test that delete_datagetter_data --oldest deletes a single GetterRun.
@@ -181,6 +279,171 @@ class CustomMgmtCommandsTest(TransactionTestCase):
 
         self.assertEqual(len(err_out.getvalue()), 0, "Errors output by command")
 
+        source_files = db.Latest.objects.get(
+            series=db.Latest.CURRENT
+        ).sourcefile_set.filter(grant__isnull=False)
+        self.assertFalse(source_files.filter(grants_hash__isnull=True).exists())
+
+        # The quality data of unchanged source files is kept, unless forced
+        source_file = source_files.first()
+        quality = source_file.quality
+        db.SourceFile.objects.filter(pk=source_file.pk).update(quality={"kept": True})
+
+        call_command("rewrite_quality_data", "latest", "--sourcefile-only")
+        source_file.refresh_from_db()
+        self.assertEqual(source_file.quality, {"kept": True})
+
+        call_command("rewrite_quality_data", "latest", "--sourcefile-only", "--force")
+        source_file.refresh_from_db()
+        self.assertEqual(source_file.quality, quality)
+
+    def test_rewrite_additional_data(self):
+        getter_run = db.GetterRun.objects.filter(grant__isnull=False).first()
+        grants = db.Grant.objects.filter(getter_run=getter_run).order_by("pk")
+        additional_data = dict(grants.values_list("pk", "additional_data"))
+        last_pk = list(additional_data)[len(additional_data) // 2]
+
+        grants.update(additional_data=None)
+
+        with TemporaryDirectory() as tmpdir:
+            checkpoint = os.path.join(tmpdir, "checkpoint.json")
+            with open(checkpoint, "w") as checkpoint_fp:
+                json.dump(
+                    {"getter_run": str(getter_run.pk), "last_pk": last_pk},
+                    checkpoint_fp,
+                )
+
+            call_command(
+                "rewrite_additional_data",
+                str(getter_run.pk),
+                "--batch-size",
+                "3",
+                "--parallel",
+                "2",
+                "--checkpoint",
+                checkpoint,
+                stdout=StringIO(),
+            )
+            self.assertFalse(os.path.exists(checkpoint))
+
+        # Only the grants after the checkpoint are rewritten
+        for pk, grant_additional_data in grants.values_list("pk", "additional_data"):
+            if pk <= last_pk:
+                self.assertIsNone(grant_additional_data)
+            else:
+                self.assertIsNotNone(grant_additional_data)
+
+        call_command("rewrite_additional_data", str(getter_run.pk), stdout=StringIO())
+        self.assertFalse(grants.filter(additional_data__isnull=True).exists())
+
+    def test_lookup_key_changes(self):
+        getter_run = db.GetterRun.objects.filter(grant__isnull=False).first()
+        grants = db.Grant.objects.filter(getter_run=getter_run)
+
+        grant = grants.first()
+        grant.data["recipientOrganization"][0]["postalCode"] = "EX36 4AJ"
+        grant.save()
+        nspl = NSPL.objects.create(postcode="EX364AJ", data={"laua": "E07000043"})
+
+        call_command("rewrite_additional_data", str(getter_run.pk), stdout=StringIO())
+        grant.refresh_from_db()
+        self.assertIn("postcode:EX364AJ", grant.additional_data_keys)
+
+        call_command("lookup_key_changes", "--start", stdout=StringIO())
+        nspl.data = {"laua": "E06000001"}
+        nspl.save()
+
+        with TemporaryDirectory() as tmpdir:
+            keys_file = os.path.join(tmpdir, "changed_keys.txt")
+            call_command("lookup_key_changes", "--finish", keys_file, stdout=StringIO())
+
+            with open(keys_file) as keys_fp:
+                self.assertEqual(keys_fp.read(), "postcode:EX364AJ\n")
+
+            grants.exclude(pk=grant.pk).update(additional_data={"unchanged": True})
+            # Loaded before the lookup keys were added
+            unbackfilled = grants.exclude(pk=grant.pk).first()
+            grants.filter(pk=unbackfilled.pk).update(additional_data_keys=None)
+            call_command(
+                "rewrite_additional_data",
+                str(getter_run.pk),
+                "--lookup-keys-file",
+                keys_file,
+                stdout=StringIO(),
+            )
+
+        grant.refresh_from_db()
+        self.assertEqual(
+            grant.additional_data["recipientOrganizationLocation"]["laua"],
+            "E06000001",
+        )
+        unbackfilled.refresh_from_db()
+        self.assertNotEqual(unbackfilled.additional_data, {"unchanged": True})
+        self.assertIsNotNone(unbackfilled.additional_data_keys)
+        self.assertEqual(
+            grants.filter(additional_data={"unchanged": True}).count(),
+            grants.count() - 2,
+        )
+
+    def test_additional_data_location_refs(self):
+        NSPL.objects.create(
+            postcode="EX364AJ", data={"laua": "E07000043", "lsoa11": "E01020135"}
+        )
+        GeoCodeName.objects.create(code="E07000043", data={"name": "North Devon"})
+        GeoLookup.objects.create(
+            areacode="E01020135",
+            areatype="lsoa",
+            data={"areacode": "E01020135", "ladnm": "North Devon"},
+        )
+
+        grants = db.Latest.grants().order_by("pk")
+        for grant in grants:
+            grant.data["recipientOrganization"][0]["postalCode"] = "ex36 4aj"
+            grant.save()
+
+        call_command("rewrite_additional_data", "latest", stdout=StringIO())
+        expected = list(grants.values_list("additional_data", flat=True))
+        self.assertEqual(
+            expected[0]["recipientOrganizationLocation"]["laua_name"], "North Devon"
+        )
+        self.assertEqual(expected[0]["recipientDistrictName"], "North Devon")
+
+        with override_settings(ADDITIONAL_DATA_LOCATION_REFS=True):
+            call_command("rewrite_additional_data", "latest", stdout=StringIO())
+
+        stored = list(grants.values_list("additional_data", flat=True))
+        self.assertEqual(
+            stored[0]["recipientOrganizationLocation"], {"postcodeRef": "EX364AJ"}
+        )
+        self.assertEqual(
+            stored[0]["locationLookup"],
+            [
+                {
+                    "areaRef": "E01020135",
+                    "source": "recipientOrganizationPostcode",
+                    "sourceCode": "E01020135",
+                }
+            ],
+        )
+        self.assertEqual(stored[0]["recipientDistrictName"], "North Devon")
+
+        self.assertEqual(LocationResolver().resolve_many(stored), expected)
+
+        with TemporaryDirectory() as tmpdir:
+            call_command("create_data_package", dir=tmpdir, stderr=StringIO())
+
+            source_file = grants[0].source_file
+            with open(
+                os.path.join(
+                    tmpdir, "json_all", "%s.json" % source_file.data["identifier"]
+                )
+            ) as grants_fp:
+                package_grants = json.load(grants_fp)["grants"]
+
+        self.assertIn(
+            expected[0], [grant["additional_data"] for grant in package_grants]
+        )
+
     def test_list_entities(self):
         err_out = StringIO()
 
@@ -1,6 +1,22 @@
+import datetime
+from contextlib import redirect_stdout
+from io import StringIO
+
+from django.core.management import call_command
+from django.db import (
+    DEFAULT_DB_ALIAS,
+    IntegrityError,
+    connection,
+    connections,
+    transaction,
+)
 from django.test import TransactionTestCase, TestCase
+from django.utils import timezone
 
 import db.models as db
+from additional_data.models import GeoLookup
+from db.copy_loader import CopyLoader, GrantCopyLoader
+from db.shadow_table import ShadowTable, SwapLockTimeout
 
 
 class GetterRunTest(TransactionTestCase):
@@ -17,6 +33,180 @@ class GetterRunTest(TransactionTestCase):
         )  # there should always be *some* in-use data
         self.assertEqual(in_use_count + not_in_use_count, total_count)
 
+    def grants_partition_exists(self, getter_run):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT to_regclass(%s)", [getter_run.grants_partition_name()]
+            )
+            return cursor.fetchone()[0] is not None
+
+    def test_grants_partition(self):
+        source_file = db.SourceFile.objects.first()
+        publisher = db.Publisher.objects.first()
+
+        getter_run = db.GetterRun.objects.create()
+        self.assertTrue(self.grants_partition_exists(getter_run))
+
+        with GrantCopyLoader(
+            getter_run_id=getter_run.pk,
+            publisher_id=publisher.pk,
+            publisher_org_id=publisher.org_id,
+            source_file_id=source_file.pk,
+        ) as loader:
+            loader.add_grant({"id": "360G-1", "fundingOrganization": []}, None)
+
+        self.assertEqual(getter_run.grant_set.count(), 1)
+
+        grants_before = db.Grant.objects.count()
+        getter_run.archive_run()
+        self.assertEqual(getter_run.grant_set.count(), 0)
+        self.assertEqual(db.Grant.objects.count(), grants_before - 1)
+        self.assertTrue(self.grants_partition_exists(getter_run))
+
+        getter_run.delete_all_data_from_run()
+        self.assertFalse(self.grants_partition_exists(getter_run))
+
+
+class LatestTest(TransactionTestCase):
+    def create_getter_run(self, days_ago, sources):
+        """Creates a GetterRun with a source file and its grants for each of
+        the (identifier, downloaded and valid, grant ids) sources"""
+        getter_run = db.GetterRun.objects.create(
+            datetime=timezone.now() - datetime.timedelta(days=days_ago)
+        )
+        publisher = db.Publisher.objects.create(
+            org_id="XI-EXAMPLE-EXAMPLE",
+            name="example",
+            data={},
+            prefix="360G-example",
+            getter_run=getter_run,
+            source=db.Publisher.PUBLISHER,
+        )
+
+        for identifier, good, grant_ids in sources:
+            source_file = db.SourceFile.objects.create(
+                getter_run=getter_run,
+                data={
+                    "identifier": identifier,
+                    "publisher": {"prefix": "360G-example"},
+                    "datagetter_metadata": {
+                        "downloads": good,
+                        "valid": good,
+                        "acceptable_license": good,
+                        "datetime_downloaded": getter_run.datetime.isoformat(),
+                    },
+                },
+            )
+            with GrantCopyLoader(
+                getter_run_id=getter_run.pk,
+                publisher_id=publisher.pk,
+                publisher_org_id=publisher.org_id,
+                source_file_id=source_file.pk,
+            ) as loader:
+                for grant_id in grant_ids:
+                    loader.add_grant({"id": grant_id, "fundingOrganization": []}, None)
+
+        return getter_run
+
+    def latest_grants(self, latest):
+        """The grant_ids in the latest's partition of the through table"""
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT db_grant.grant_id FROM %s AS through"
+                " JOIN db_grant ON db_grant.id = through.grant_id"
+                % latest.grants_partition_name()
+            )
+            return sorted(grant_id for (grant_id,) in cursor.fetchall())
+
+    def update(self):
+        with redirect_stdout(StringIO()):
+            db.Latest.update()
+
+    def test_update(self):
+        first_run = self.create_getter_run(
+            7, [("a", True, ["360G-a-1"]), ("b", True, ["360G-b-1", "360G-b-2"])]
+        )
+        self.update()
+
+        first = db.Latest.objects.get(series=db.Latest.CURRENT)
+        self.assertEqual(
+            self.latest_grants(first), ["360G-a-1", "360G-b-1", "360G-b-2"]
+        )
+
+        # As if it had been compacted while out of use
+        db.GrantBlob.compact(first_run.sourcefile_set.filter(data__identifier="b"))
+
+        second_run = self.create_getter_run(
+            0,
+            [
+                # Replaces the first run's source file
+                ("a", True, ["360G-a-3"]),
+                # Failed so the first run's is carried over
+                ("b", False, []),
+                # Failed with nothing to replace it
+                ("c", False, []),
+                # Downloaded but without any grants
+                ("d", True, []),
+            ],
+        )
+        self.update()
+
+        latest = db.Latest.objects.get(series=db.Latest.CURRENT)
+        self.assertEqual(
+            sorted(latest.sourcefile_set.values_list("getter_run", "data__identifier")),
+            sorted([(first_run.pk, "b"), (second_run.pk, "a")]),
+        )
+        self.assertEqual(
+            self.latest_grants(latest), ["360G-a-3", "360G-b-1", "360G-b-2"]
+        )
+        self.assertEqual(
+            sorted(db.Latest.grants().values_list("grant_id", flat=True)),
+            ["360G-a-3", "360G-b-1", "360G-b-2"],
+        )
+        # The carried over source has its grants' data back
+        self.assertFalse(db.Latest.grants().filter(data__isnull=True).exists())
+        self.assertEqual(
+            sorted(db.Latest.current_getter_run_ids()),
+            sorted([first_run.pk, second_run.pk]),
+        )
+
+        # The first is kept as the previous
+        self.assertEqual(db.Latest.objects.get(series=db.Latest.PREVIOUS), first)
+        self.assertEqual(
+            self.latest_grants(first), ["360G-a-1", "360G-b-1", "360G-b-2"]
+        )
+        self.assertFalse(db.Latest.objects.filter(series=db.Latest.NEXT).exists())
+
+        # Updating again replaces the previous, dropping its partition
+        self.update()
+        self.assertEqual(db.Latest.objects.get(series=db.Latest.PREVIOUS), latest)
+        self.assertFalse(db.Latest.objects.filter(pk=first.pk).exists())
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT to_regclass(%s)", [first.grants_partition_name()])
+            self.assertIsNone(cursor.fetchone()[0])
+
+        # Only the first run's replaced source is out of use, the run loaded
+        # since the update is about to be used
+        third_run = self.create_getter_run(-1, [("a", True, ["360G-a-4"])])
+        call_command("compact_grant_data", "--batch-size", "1", stdout=StringIO())
+        self.assertEqual(
+            list(
+                db.Grant.objects.filter(data__isnull=True).values_list(
+                    "grant_id", flat=True
+                )
+            ),
+            ["360G-a-1"],
+        )
+        self.assertFalse(third_run.grant_set.filter(blob__isnull=False).exists())
+
+    def test_update_without_grants(self):
+        self.create_getter_run(0, [("a", False, [])])
+
+        with self.assertRaises(Exception):
+            self.update()
+
+        self.assertFalse(db.Latest.objects.filter(series=db.Latest.CURRENT).exists())
+
 
 class GrantTest(TestCase):
     def test_convenience_fields_from_data(self):
@@ -91,3 +281,198 @@ class GrantTest(TestCase):
         self.assertSetEqual(set(grant.funding_org_ids), {"GB-CHC-12345"})
 
         self.assertEqual(grant.publisher_org_id, "XI-EXAMPLE-EXAMPLE")
+
+
+class GrantCopyLoaderTest(TransactionTestCase):
+    fixtures = ["test_data.json"]
+
+    def test_copy_round_trip(self):
+        source_file = db.SourceFile.objects.first()
+        publisher = db.Publisher.objects.filter(
+            getter_run=source_file.getter_run
+        ).first()
+
+        awkward = 'tab\there\nnew line\r\\N back\\slash "quoted" {braces}, £'
+
+        data = {
+            "id": "360G-copy-loader\t1",
+            "title": awkward,
+            "description": "",
+            "amountAwarded": 1234.5,
+            "fundingOrganization": [{"id": 'GB-"funder"\\1'}, {"name": "No id"}],
+            "recipientOrganization": [{"id": "GB-CHC-1,2 {3}"}],
+        }
+        individual_data = {
+            "id": "360G-copy-loader-2",
+            "title": "",
+            "fundingOrganization": [{"id": "GB-CHC-12345"}],
+        }
+
+        with GrantCopyLoader(
+            getter_run_id=source_file.getter_run_id,
+            publisher_id=publisher.pk,
+            publisher_org_id=publisher.org_id,
+            source_file_id=source_file.pk,
+        ) as loader:
+            loader.add_grant(data, {"note": awkward}, ["org_id:GB-CHC-1,2 {3}"])
+            loader.add_grant(individual_data, None)
+
+        self.assertEqual(loader.rows_added, 2)
+
+        grant = db.Grant.objects.get(grant_id=data["id"])
+        self.assertEqual(grant.data, data)
+        self.assertEqual(grant.additional_data, {"note": awkward})
+        self.assertEqual(grant.funding_org_ids, ['GB-"funder"\\1'])
+        self.assertEqual(grant.recipient_org_ids, ["GB-CHC-1,2 {3}"])
+        self.assertEqual(grant.additional_data_keys, ["org_id:GB-CHC-1,2 {3}"])
+        self.assertEqual(grant.publisher_org_id, publisher.org_id)
+        self.assertEqual(grant.source_file, source_file)
+
+        grant = db.Grant.objects.get(grant_id=individual_data["id"])
+        self.assertEqual(grant.data, individual_data)
+        self.assertIsNone(grant.additional_data)
+        self.assertEqual(grant.recipient_org_ids, [])
+
+
+class SourceFileTest(TransactionTestCase):
+    fixtures = ["test_data.json"]
+
+    def test_grants_hashes(self):
+        source_files = db.SourceFile.objects.filter(grant__isnull=False).distinct()
+        grants_hashes = db.SourceFile.grants_hashes(source_files)
+
+        source_file = source_files.first()
+        grants_count, grants_hash = grants_hashes[source_file.pk]
+        self.assertEqual(grants_count, source_file.grant_set.count())
+        self.assertEqual(len(grants_hash), 64)
+
+        # Doesn't depend on the order the grants were loaded in
+        grants = list(source_file.grant_set.order_by("-pk").values("grant_id", "data"))
+        source_file.grant_set.all().delete()
+        with GrantCopyLoader(
+            getter_run_id=source_file.getter_run_id,
+            publisher_id=source_file.get_publisher().pk,
+            publisher_org_id=source_file.get_publisher().org_id,
+            source_file_id=source_file.pk,
+        ) as loader:
+            for grant in grants:
+                loader.add_grant(grant["data"], None)
+
+        self.assertEqual(
+            db.SourceFile.grants_hashes(source_files)[source_file.pk],
+            (grants_count, grants_hash),
+        )
+
+        source_file.grant_set.filter(grant_id=grants[0]["grant_id"]).update(
+            data={"id": grants[0]["grant_id"]}
+        )
+        self.assertNotEqual(
+            db.SourceFile.grants_hashes(source_files)[source_file.pk][1], grants_hash
+        )
+
+
+class GrantBlobTest(TransactionTestCase):
+    fixtures = ["test_data.json"]
+
+    def test_compact_and_hydrate(self):
+        source_file = db.SourceFile.objects.filter(latest__isnull=True).first()
+        source_files = db.SourceFile.objects.filter(pk=source_file.pk)
+        grants_data = dict(source_file.grant_set.values_list("pk", "data"))
+        self.assertGreater(len(grants_data), 0)
+
+        self.assertEqual(db.GrantBlob.compact(source_files), len(grants_data))
+        self.assertFalse(source_file.grant_set.filter(data__isnull=False).exists())
+        self.assertFalse(source_file.grant_set.filter(blob__isnull=True).exists())
+        self.assertEqual(
+            db.GrantBlob.objects.count(),
+            source_file.grant_set.values("blob").distinct().count(),
+        )
+
+        # Nothing left to compact
+        self.assertEqual(db.GrantBlob.compact(source_files), 0)
+
+        with self.assertNumQueries(2):
+            grants = db.GrantBlob.fill(list(source_file.grant_set.all()))
+        self.assertEqual({grant.pk: grant.data for grant in grants}, grants_data)
+
+        db.GrantBlob.hydrate(source_files)
+        self.assertEqual(
+            dict(source_file.grant_set.values_list("pk", "data")), grants_data
+        )
+        self.assertFalse(source_file.grant_set.filter(blob__isnull=False).exists())
+
+        self.assertGreater(db.GrantBlob.delete_unused(), 0)
+        self.assertEqual(db.GrantBlob.objects.count(), 0)
+
+
+class ShadowTableTest(TestCase):
+    def table_indexes(self, table):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT indexname, indexdef FROM pg_indexes WHERE tablename = %s",
+                [table],
+            )
+            return sorted(cursor.fetchall())
+
+    def test_swap(self):
+        GeoLookup.objects.create(areacode="E01000001", areatype="lsoa", data={})
+        indexes = self.table_indexes(GeoLookup._meta.db_table)
+
+        with ShadowTable(GeoLookup) as shadow:
+            with CopyLoader(
+                GeoLookup, ["areacode", "areatype", "data"], table=shadow.table
+            ) as loader:
+                loader.add(["E06000001", "la", {"areaname": "Hartlepool"}])
+                loader.add(["E06000002", "la", {"areaname": "Middlesbrough"}])
+
+            # Not replaced until everything has loaded
+            self.assertEqual(GeoLookup.objects.count(), 1)
+
+        self.assertFalse(shadow.exists())
+        self.assertEqual(
+            sorted(GeoLookup.objects.values_list("areacode", flat=True)),
+            ["E06000001", "E06000002"],
+        )
+        self.assertEqual(self.table_indexes(GeoLookup._meta.db_table), indexes)
+
+        # The unique constraint and id sequence still work
+        GeoLookup.objects.create(areacode="E06000003", areatype="la", data={})
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            GeoLookup.objects.create(areacode="E06000003", areatype="la", data={})
+
+    def test_failed_load(self):
+        GeoLookup.objects.create(areacode="E01000001", areatype="lsoa", data={})
+
+        with self.assertRaises(ValueError):
+            with ShadowTable(GeoLookup):
+                raise ValueError
+
+        self.assertEqual(GeoLookup.objects.count(), 1)
+
+    def test_swap_lock_timeout(self):
+        GeoLookup.objects.create(areacode="E01000001", areatype="lsoa", data={})
+
+        shadow = ShadowTable(GeoLookup)
+        shadow.lock_timeout = "100ms"
+        shadow.lock_attempts = 2
+        shadow.lock_retry_delay = 0
+        shadow.create()
+
+        # Something else is reading the live table
+        reader = connections.create_connection(DEFAULT_DB_ALIAS)
+        try:
+            with reader.cursor() as cursor:
+                reader.set_autocommit(False)
+                cursor.execute(
+                    "LOCK TABLE %s IN ACCESS SHARE MODE" % GeoLookup._meta.db_table
+                )
+                with self.assertRaises(SwapLockTimeout):
+                    shadow.swap()
+        finally:
+            reader.close()
+
+        self.assertTrue(shadow.exists())
+        self.assertEqual(GeoLookup.objects.count(), 1)
+
+        shadow.swap()
+        self.assertEqual(GeoLookup.objects.count(), 0)
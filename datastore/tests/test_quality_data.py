@@ -20,6 +20,21 @@ class TestDataQualityData(TestCase):
         # data quality usefulness results
         self.assertEqual(len(quality), 2)
 
+    def test_quality_engine_reused(self):
+        grants_list = list(
+            db.SourceFile.objects.get(pk=3).grant_set.values_list("data", flat=True)
+        )
+
+        engine = quality_data.QualityEngine()
+        results = engine.create(grants_list)
+        usefulness_tests = list(engine.usefulness_tests)
+
+        # The tests aren't added again by each set of grants or engine
+        self.assertEqual(engine.create(grants_list), results)
+        self.assertEqual(quality_data.QualityEngine().create(grants_list), results)
+        self.assertEqual(engine.usefulness_tests, usefulness_tests)
+        self.assertEqual(quality_data.create(grants_list), results)
+
     def test_create_sourcefile_publisher_quality_data(self):
         source_file = db.SourceFile.objects.get(pk=3)
 
@@ -164,3 +179,28 @@ class TestDataQualityData(TestCase):
 
         self.assertEqual(expected_publisher_aggregate, publisher.aggregate)
         self.assertEqual(expected_publisher_quality, publisher.quality)
+
+        # The stats of the publisher's source files come from a few grouped
+        # queries rather than one for each of them
+        with self.assertNumQueries(5):
+            self.assertEqual(
+                quality_data.create_publisher_stats(publisher),
+                (expected_publisher_quality, expected_publisher_aggregate),
+            )
+
+    def test_stats_with_malformed_dates(self):
+        source_files = db.Latest.objects.get(
+            series=db.Latest.CURRENT
+        ).sourcefile_set.all()
+        for source_file in source_files:
+            source_file.aggregate = {"count": 1, "max_award_date": "03/10/2019"}
+            source_file.data["modified"] = "2019-02-31T00:00:00"
+            source_file.save()
+
+        # The dates are left out rather than failing the other stats
+        stats = quality_data.generate_stats("overview_grants", source_files)
+        self.assertEqual(stats["aggregate"]["awardedThisYear"], 0)
+        self.assertEqual(stats["aggregate"]["total"]["grants"], source_files.count())
+
+        stats = quality_data.generate_stats("overview_publishers", source_files)
+        self.assertEqual(stats["aggregate"]["publishedThisYear"], 0)
@@ -79,6 +79,9 @@ echo_stamp "Create GrantNav package"
 echo_stamp "Deleting old unused datagetter data"
 ./datastore/manage.py delete_datagetter_data --all-not-in-use --older-than-days 90 --force-delete-in-use-data --no-prompt
 
+echo_stamp "Compacting unused datagetter data"
+./datastore/manage.py compact_grant_data
+
 echo_stamp "Deleting old GrantNav packages"
 find $GRANTNAV_DATA_PACKAGE_DOWNLOAD_DIR -name "data_*.tar.gz" -mtime +$MAX_PACKAGE_AGE_DAYS | xargs rm -f
 